@@ -7,6 +7,9 @@ import logging
 ## This is required for the azure utility when using this for anything other than azure please comment this line
 from azure.storage.blob import BlockBlobService
 
+from . import httpClient
+from . import credentialProvider
+
 class AzureUtility(object):
     def __init__(self):
         self.storageAccount = self.getStorageAccountName()
@@ -27,7 +30,7 @@ class AzureUtility(object):
                 urlFIT = f"https://{self.storageAccount}.table.core.windows.net/{self.fitTable}(PartitionKey='{customerName}',RowKey='{serviceCategory}')"
 
                 self.writeLog(f'urlFIT : {urlFIT}', "Info")
-                respRestFIT = requests.get(urlFIT, headers=headers,timeout=100)
+                respRestFIT = httpClient.getSession().get(urlFIT, headers=headers,timeout=httpClient.getRequestTimeout())
                 
                 statusCode = respRestFIT.status_code
 
@@ -113,26 +116,18 @@ class AzureUtility(object):
         elif typeofLog ==  "Error":
             logging.error(message)
     
-    ## This function will get the token for the REST API call
+    ## This function will get the token for the REST API call. The token is cached until shortly before it expires.
     def getToken(self):
         access_token = ""
         resource_uri = "https://storage.azure.com/" 
         try:
-            token_auth_uri = f"{self.identityEndpoint}?resource={resource_uri}&api-version=2017-09-01"
-            headers = {'Content-Type': 'application/json', 'secret': self.identityHeader,'Access-Control-Allow-Credentials': 'true','Access-Control-Allow-Origin': 'http://localhost:8081','Access-Control-Allow-Methods': 'GET','Access-Control-Request-Headers': 'X-Custom-Header'}
-            
             try:
-                resp = requests.get(token_auth_uri, headers=headers)
-                resp.raise_for_status()
+                access_token = credentialProvider.getToken(resource_uri)
             except requests.exceptions.HTTPError as err:
                 self.writeLog(f"getToken: The error while getting token {err}", "Error")
                 return err
-
-
-            access_token = resp.json()['access_token']
             
         except Exception as error:
             self.writeLog(f'getToken: error : {error}', "Error")
 
         return access_token
-        
@@ -0,0 +1,82 @@
+## This class holds everything the billing functions produce for a single subscription (cost accumulators, CSV headers and CSV rows).
+## Every subscription gets its own object so subscriptions can be processed by parallel workers and merged afterwards in the
+## original subscription order, which gives exactly the same output as a sequential run.
+## The rows of every billing code are kept in a column oriented BillingRowStore.
+from .billingRowStore import BillingRowStore
+
+## Columns holding a cost per billing code (the part before ':'), kept as numbers until the file is written
+CostColumns = {
+    "ALL": [11],
+    "SUBS": [2],
+    "SVC": [3],
+    "AZU-COST": [5],
+    "AZU-OS": [5]
+}
+
+class BillingResult(object):
+    def __init__(self, subid = None, subname = None):
+        self.subid = subid
+        self.subname = subname
+        self.currencyCode = ""
+        self.SubsTotalCost = 0
+        self.ServiceCost = dict()
+        self.VMData = dict()
+        self.ResourceIDs = dict()
+        self.CSVData = dict()
+        self.CSVHeader = dict()
+
+    def setCSVFileHeaderRow(self, billingItemCode, headerRow):
+        billingItemCode = billingItemCode.upper()
+        self.CSVHeader[billingItemCode] = headerRow
+
+    def getRowStore(self, billingItemCode, nbColumns):
+        if billingItemCode not in self.CSVData:
+            self.CSVData[billingItemCode] = BillingRowStore(nbColumns, CostColumns.get(billingItemCode.split(':')[0], ()))
+        return self.CSVData[billingItemCode]
+
+    ## Cost values of the cost columns are given as float, they are formatted when the file is written. Returns the index of
+    ## the row in the billing code.
+    def storeCSVDataForSubscription(self, billingItemCode, dataRow):
+        billingItemCode = billingItemCode.upper()
+        return self.getRowStore(billingItemCode, len(dataRow)).addRow(dataRow)
+
+    def getCSVDataRow(self, billingItemCode, rowIndex):
+        return self.CSVData[billingItemCode.upper()].getRow(rowIndex)
+
+    ## Replaces values of a row already stored, given as {columnIndex: value}
+    def updateCSVDataForSubscription(self, billingItemCode, rowIndex, columnValues):
+        self.CSVData[billingItemCode.upper()].setValues(rowIndex, columnValues)
+
+    ## Adds several rows at once, given as one list (or numpy array) of values per column
+    def storeCSVColumnsForSubscription(self, billingItemCode, dataColumns):
+        billingItemCode = billingItemCode.upper()
+        self.getRowStore(billingItemCode, len(dataColumns)).addColumns(dataColumns)
+
+    ## Returns the rows of the billing code as a DataFrame with its CSV header
+    def getCSVDataFrame(self, billingItemCode):
+        return self.getCSVRowStore(billingItemCode).toDataFrame(self.CSVHeader[billingItemCode])
+
+    ## Returns the CSV text of the billing code in chunks of rows, for the streaming upload
+    def iterCSVChunks(self, billingItemCode):
+        return self.getCSVRowStore(billingItemCode).iterCSVChunks(self.CSVHeader[billingItemCode])
+
+    ## Returns the Parquet file of the billing code, with one row group per subscription (first column)
+    def getParquetData(self, billingItemCode):
+        return self.getCSVRowStore(billingItemCode).toParquet(self.CSVHeader[billingItemCode])
+
+    def getCSVRowStore(self, billingItemCode):
+        if billingItemCode in self.CSVData:
+            return self.CSVData[billingItemCode]
+        return BillingRowStore(len(self.CSVHeader[billingItemCode]))
+
+    ## Adds the CSV headers and rows of another result to this one. Header rows are replaced (last one wins) while keeping the
+    ## position of the first occurrence, and data rows are appended, the same as when both were written to a single object.
+    ## The row stores of the other result are taken over, it must not be used afterwards.
+    def merge(self, billingResult):
+        for billingItemCode, headerRow in billingResult.CSVHeader.items():
+            self.CSVHeader[billingItemCode] = headerRow
+        for billingItemCode, rowStore in billingResult.CSVData.items():
+            if billingItemCode not in self.CSVData:
+                self.CSVData[billingItemCode] = rowStore
+            else:
+                self.CSVData[billingItemCode].extend(rowStore)
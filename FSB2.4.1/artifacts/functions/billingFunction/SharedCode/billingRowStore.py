@@ -0,0 +1,257 @@
+## Column oriented storage for the rows of one billing file (one billing code).
+## Every column keeps its distinct values once and a compact array('i') of value codes per row, so repeated strings
+## (subscription id and name, resource type, location, meter name..) are stored a single time instead of once per row.
+## Cost columns keep the numbers in an array('d') and are formatted with 6 decimals only when the file is written, the
+## same text as formatNumber. A cost value that is not a float (e.g. the "0" of the heartbeat rows) is written as given.
+## The rows can also be written as a Parquet file (pyarrow): cost columns are float64 and the other columns are dictionary
+## encoded strings built directly from the value codes of the columns.
+## Columns of many rows are added as value codes (pd.factorize, or CodedValues from the caller) so only the distinct values
+## of the rows are looked up, not every cell.
+import math
+import numpy as np
+import pandas as pd
+
+from array import array
+
+# pyarrow is only needed for the Parquet output of the ALL file (ALL_FILE_FORMAT)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+## Number of rows rendered at once when the CSV text is produced in chunks
+CSVChunkRows = 10000
+
+## None and NaN values are empty in the CSV files
+def isNullValue(value):
+    return (value is None) or ((type(value) is float) and math.isnan(value))
+
+## Values of a column given as codes (numpy int array) into a list of values, values that are not used by a code are ignored
+class CodedValues(object):
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+## Returns the values as CodedValues, or None when they are not all strings (or None) as pd.factorize would then merge
+## 0, 0.0 and "0" and they are coded one by one instead. The values are kept in order of their first row.
+def getCodedValues(values):
+    objectValues = np.empty(len(values), dtype=object)
+    objectValues[:] = values
+    codes, distinctValues = pd.factorize(objectValues)
+    for value in distinctValues:
+        if type(value) is not str:
+            return None
+    # None and NaN have the code -1, they are coded as a last None value
+    distinctValues = distinctValues.tolist() + [None]
+    codes[codes < 0] = len(distinctValues) - 1
+    return CodedValues(codes, distinctValues)
+
+class BillingRowStore(object):
+    def __init__(self, nbColumns, costColumns = ()):
+        self.nbRows = 0
+        self.columns = []
+        for columnIndex in range(nbColumns):
+            if columnIndex in costColumns:
+                self.columns.append(CostColumn())
+            else:
+                self.columns.append(ValueColumn())
+
+    ## Adds a row and returns its index
+    def addRow(self, dataRow):
+        for column, value in zip(self.columns, dataRow):
+            column.add(value, self.nbRows)
+        self.nbRows += 1
+        return self.nbRows - 1
+
+    def getRow(self, rowIndex):
+        return [column.get(rowIndex) for column in self.columns]
+
+    ## Replaces values of a row already added, given as {columnIndex: value}
+    def setValues(self, rowIndex, columnValues):
+        for columnIndex, value in columnValues.items():
+            self.columns[columnIndex].set(value, rowIndex)
+
+    ## Adds several rows given as one list (or numpy array, or CodedValues) of values per column
+    def addColumns(self, dataColumns):
+        nbRows = len(dataColumns[0])
+        for column, values in zip(self.columns, dataColumns):
+            column.addValues(values, self.nbRows)
+        self.nbRows += nbRows
+
+    ## Appends the rows of another store with the same columns
+    def extend(self, rowStore):
+        for column, otherColumn in zip(self.columns, rowStore.columns):
+            column.extend(otherColumn, self.nbRows)
+        self.nbRows += rowStore.nbRows
+
+    ## Returns the rows (all of them, or rows start to stop) as a DataFrame with the given header. The values are referenced
+    ## from the distinct values (no copy of the strings) and the costs are formatted as in the CSV files.
+    def toDataFrame(self, headerRow, start = 0, stop = None):
+        stop = self.nbRows if stop == None else min(stop, self.nbRows)
+        dataColumns = dict()
+        for columnIndex in range(len(headerRow)):
+            if columnIndex < len(self.columns):
+                dataColumns[columnIndex] = self.columns[columnIndex].toArray(start, stop)
+            else:
+                dataColumns[columnIndex] = np.full(stop - start, None, dtype=object)
+        dataFrame = pd.DataFrame(dataColumns)
+        dataFrame.columns = headerRow
+        return dataFrame
+
+    ## Returns the CSV text in chunks of CSVChunkRows rows, the header line is in the first chunk.
+    ## Joined together the chunks are the same text as toDataFrame(headerRow).to_csv(index=False).
+    def iterCSVChunks(self, headerRow):
+        yield self.toDataFrame(headerRow, 0, 0).to_csv(index=False,encoding = "utf-8")
+        for start in range(0, self.nbRows, CSVChunkRows):
+            yield self.toDataFrame(headerRow, start, start + CSVChunkRows).to_csv(index=False,header=False,encoding = "utf-8")
+
+    ## Returns the rows (all of them, or rows start to stop) as an Arrow table with the given header
+    def toArrowTable(self, headerRow, start = 0, stop = None):
+        stop = self.nbRows if stop == None else min(stop, self.nbRows)
+        arrowColumns = []
+        for columnIndex in range(len(headerRow)):
+            if columnIndex < len(self.columns):
+                arrowColumns.append(self.columns[columnIndex].toArrowArray(start, stop))
+            else:
+                arrowColumns.append(pa.nulls(stop - start, type=pa.string()))
+        return pa.Table.from_arrays(arrowColumns, names=headerRow)
+
+    ## Returns the (start, stop) row ranges of the runs of equal values in a value column, e.g. the subscriptions of a file
+    def getValueRanges(self, columnIndex):
+        if self.nbRows == 0:
+            return []
+        codes = np.frombuffer(self.columns[columnIndex].codes, dtype=np.int32)
+        rangeEdges = [0] + (np.flatnonzero(codes[1:] != codes[:-1]) + 1).tolist() + [self.nbRows]
+        return list(zip(rangeEdges[:-1], rangeEdges[1:]))
+
+    ## Returns the Parquet file of the rows, with one row group per run of equal values of groupColumn (one row group per
+    ## subscription when it is the subscription id column)
+    def toParquet(self, headerRow, groupColumn = 0):
+        outputStream = pa.BufferOutputStream()
+        with pq.ParquetWriter(outputStream, self.toArrowTable(headerRow, 0, 0).schema) as parquetWriter:
+            for start, stop in self.getValueRanges(groupColumn):
+                parquetWriter.write_table(self.toArrowTable(headerRow, start, stop), row_group_size=stop - start)
+        return outputStream.getvalue().to_pybytes()
+
+class ValueColumn(object):
+    def __init__(self):
+        self.codes = array('i')
+        self.values = []
+        self.valueCodes = dict()
+        self.distinctValues = None
+        self.arrowValues = None
+
+    ## Strings are the common case, other values are keyed with their type so that 0, 0.0 and "0" stay different values
+    def getCode(self, value):
+        valueKey = value if type(value) is str else (type(value), value)
+        code = self.valueCodes.get(valueKey)
+        if code == None:
+            code = len(self.values)
+            self.valueCodes[valueKey] = code
+            self.values.append(value)
+        return code
+
+    def add(self, value, rowIndex):
+        self.codes.append(self.getCode(value))
+
+    def get(self, rowIndex):
+        return self.values[self.codes[rowIndex]]
+
+    def set(self, value, rowIndex):
+        self.codes[rowIndex] = self.getCode(value)
+
+    def addValues(self, values, rowIndex):
+        codedValues = values if isinstance(values, CodedValues) else getCodedValues(values)
+        if codedValues == None:
+            getCode = self.getCode
+            self.codes.extend([getCode(value) for value in values])
+            return
+        # only the values used by the rows are coded, in order of their first row like add() does
+        codes = np.asarray(codedValues.codes)
+        codeMap = np.zeros(len(codedValues.values) + 1, dtype=np.int32)
+        for code in pd.unique(codes):
+            codeMap[code] = self.getCode(codedValues.values[code])
+        self.codes.frombytes(codeMap[codes].astype(np.int32).tobytes())
+
+    def extend(self, column, rowIndex):
+        codeMap = np.array([self.getCode(value) for value in column.values] + [0], dtype=np.int32)
+        self.codes.frombytes(codeMap[np.frombuffer(column.codes, dtype=np.int32)].tobytes())
+
+    def toArray(self, start, stop):
+        # the array of distinct values is kept for the next chunks until a new value is added
+        if (self.distinctValues is None) or (len(self.distinctValues) != len(self.values)):
+            self.distinctValues = np.empty(len(self.values), dtype=object)
+            for code, value in enumerate(self.values):
+                self.distinctValues[code] = value
+        return self.distinctValues[np.frombuffer(self.codes, dtype=np.int32)[start:stop]]
+
+    ## Dictionary encoded strings, the dictionary only holds the values used by the rows start to stop. Values that are not
+    ## strings are written as their text, None and NaN as null.
+    def toArrowArray(self, start, stop):
+        if (self.arrowValues is None) or (len(self.arrowValues) != len(self.values)):
+            self.arrowValues = pa.array([None if isNullValue(value) else value if type(value) is str else str(value) for value in self.values], type=pa.string())
+        usedCodes, indices = np.unique(np.frombuffer(self.codes, dtype=np.int32)[start:stop], return_inverse=True)
+        dictionary = self.arrowValues.take(pa.array(usedCodes, type=pa.int32()))
+        return pa.DictionaryArray.from_arrays(pa.array(indices.astype(np.int32), mask=dictionary.is_null().to_numpy(zero_copy_only=False)[indices]), dictionary)
+
+class CostColumn(object):
+    def __init__(self):
+        self.costs = array('d')
+        # row index -> value written as given
+        self.rawValues = dict()
+
+    def add(self, value, rowIndex):
+        if type(value) is float:
+            self.costs.append(value)
+        else:
+            self.costs.append(math.nan)
+            self.rawValues[rowIndex] = value
+
+    def get(self, rowIndex):
+        return self.rawValues.get(rowIndex, self.costs[rowIndex])
+
+    def set(self, value, rowIndex):
+        self.rawValues.pop(rowIndex, None)
+        if type(value) is float:
+            self.costs[rowIndex] = value
+        else:
+            self.costs[rowIndex] = math.nan
+            self.rawValues[rowIndex] = value
+
+    def addValues(self, values, rowIndex):
+        if isinstance(values, np.ndarray) and values.dtype == np.float64:
+            self.costs.frombytes(values.tobytes())
+        else:
+            for valueIndex, value in enumerate(values):
+                self.add(value, rowIndex + valueIndex)
+
+    def extend(self, column, rowIndex):
+        self.costs.extend(column.costs)
+        for valueIndex, value in column.rawValues.items():
+            self.rawValues[rowIndex + valueIndex] = value
+
+    def toArray(self, start, stop):
+        costs = np.frombuffer(self.costs, dtype=np.float64)[start:stop]
+        formattedCosts = np.char.mod("%.6f", costs).astype(object) if len(costs) > 0 else np.empty(0, dtype=object)
+        for rowIndex, value in self.rawValues.items():
+            if start <= rowIndex < stop:
+                formattedCosts[rowIndex - start] = value
+        return formattedCosts
+
+    ## Costs as float64 (not rounded to the 6 decimals of the CSV files), a value written as given is converted to a number,
+    ## or null when it is not one
+    def toArrowArray(self, start, stop):
+        costs = np.frombuffer(self.costs, dtype=np.float64)[start:stop].copy()
+        nullRows = np.zeros(len(costs), dtype=bool)
+        for rowIndex, value in self.rawValues.items():
+            if start <= rowIndex < stop:
+                try:
+                    costs[rowIndex - start] = float(value)
+                except (TypeError, ValueError):
+                    nullRows[rowIndex - start] = True
+        return pa.array(costs, type=pa.float64(), mask=nullRows)
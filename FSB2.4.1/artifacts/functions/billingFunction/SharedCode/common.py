@@ -3,17 +3,29 @@ import logging
 import os
 import json
 import time
+import queue
+import threading
 import requests
 import hashlib
 import hmac
+import gzip
+import zlib
 import base64
+from concurrent.futures import ThreadPoolExecutor
 
 import azure.functions as func
-from azure.storage.blob import BlockBlobService
+from azure.storage.blob import BlockBlobService, AppendBlobService, BlobBlock, ContentSettings
 from azure.storage.file import FileService
 
-from google.cloud import storage
-from google.oauth2 import service_account
+from . import httpClient
+from . import credentialProvider
+from . import runMetrics
+
+# ijson is only needed for the streaming decode of the usage detail pages (USAGE_STREAM_DECODE)
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 identity_endpoint = os.environ["IDENTITY_ENDPOINT"]
 identity_header = os.environ["IDENTITY_HEADER"]
@@ -27,6 +39,13 @@ timeFrame = os.environ["TimeFrame"] if (("TimeFrame" in os.environ) and (os.envi
 GoogleBucketName = None
 GoogleBucketKey = None
 LastErrorMessage = ""
+KeyVaultSecrets = dict()
+KeyVaultSecretsLock = threading.Lock()
+KeyVaultSecretLocks = dict()
+BlobServices = dict()
+AppendBlobServices = dict()
+BlobContainers = set()
+BlobServicesLock = threading.Lock()
 
 def getCompanyTagPrefix():
     return companyTagPrefix
@@ -51,6 +70,24 @@ def getApplicationConfigJSON(varName):
         varValue = ""
     return varValue
 
+## Returns the service category of every provider of the SERVICES_SPLIT_DATA configuration, with lowercase provider names.
+## Built once per run so the category of a usage record is a single dict lookup. When a provider is listed in several
+## categories the last one wins, like the former scan over all the categories.
+def getServiceCategoryIndex(serviceSplitData):
+    serviceCategoryIndex = dict()
+    if len(serviceSplitData) > 0:
+        for serviceEntry in serviceSplitData[0]:
+            for provider in serviceEntry['Providers']:
+                serviceCategoryIndex[provider.lower()] = serviceEntry['ServiceCategoryName']
+    return serviceCategoryIndex
+
+def getApplicationConfigInt(varName, defaultValue):
+    try:
+        varValue = int(os.environ[varName])
+    except Exception as e:
+        varValue = defaultValue
+    return varValue
+
 def getStorageAccountName():
     accountname = ""
     try:
@@ -80,24 +117,74 @@ def getStorageAccountSecret():
 
     return accstrgkey
 
-def writeToBlobStorage(containerName,fileName,output):
+## Returns the BlockBlobService of the storage account of the function app. One client is created per account and shared
+## by all the callers (and threads) of the worker process, so the connection string is parsed once.
+def getBlockBlobService():
+    with BlobServicesLock:
+        if accountdetails not in BlobServices:
+            BlobServices[accountdetails] = BlockBlobService(account_name=getStorageAccountName(), account_key=getStorageAccountSecret())
+        return BlobServices[accountdetails]
+
+## Append blob service of the storage account (streamed run logs), shared like getBlockBlobService
+def getAppendBlobService():
+    with BlobServicesLock:
+        if accountdetails not in AppendBlobServices:
+            AppendBlobServices[accountdetails] = AppendBlobService(account_name=getStorageAccountName(), account_key=getStorageAccountSecret())
+        return AppendBlobServices[accountdetails]
+
+## Creates the container the first time it is used by the worker process, the next uploads skip the create_container call
+def ensureBlobContainer(blobService, containerName):
+    containerKey = (blobService.account_name, containerName)
+    if containerKey in BlobContainers:
+        return
+    blobService.create_container(containerName)
+    with BlobServicesLock:
+        BlobContainers.add(containerKey)
+
+## After a failed upload the container is created again on the next use, in case it was deleted since it was cached
+def forgetBlobContainer(blobService, containerName):
+    with BlobServicesLock:
+        BlobContainers.discard((blobService.account_name, containerName))
+
+## With the app setting BLOB_COMPRESSION = gzip the billing outputs (CSV files, logs and metrics) are written gzip compressed,
+## with their usual name and the Content-Encoding gzip, so HTTP clients decompress them transparently.
+## Returns the content settings of the blob, or None when the outputs are written uncompressed.
+def getBlobContentSettings(contentType):
+    if ("BLOB_COMPRESSION" in os.environ) and (os.environ["BLOB_COMPRESSION"].lower() == "gzip"):
+        return ContentSettings(content_type=contentType, content_encoding="gzip")
+    return None
+
+## Compresses the text (or bytes) chunks as one gzip stream, as they come
+def iterGzipChunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressedData = compressor.compress(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+        if len(compressedData) > 0:
+            yield compressedData
+    yield compressor.flush()
+
+## Returns the content of a blob written by the billing functions, decompressed when it was written in the gzip mode
+def decompressBlobContent(blobContent):
+    if blobContent[:2] == b"\x1f\x8b":
+        return gzip.decompress(blobContent)
+    return blobContent
+
+def writeToBlobStorage(containerName,fileName,output,contentType = "text/plain; charset=utf-8"):
     global LastErrorMessage
     LastErrorMessage = ""
     try:
-        accountname = getStorageAccountName()
-        #logging.info(f"The account name is  {accountname}")
-        accountKey = getStorageAccountSecret()
-        #logging.info(f"The accountKey is  {accountKey}")
         otpstr = str(output)
-        blobService = BlockBlobService(account_name=accountname, account_key=accountKey)
-
-        #if '/' in containerName:
-        #    splcon = containerName.split('/')
-        #    for i in range(0,splcon-1):
-        #        blnCont = blobService.create_container(splcon[i])
-
-        blnCont = blobService.create_container(containerName)
-        blobService.create_blob_from_text(containerName, fileName, otpstr)
+        blobService = getBlockBlobService()
+        try:
+            ensureBlobContainer(blobService, containerName)
+            contentSettings = getBlobContentSettings(contentType)
+            if contentSettings != None:
+                blobService.create_blob_from_bytes(containerName, fileName, gzip.compress(otpstr.encode("utf-8")), content_settings=contentSettings)
+            else:
+                blobService.create_blob_from_text(containerName, fileName, otpstr)
+        except Exception:
+            forgetBlobContainer(blobService, containerName)
+            raise
 
         #####For File service
         #fileser = FileService(account_name=accountname, account_key=accountKey)
@@ -109,20 +196,94 @@ def writeToBlobStorage(containerName,fileName,output):
         logging.error(f'writeToBlobStorage error : {e}')
         LastErrorMessage = f'writeToBlobStorage error : {e}'
 
+## Returns the chunks as they are stored in the blob (bytes) and the content settings of the blob. In the gzip mode
+## (BLOB_COMPRESSION) the chunks are compressed as they come, except with compress = False for content that is already
+## compressed (Parquet files).
+def getStoredChunks(chunks,contentType,compress):
+    if compress:
+        contentSettings = getBlobContentSettings(contentType)
+        if contentSettings != None:
+            chunks = iterGzipChunks(chunks)
+        else:
+            contentSettings = ContentSettings()
+    else:
+        contentSettings = ContentSettings(content_type=contentType)
+    return (chunk.encode("utf-8") if isinstance(chunk, str) else chunk for chunk in chunks), contentSettings
+
+## Uploads a blob given as an iterable of text (or bytes) chunks without holding the whole content in memory.
+## The chunks are gathered in blocks of BLOB_BLOCK_SIZE_MB (default 4) MB, each block is staged with put_block as soon as
+## it is full and the blob is committed with put_block_list. Content that fits in a single block is uploaded in one call.
+## The MD5 of the stored content is computed on the way and set as the Content-MD5 of the blob (used by
+## uploadChunksIfChanged). Returns the number of bytes stored.
+## Raises the error of the storage service, it can be called from several threads at once.
+def uploadChunksToBlobStorage(containerName,fileName,chunks,contentType = "text/csv; charset=utf-8",compress = True):
+    blockSize = getApplicationConfigInt("BLOB_BLOCK_SIZE_MB", 4) * 1024 * 1024
+    blobService = getBlockBlobService()
+    chunks, contentSettings = getStoredChunks(chunks, contentType, compress)
+    contentHash = hashlib.md5()
+    nbBytes = 0
+    try:
+        ensureBlobContainer(blobService, containerName)
+
+        blockList = []
+        blockBuffer = bytearray()
+        for chunk in chunks:
+            contentHash.update(chunk)
+            nbBytes += len(chunk)
+            blockBuffer += chunk
+            while len(blockBuffer) >= blockSize:
+                blockId = f"{len(blockList):08d}"
+                blobService.put_block(containerName, fileName, bytes(blockBuffer[:blockSize]), blockId)
+                blockList.append(BlobBlock(id=blockId))
+                del blockBuffer[:blockSize]
+
+        contentSettings.content_md5 = base64.b64encode(contentHash.digest()).decode("utf-8")
+        if len(blockList) == 0:
+            blobService.create_blob_from_bytes(containerName, fileName, bytes(blockBuffer), content_settings=contentSettings)
+        else:
+            if len(blockBuffer) > 0:
+                blockId = f"{len(blockList):08d}"
+                blobService.put_block(containerName, fileName, bytes(blockBuffer), blockId)
+                blockList.append(BlobBlock(id=blockId))
+            blobService.put_block_list(containerName, fileName, blockList, content_settings=contentSettings)
+    except Exception:
+        forgetBlobContainer(blobService, containerName)
+        raise
+    return nbBytes
+
+## Returns the Content-MD5 of an existing blob, None when the blob does not exist or has no Content-MD5
+def getBlobContentMD5(containerName,fileName):
+    try:
+        return getBlockBlobService().get_blob_properties(containerName, fileName).properties.content_settings.content_md5
+    except Exception as e:
+        return None
+
+## With the app setting UPLOAD_SKIP_UNCHANGED = 1 the blob is only uploaded when its content changed: the MD5 of the content
+## as it would be stored is compared with the Content-MD5 of the existing blob, written by the previous upload. The content
+## is rendered a second time for the upload when it changed, so getChunks is a function returning new chunks.
+## Returns (uploaded, nbBytes): uploaded is False when the existing blob already has this content of nbBytes bytes.
+def uploadChunksIfChanged(containerName,fileName,getChunks,contentType = "text/csv; charset=utf-8",compress = True):
+    if getApplicationConfigInt("UPLOAD_SKIP_UNCHANGED", 0) == 1:
+        existingMD5 = getBlobContentMD5(containerName, fileName)
+        if existingMD5 != None:
+            contentHash = hashlib.md5()
+            nbBytes = 0
+            for chunk in getStoredChunks(getChunks(), contentType, compress)[0]:
+                contentHash.update(chunk)
+                nbBytes += len(chunk)
+            if base64.b64encode(contentHash.digest()).decode("utf-8") == existingMD5:
+                return False, nbBytes
+    return True, uploadChunksToBlobStorage(containerName, fileName, getChunks(), contentType, compress)
+
 def readfromBlob(containerName,fileName):
     global LastErrorMessage
     LastErrorMessage = ""
     blobText=""
     try:
-        accountname = getStorageAccountName()
-        #logging.info(f"The account name is  {accountname}")
-        accountKey = getStorageAccountSecret()
-        #logging.info(f"The accountKey is  {accountKey}")
+        blobService = getBlockBlobService()
 
-        blobService = BlockBlobService(account_name=accountname, account_key=accountKey)
-
-        blobTemp = blobService.get_blob_to_text(containerName, fileName)
-        blobText = blobTemp.content
+        blobTemp = blobService.get_blob_to_bytes(containerName, fileName)
+        blobText = decompressBlobContent(blobTemp.content).decode("utf-8")
         #logging.info(f"The blobText is  {blobText}")
         
     except Exception as e:
@@ -131,27 +292,96 @@ def readfromBlob(containerName,fileName):
 
     return blobText
 
-def getGoogleBucketConfiguration():
-    global GoogleBucketName, GoogleBucketKey
+## Names of all the Key Vault secrets used by the billingupload function, so they can be loaded in one step by getKeyVaultSecrets
+def getBillingSecretNames():
+    secretNames = ["billing-customer-name"]
+    for varName in ["GOOGLE_BUCKET_NAME_SECRET_NAME", "GOOGLE_BUCKET_KEY_SECRET_NAME"]:
+        if (varName in os.environ) and (os.environ[varName] != ""):
+            secretNames.append(os.environ[varName])
+    return secretNames
+
+## Returns the secrets of the cache that are still valid, must be called with KeyVaultSecretsLock held
+def getCachedKeyVaultSecrets(keyvault_name, secretNames):
+    now = time.time()
+    secrets = dict()
+    for secretName in secretNames:
+        cacheKey = f"{keyvault_name}/{secretName}"
+        if (cacheKey in KeyVaultSecrets) and (KeyVaultSecrets[cacheKey]['expiresOn'] > now):
+            secrets[secretName] = KeyVaultSecrets[cacheKey]['value']
+    return secrets
+
+## Returns a dict with the value of every secret (None when it could not be read). The secrets that are not in the cache are
+## fetched concurrently with one Vault token. The values are cached in the worker process for KEYVAULT_SECRET_CACHE_SECONDS,
+## secrets that could not be read are only cached for a few minutes so a Vault hiccup does not last until the next TTL.
+## KeyVaultSecretsLock is only held to read and update the cache. While a secret is fetched its own lock is held, so a
+## caller needing the same secret waits for the fetch but callers of other secrets do not.
+def getKeyVaultSecrets(secretNames):
+    keyvault_name = os.environ["AZ_KEYVAULT_NAME"]
+    cacheSeconds = getApplicationConfigInt("KEYVAULT_SECRET_CACHE_SECONDS", 3600)
+    with KeyVaultSecretsLock:
+        secrets = getCachedKeyVaultSecrets(keyvault_name, secretNames)
+        missingSecrets = sorted(set(secretName for secretName in secretNames if secretName not in secrets))
+        if len(missingSecrets) == 0:
+            return secrets
+        secretLocks = []
+        for secretName in missingSecrets:
+            secretLocks.append(KeyVaultSecretLocks.setdefault(f"{keyvault_name}/{secretName}", threading.Lock()))
+
+    # the locks are always taken in the order of the secret names so two callers cannot wait on each other
+    for secretLock in secretLocks:
+        secretLock.acquire()
     try:
-        keyvault_name = os.environ["AZ_KEYVAULT_NAME"]
-        secret_name_bucket_name = os.environ["GOOGLE_BUCKET_NAME_SECRET_NAME"]
-        secret_name_bucket_key = os.environ["GOOGLE_BUCKET_KEY_SECRET_NAME"]
+        # another caller may have fetched some of the secrets while this one was waiting
+        with KeyVaultSecretsLock:
+            secrets.update(getCachedKeyVaultSecrets(keyvault_name, missingSecrets))
+        missingSecrets = [secretName for secretName in missingSecrets if secretName not in secrets]
+        if len(missingSecrets) == 0:
+            return secrets
 
         if ("_LOCAL_DEV_VAULT_TOKEN" in os.environ):
             api_token_kv = os.environ["_LOCAL_DEV_VAULT_TOKEN"]
         else:
             api_token_kv = getTokenFromManage('https://vault.azure.net')
+        maxRetries = getApplicationConfigInt("KEYVAULT_MAX_RETRIES", 10)
+
+        def fetchSecret(secretName):
+            url = f"https://{keyvault_name}.vault.azure.net/secrets/{secretName}/?api-version=7.2"
+            try:
+                resp = callREST(url,api_token_kv,False,maxRetries)
+                return resp['value'] if 'value' in resp else None
+            except Exception as e:
+                logging.error(f"The secret [{secretName}] could not be read from keyvault [{keyvault_name}] : {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=len(missingSecrets)) as executor:
+            secretValues = list(executor.map(runMetrics.bindRun(fetchSecret), missingSecrets))
+
+        with KeyVaultSecretsLock:
+            now = time.time()
+            for secretName, secretValue in zip(missingSecrets, secretValues):
+                secrets[secretName] = secretValue
+                KeyVaultSecrets[f"{keyvault_name}/{secretName}"] = {
+                    'value': secretValue,
+                    'expiresOn': now + (cacheSeconds if secretValue != None else min(cacheSeconds, 300))
+                }
+        logging.info(f"Loaded {len(missingSecrets)} secret(s) from keyvault [{keyvault_name}]")
+    finally:
+        for secretLock in secretLocks:
+            secretLock.release()
+    return secrets
+
+def getGoogleBucketConfiguration():
+    global GoogleBucketName, GoogleBucketKey
+    try:
+        keyvault_name = os.environ["AZ_KEYVAULT_NAME"]
+        secret_name_bucket_name = os.environ["GOOGLE_BUCKET_NAME_SECRET_NAME"]
+        secret_name_bucket_key = os.environ["GOOGLE_BUCKET_KEY_SECRET_NAME"]
 
-        url = f"https://{keyvault_name}.vault.azure.net/secrets/{secret_name_bucket_name}/?api-version=7.2"
-        resp = callREST(url,api_token_kv,True)
-        logging.info(resp)
-        if 'value' in resp:
-            GoogleBucketName = resp['value']
-        url = f"https://{keyvault_name}.vault.azure.net/secrets/{secret_name_bucket_key}/?api-version=7.2"
-        resp = callREST(url,api_token_kv)
-        if 'value' in resp:
-            GoogleBucketKey = resp['value']
+        secrets = getKeyVaultSecrets([secret_name_bucket_name, secret_name_bucket_key])
+        if secrets[secret_name_bucket_name] != None:
+            GoogleBucketName = secrets[secret_name_bucket_name]
+        if secrets[secret_name_bucket_key] != None:
+            GoogleBucketKey = secrets[secret_name_bucket_key]
         if GoogleBucketName and GoogleBucketKey:
             logging.info(f"Sucessfully loaded Google bucket config from keyvault [{keyvault_name}]")
             return True
@@ -167,121 +397,184 @@ def getBillingCustomerNameConfiguration():
         secret_name = "billing-customer-name"
         BillingCustomerName = None
 
-        if ("_LOCAL_DEV_VAULT_TOKEN" in os.environ):
-            api_token_kv = os.environ["_LOCAL_DEV_VAULT_TOKEN"]
-        else:
-            api_token_kv = getTokenFromManage('https://vault.azure.net')
-
-        url = f"https://{keyvault_name}.vault.azure.net/secrets/{secret_name}/?api-version=7.2"
-        resp = callREST(url,api_token_kv,True)
-        logging.info(resp)
-        if 'value' in resp:
-            BillingCustomerName = f"{resp['value']}"
+        secrets = getKeyVaultSecrets([secret_name])
+        if secrets[secret_name] != None:
+            BillingCustomerName = f"{secrets[secret_name]}"
             logging.info(f"Sucessfully loaded Billing Customer Name [{BillingCustomerName}] from keyvault [{keyvault_name}]")
-            # BillingCustomerName = resp['value']
             return BillingCustomerName
     except Exception as e:
         return False        
  
-def uploadToGoogle(fileName,fileContent):
-    successStatus = True
-    if GoogleBucketName and GoogleBucketKey:
-        service_account_info = json.loads(GoogleBucketKey)
-        google_credentials = service_account.Credentials.from_service_account_info(service_account_info)
-        ##scoped_credentials = google_credentials.with_scopes()
-        try:
-            client = storage.Client(project= None,credentials=google_credentials)
-            bucket = client.get_bucket(GoogleBucketName)
-            object_name_in_gcs_bucket = bucket.blob(f"{fileName}")
-            result = object_name_in_gcs_bucket.upload_from_string(fileContent)
-            all_blobs = list(client.list_blobs(bucket))
-            #logging.info(f'Google bucket [{GoogleBucketName}] blob content : {all_blobs}')
-            statusStr = f"Successfully uploaded file [{fileName}] to Google bucket [{GoogleBucketName}]"
-        except Exception as e:
-            statusStr = f"Error while trying to upload file [{fileName}] to Google bucket [{GoogleBucketName}] Error : {str(e)}"
-            successStatus = False
-    else:
-        statusStr = f"Unable to access Google Bucket configuration !"
-        successStatus = False
-    StatusObj = {"success": successStatus, "message" : statusStr }
-    return StatusObj
-
+## The token is requested once per resource and cached until shortly before it expires (see credentialProvider)
 def get_bearer_token(resource_uri):
-    #logging.info(resource_uri)
-    #logging.info(identity_endpoint)
-    #logging.info(identity_header)
-    #logging.info(my_app_setting_value)
-    #url = "http://169.254.169.254/metadata/identity/oauth2/token?api-version=2018-02-01"
-    token_auth_uri = f"{identity_endpoint}?resource={resource_uri}&api-version=2017-09-01"
-    #head_msi = {'X-IDENTITY-HEADER':identity_header}
-    #head_msi={'X-IDENTITY-HEADER': ide}
-    headers = {'Content-Type': 'application/json', 'secret': identity_header,'Access-Control-Allow-Credentials': 'true','Access-Control-Allow-Origin': 'http://localhost:8081','Access-Control-Allow-Methods': 'GET','Access-Control-Request-Headers': 'X-Custom-Header'}
-    #head_msi = {'Metadata':'true'}
-
-    #logging.info(token_auth_uri)
-    #logging.info(headers)
-    
     try:
-        resp = requests.get(token_auth_uri, headers=headers)
-        #logging.info(resp.text)
-        resp.raise_for_status()
-        #logging.info(resp.text)
-    except requests.exceptions.HTTPError as err:
+        access_token = credentialProvider.getToken(resource_uri)
+    except requests.exceptions.RequestException as err:
         logging.error(err)
         return err
 
-
-    #logging.info(resp)
-    access_token = resp.json()['access_token']
     return access_token
 
 def getTokenFromManage(resource):
     toke_get = get_bearer_token(resource)
     return toke_get
 
-def callREST(url, token, debuglogging = True):
+def callREST(url, token, debuglogging = True, max_retries = 10, body = None):
+    resp, respJson = getRESTResponse(url, token, debuglogging, max_retries, body = body)
+    return respJson
+
+## Makes the REST call with retries and returns the response and its parsed body. The body is parsed only once.
+## The call is a GET, or a POST of the body (as JSON) when a body is given.
+## With stream = True the body of a successful answer is not read, the caller reads it from resp.raw.
+def getRESTResponse(url, token, debuglogging = True, max_retries = 10, stream = False, body = None):
     if debuglogging:
         logging.info(f'Calling REST API with Uri [{url}]')
     headers = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + token}
-    retry_sec = 5
-    max_retries = 10
+    rateLimiter = httpClient.getRateLimiter(url)
     nb_retries = 0
-    while (nb_retries < max_retries):
+    callStart = time.monotonic()
+    while True:
+        if rateLimiter != None:
+            rateLimiter.acquire()
+        respJson = None
         try:
             resp = None
-            resp = requests.get(url, headers=headers,timeout=100)
-            if debuglogging:
-                logging.info(f'The response is [{resp.json()}]')
+            if body == None:
+                resp = httpClient.getSession().get(url, headers=headers, timeout=httpClient.getRequestTimeout(), stream=stream)
+            else:
+                resp = httpClient.getSession().post(url, headers=headers, json=body, timeout=httpClient.getRequestTimeout(), stream=stream)
+            if not (stream and resp.ok):
+                try:
+                    respJson = resp.json()
+                except ValueError:
+                    # a successful answer must be JSON, an error answer can be anything
+                    if resp.ok:
+                        raise
+                if debuglogging:
+                    logging.info(f'The response is [{respJson}]')
         except Exception as e:
             resp = None
 
-        if (resp and resp.json() and 'error' in resp.json()):
+        httpClient.updateRateLimiter(rateLimiter, resp)
+
+        if (resp and respJson and 'error' in respJson):
+            resp.close()
             resp = None
 
         if ((resp != None) and ((resp.status_code < 200) or (resp.status_code > 299 and resp.status_code != 401))):
             http_error = resp.status_code
         else:
             http_error = None
-        
+
         if (resp == None or http_error != None):
             nb_retries += 1
-            scode = "0" if resp == None else http_error
+            scode = 0 if resp == None else http_error
+            if (not httpClient.isRetryableStatus(scode)) or (nb_retries >= max_retries):
+                break
+            # the delay asked by the server has priority over our own backoff
+            retry_sec = httpClient.getRetryAfter(resp)
+            if retry_sec != None:
+                if rateLimiter != None:
+                    rateLimiter.pause(retry_sec)
+            else:
+                retry_sec = httpClient.getRetryDelay(nb_retries)
             if debuglogging:
-                logging.info(f'Request failed with HTTP code [{scode}], retrying ({nb_retries}/{max_retries}) after {retry_sec} sec')
-            if scode != 404:
-                time.sleep(retry_sec)
-                retry_sec += 5
+                logging.info(f'Request failed with HTTP code [{scode}], retrying ({nb_retries}/{max_retries}) after {retry_sec:.1f} sec')
+            time.sleep(retry_sec)
         else:
-            caalRestresp = resp.json()
             break
 
     if (resp == None or http_error != None):
         scode = "0" if resp == None else http_error
-        sts = '{"statuscode":'+ str(scode)+'}'
-        caalRestresp = json.loads(sts)
-        err_msg = f"Request failed with HTTP code [{scode}] after {max_retries} retries."
+        runMetrics.recordRESTCall(url, int(scode), time.monotonic() - callStart, nb_retries, 0)
+        err_msg = f"Request failed with HTTP code [{scode}] after {nb_retries} tries."
         logging.info(err_msg)
         raise Exception(err_msg)
-       
-    return caalRestresp
 
+    # a streamed body is not read yet, its size is only known from the headers
+    respBytes = int(resp.headers.get('Content-Length', 0)) if stream else len(resp.content)
+    runMetrics.recordRESTCall(url, resp.status_code, time.monotonic() - callStart, nb_retries, respBytes)
+    return resp, respJson
+
+## Generator returning the pages of a paged REST answer (following the 'nextLink' of every page).
+## With a prefetch depth > 0 a background thread already fetches the next page(s) while the caller is still processing
+## the current one, so network time and processing time overlap. With a prefetch depth of 0 the pages are fetched inline.
+def iterateRESTPages(url, token, debuglogging = True, prefetchDepth = None):
+    if prefetchDepth == None:
+        prefetchDepth = getApplicationConfigInt("USAGE_PAGE_PREFETCH_DEPTH", 1)
+
+    if prefetchDepth <= 0:
+        while (url != None):
+            page = callREST(url, token, debuglogging)
+            url = page['nextLink'] if 'nextLink' in page else None
+            yield page
+        return
+
+    # The page being processed by the caller holds one slot, the others can be used to fetch pages in advance
+    pageSlots = threading.Semaphore(prefetchDepth + 1)
+    pageQueue = queue.Queue()
+    stopFetching = threading.Event()
+
+    def fetchPages(nextUrl):
+        try:
+            while (nextUrl != None):
+                pageSlots.acquire()
+                if stopFetching.is_set():
+                    return
+                page = callREST(nextUrl, token, debuglogging)
+                nextUrl = page['nextLink'] if 'nextLink' in page else None
+                pageQueue.put((page, None))
+            pageQueue.put((None, None))
+        except Exception as e:
+            pageQueue.put((None, e))
+
+    fetchThread = threading.Thread(target=runMetrics.bindRun(fetchPages), args=(url,), daemon=True)
+    fetchThread.start()
+    try:
+        while True:
+            page, error = pageQueue.get()
+            if error != None:
+                raise error
+            if page == None:
+                break
+            yield page
+            pageSlots.release()
+    finally:
+        # Also reached when the caller stops iterating early, unblock the fetch thread so it can end
+        stopFetching.set()
+        pageSlots.release()
+
+## Generator returning the items of the 'value' list of a paged REST answer, one at a time (following the 'nextLink' of every page).
+## With the app setting USAGE_STREAM_DECODE = 1 (and the ijson package installed) every page is decoded while it is downloaded
+## and only the current item is kept in memory, instead of the complete page. Otherwise the pages are read by iterateRESTPages.
+def iterateRESTValues(url, token, debuglogging = True):
+    if (getApplicationConfigInt("USAGE_STREAM_DECODE", 0) != 1) or (ijson == None):
+        for page in iterateRESTPages(url, token, debuglogging):
+            if 'value' in page:
+                for item in page['value']:
+                    yield item
+        return
+
+    while (url != None):
+        resp, respJson = getRESTResponse(url, token, debuglogging, stream=True)
+        nextUrl = None
+        try:
+            resp.raw.decode_content = True
+            itemBuilder = None
+            for prefix, event, value in ijson.parse(resp.raw, use_float=True):
+                if itemBuilder != None:
+                    itemBuilder.event(event, value)
+                    if (prefix == 'value.item') and (event == 'end_map'):
+                        yield itemBuilder.value
+                        itemBuilder = None
+                elif (prefix == 'value.item') and (event == 'start_map'):
+                    itemBuilder = ijson.ObjectBuilder()
+                    itemBuilder.event(event, value)
+                elif (prefix == 'nextLink') and (event == 'string'):
+                    nextUrl = value
+                elif (prefix == 'error') and (event == 'start_map'):
+                    # the items already returned can't be taken back, so this can't be retried
+                    raise Exception(f"Request [{url}] returned an error while reading the answer.")
+        finally:
+            resp.close()
+        url = nextUrl
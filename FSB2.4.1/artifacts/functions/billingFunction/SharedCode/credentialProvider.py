@@ -0,0 +1,83 @@
+## Managed identity tokens shared by all the callers (and threads) of the worker process.
+## The tokens are cached per resource URI and only requested again from the IDENTITY_ENDPOINT shortly before they expire
+## (TOKEN_REFRESH_MARGIN_SECONDS before expires_on). When several threads need a new token at the same time it is requested once.
+import os
+import time
+import datetime
+import threading
+
+from . import httpClient
+from . import runMetrics
+
+TokenCache = dict()
+TokenLocks = dict()
+TokenLocksLock = threading.Lock()
+
+def getRefreshMargin():
+    try:
+        refreshMargin = int(os.environ["TOKEN_REFRESH_MARGIN_SECONDS"])
+    except Exception as e:
+        refreshMargin = 300
+    return refreshMargin
+
+## Returns the expiry of the token as epoch seconds. Depending on the api-version expires_on is a number of seconds
+## or a date like "09/14/2017 00:00:00 PM +00:00". Returns 0 (do not cache) when the expiry is unknown.
+def getTokenExpiry(tokenResponse):
+    expiresOn = tokenResponse['expires_on'] if 'expires_on' in tokenResponse else None
+    if expiresOn != None:
+        try:
+            return float(expiresOn)
+        except ValueError:
+            pass
+        try:
+            return datetime.datetime.strptime(expiresOn, "%m/%d/%Y %I:%M:%S %p %z").timestamp()
+        except ValueError:
+            pass
+        try:
+            # some answers combine a 24 hour time with AM/PM, e.g. "00:00:00 PM"
+            return datetime.datetime.strptime(expiresOn.replace(" AM", "").replace(" PM", ""), "%m/%d/%Y %H:%M:%S %z").timestamp()
+        except ValueError:
+            pass
+    if 'expires_in' in tokenResponse:
+        try:
+            return time.time() + float(tokenResponse['expires_in'])
+        except ValueError:
+            pass
+    return 0
+
+def isTokenValid(cachedToken):
+    return (cachedToken != None) and (cachedToken['expiresOn'] - getRefreshMargin() > time.time())
+
+def requestToken(resourceUri):
+    identityEndpoint = os.environ["IDENTITY_ENDPOINT"]
+    identityHeader = os.environ["IDENTITY_HEADER"]
+    tokenAuthUri = f"{identityEndpoint}?resource={resourceUri}&api-version=2017-09-01"
+    headers = {'Content-Type': 'application/json', 'secret': identityHeader,'Access-Control-Allow-Credentials': 'true','Access-Control-Allow-Origin': 'http://localhost:8081','Access-Control-Allow-Methods': 'GET','Access-Control-Request-Headers': 'X-Custom-Header'}
+    requestStart = time.monotonic()
+    # callers waiting on the lock of the resource wait at most this timeout for a hung identity endpoint
+    resp = httpClient.getSession().get(tokenAuthUri, headers=headers, timeout=httpClient.getRequestTimeout())
+    runMetrics.recordRESTCall(tokenAuthUri, resp.status_code, time.monotonic() - requestStart, 0, len(resp.content))
+    resp.raise_for_status()
+    return resp.json()
+
+## Returns an access token for the resource URI, from the cache when it is still valid.
+## Raises requests.exceptions.HTTPError when the identity endpoint refuses the request, and requests.exceptions.Timeout
+## when it does not answer within HTTP_TIMEOUT_SECONDS.
+def getToken(resourceUri):
+    cachedToken = TokenCache.get(resourceUri)
+    if isTokenValid(cachedToken):
+        return cachedToken['accessToken']
+
+    with TokenLocksLock:
+        if resourceUri not in TokenLocks:
+            TokenLocks[resourceUri] = threading.Lock()
+        resourceLock = TokenLocks[resourceUri]
+
+    with resourceLock:
+        # another thread may have refreshed the token while this one was waiting
+        cachedToken = TokenCache.get(resourceUri)
+        if isTokenValid(cachedToken):
+            return cachedToken['accessToken']
+        tokenResponse = requestToken(resourceUri)
+        TokenCache[resourceUri] = {'accessToken': tokenResponse['access_token'], 'expiresOn': getTokenExpiry(tokenResponse)}
+        return tokenResponse['access_token']
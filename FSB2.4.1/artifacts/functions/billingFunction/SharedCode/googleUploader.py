@@ -0,0 +1,69 @@
+## Uploads of the billing files to the Google bucket of the customer.
+## One uploader is created per run: the service account credentials and the storage client are built once and shared by all
+## the uploads (and upload threads) of the run, and the bucket is only referenced, it is never read or listed.
+## Files larger than GOOGLE_UPLOAD_CHUNK_MB (default 8) MB are sent with a resumable upload in chunks of that size, so a
+## network error only sends the current chunk again instead of the whole file.
+## With the app setting UPLOAD_SKIP_UNCHANGED = 1 a file is not uploaded again when the object in the bucket already has the
+## same MD5, e.g. when the billing of the same period is run again.
+import os
+import json
+import base64
+import hashlib
+
+from google.cloud import storage
+from google.oauth2 import service_account
+from . import common
+
+## Resumable upload chunks must be a multiple of 256 KB
+ChunkSizeUnit = 256 * 1024
+
+def getChunkSize():
+    try:
+        chunkSize = int(float(os.environ["GOOGLE_UPLOAD_CHUNK_MB"]) * 1024 * 1024)
+    except Exception as e:
+        chunkSize = 8 * 1024 * 1024
+    return max(ChunkSizeUnit, chunkSize - chunkSize % ChunkSizeUnit)
+
+## Same setting as the blob storage uploads (common.uploadChunksIfChanged)
+def getSkipUnchanged():
+    return common.getApplicationConfigInt("UPLOAD_SKIP_UNCHANGED", 0) == 1
+
+class GoogleUploader(object):
+    def __init__(self, bucketName, bucketKey):
+        self.bucketName = bucketName
+        self.chunkSize = getChunkSize()
+        self.skipUnchanged = getSkipUnchanged()
+        credentials = service_account.Credentials.from_service_account_info(json.loads(bucketKey))
+        self.client = storage.Client(project=None, credentials=credentials)
+        # a reference to the bucket, get_bucket would read its metadata with one more call
+        self.bucket = self.client.bucket(bucketName)
+
+    ## Returns the MD5 (base64) of the object in the bucket, None when it does not exist or cannot be read
+    def getObjectMD5(self, fileName):
+        try:
+            existingBlob = self.bucket.get_blob(fileName)
+            return existingBlob.md5_hash if existingBlob != None else None
+        except Exception as e:
+            return None
+
+    ## Uploads the content (text or bytes) and returns {"success", "skipped", "bytes", "message"}, skipped is True when the
+    ## object already had this content (UPLOAD_SKIP_UNCHANGED and not forceUpload)
+    def upload(self, fileName, fileContent, contentType = "text/csv", forceUpload = False):
+        try:
+            fileData = fileContent.encode("utf-8") if isinstance(fileContent, str) else fileContent
+            if self.skipUnchanged and not forceUpload and (self.getObjectMD5(fileName) == base64.b64encode(hashlib.md5(fileData).digest()).decode("utf-8")):
+                return {"success": True, "skipped": True, "bytes": len(fileData), "message": f"File [{fileName}] is unchanged in Google bucket [{self.bucketName}], not uploaded again"}
+            blob = self.bucket.blob(fileName, chunk_size=self.chunkSize if len(fileData) > self.chunkSize else None)
+            blob.upload_from_string(fileData, content_type=contentType)
+            return {"success": True, "skipped": False, "bytes": len(fileData), "message": f"Successfully uploaded file [{fileName}] to Google bucket [{self.bucketName}]"}
+        except Exception as e:
+            return {"success": False, "skipped": False, "bytes": 0, "message": f"Error while trying to upload file [{fileName}] to Google bucket [{self.bucketName}] Error : {str(e)}"}
+
+    ## Uploads a DATA file and then its CTRL file, the CTRL file is only sent once the DATA file is complete (or unchanged).
+    ## A CTRL file is always sent again after a new DATA file.
+    ## Returns the status of every upload done.
+    def uploadWithControlFile(self, fileName, fileContent, controlFileName, controlContent):
+        uploadStatuses = [self.upload(fileName, fileContent, "text/csv")]
+        if uploadStatuses[0]['success']:
+            uploadStatuses.append(self.upload(controlFileName, controlContent, "application/xml", not uploadStatuses[0]['skipped']))
+        return uploadStatuses
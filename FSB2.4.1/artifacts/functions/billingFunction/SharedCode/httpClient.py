@@ -0,0 +1,174 @@
+## Shared HTTP layer for all the REST calls made by the billing functions (ARM, Key Vault, Table storage and managed identity).
+## One requests.Session is shared by all the callers (and threads) of the worker process. It keeps a pool of keep-alive
+## connections per host, so consecutive calls to the same host reuse the TCP+TLS connection instead of opening a new one.
+import os
+import time
+import random
+import threading
+import requests
+
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+HTTPSession = None
+HTTPSessionLock = threading.Lock()
+RateLimiters = dict()
+RateLimitersLock = threading.Lock()
+ARMHosts = ["management.azure.com"]
+
+def getPoolConfigValue(varName, defaultValue):
+    try:
+        varValue = int(os.environ[varName])
+    except Exception as e:
+        varValue = defaultValue
+    return varValue
+
+def getConfigFloat(varName, defaultValue):
+    try:
+        varValue = float(os.environ[varName])
+    except Exception as e:
+        varValue = defaultValue
+    return varValue
+
+## Timeout in seconds of every REST call (connection and read), app setting HTTP_TIMEOUT_SECONDS
+def getRequestTimeout():
+    return getConfigFloat("HTTP_TIMEOUT_SECONDS", 100)
+
+## Returns the shared session, it is created on first use with the pool sizes from the app settings:
+##  HTTP_POOL_CONNECTIONS : number of hosts for which a connection pool is kept
+##  HTTP_POOL_MAXSIZE     : number of connections kept open per host (should be at least the number of parallel workers)
+def getSession():
+    global HTTPSession
+    if HTTPSession == None:
+        with HTTPSessionLock:
+            if HTTPSession == None:
+                adapter = HTTPAdapter(
+                    pool_connections=getPoolConfigValue("HTTP_POOL_CONNECTIONS", 10),
+                    pool_maxsize=getPoolConfigValue("HTTP_POOL_MAXSIZE", 20))
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                HTTPSession = session
+    return HTTPSession
+
+## Returns the number of connections opened and reused per host since the session was created, e.g.
+## {"management.azure.com:443": {"requests": 120, "opened": 2, "reused": 118}}
+def getPoolStatistics():
+    poolStatistics = dict()
+    if HTTPSession == None:
+        return poolStatistics
+    adapters = []
+    for adapter in HTTPSession.adapters.values():
+        if adapter not in adapters:
+            adapters.append(adapter)
+    for adapter in adapters:
+        pools = adapter.poolmanager.pools
+        for poolKey in pools.keys():
+            pool = pools[poolKey]
+            hostName = f"{poolKey.key_host}:{poolKey.key_port}"
+            if hostName not in poolStatistics:
+                poolStatistics[hostName] = {"requests": 0, "opened": 0, "reused": 0}
+            poolStatistics[hostName]["requests"] += pool.num_requests
+            poolStatistics[hostName]["opened"] += pool.num_connections
+            poolStatistics[hostName]["reused"] += max(pool.num_requests - pool.num_connections, 0)
+    return poolStatistics
+
+## Returns the pool statistics as readable lines for the run log
+def getPoolStatisticsLogLines():
+    logLines = []
+    for hostName, hostStatistics in getPoolStatistics().items():
+        logLines.append(f"HTTP connections for [{hostName}] : {hostStatistics['requests']} requests, {hostStatistics['opened']} connections opened, {hostStatistics['reused']} reused")
+    return logLines
+
+## Token bucket shared by all the threads calling the same host. Every call takes a token, the tokens are refilled at a fixed
+## rate up to the bucket capacity. This keeps parallel callers under the read quota of the host instead of all of them
+## getting throttled (HTTP 429) at the same time.
+class TokenBucket(object):
+    def __init__(self, ratePerSecond, capacity):
+        self.ratePerSecond = ratePerSecond
+        self.capacity = capacity
+        self.tokens = capacity
+        self.lastRefill = time.monotonic()
+        self.pausedUntil = 0
+        self.lock = threading.Lock()
+
+    ## Waits until a token is available and takes it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.lastRefill) * self.ratePerSecond)
+                self.lastRefill = now
+                if (now >= self.pausedUntil) and (self.tokens >= 1):
+                    self.tokens -= 1
+                    return
+                waitTime = max(self.pausedUntil - now, (1 - self.tokens) / self.ratePerSecond)
+            time.sleep(waitTime)
+
+    ## The server asked to wait (Retry-After), no caller gets a token before that time
+    def pause(self, seconds):
+        with self.lock:
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + seconds)
+            self.tokens = 0
+
+    ## The server reported how many reads are left in its quota, never hand out more tokens than that
+    def limitTokens(self, remaining):
+        with self.lock:
+            self.tokens = min(self.tokens, remaining)
+
+## Returns the shared rate limiter for the host of the url, or None when calls to that host are not limited.
+## Only ARM is limited, with the rate from the app settings ARM_READS_PER_SECOND and ARM_READS_BURST (0 disables the limiter).
+def getRateLimiter(url):
+    hostName = urlparse(url).hostname
+    if hostName not in ARMHosts:
+        return None
+    with RateLimitersLock:
+        if hostName not in RateLimiters:
+            ratePerSecond = getConfigFloat("ARM_READS_PER_SECOND", 20)
+            if ratePerSecond > 0:
+                RateLimiters[hostName] = TokenBucket(ratePerSecond, max(getConfigFloat("ARM_READS_BURST", 100), 1))
+            else:
+                RateLimiters[hostName] = None
+        return RateLimiters[hostName]
+
+## Passes the remaining read quota reported by ARM (x-ms-ratelimit-remaining-* headers) to the rate limiter
+def updateRateLimiter(rateLimiter, resp):
+    if rateLimiter == None or resp == None:
+        return
+    remainingReads = []
+    for headerName in ["x-ms-ratelimit-remaining-subscription-reads", "x-ms-ratelimit-remaining-tenant-reads"]:
+        if headerName in resp.headers:
+            try:
+                remainingReads.append(int(resp.headers[headerName]))
+            except ValueError:
+                pass
+    if len(remainingReads) > 0:
+        rateLimiter.limitTokens(min(remainingReads))
+
+## Returns the number of seconds from the Retry-After header (delay in seconds or HTTP date), or None when there is none
+def getRetryAfter(resp):
+    if resp == None or "Retry-After" not in resp.headers:
+        return None
+    retryAfter = resp.headers["Retry-After"]
+    try:
+        return max(float(retryAfter), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retryAfter).timestamp() - time.time(), 0)
+    except Exception:
+        return None
+
+## Errors that can succeed when the call is made again: no answer at all (0), timeouts, throttling and server errors.
+## Other client errors (400, 403, 404, ..) will fail again so they are not retried.
+def isRetryableStatus(statusCode):
+    return (statusCode == 0) or (statusCode == 408) or (statusCode == 429) or (statusCode >= 500)
+
+## Delay before the next try: exponential backoff (REST_RETRY_BASE_SECONDS doubled after every try, up to
+## REST_RETRY_MAX_SECONDS) with a random part so parallel callers do not retry at the same moment
+def getRetryDelay(nbRetries):
+    baseDelay = getConfigFloat("REST_RETRY_BASE_SECONDS", 2)
+    maxDelay = getConfigFloat("REST_RETRY_MAX_SECONDS", 60)
+    retryDelay = min(maxDelay, baseDelay * (2 ** (nbRetries - 1)))
+    return (retryDelay / 2) + random.uniform(0, retryDelay / 2)
@@ -0,0 +1,143 @@
+## Run log of the billing functions (info and error lines), replacing the string concatenation of the whole log.
+## The lines are kept in a bounded tail for the errorOutput/infoOutput blob bindings (LOG_TAIL_BYTES of UTF-8 text, the
+## oldest lines are dropped first) and, when the app setting LOG_STREAM_CONTAINER is set, the complete log is also streamed
+## to an append blob in batches of LOG_STREAM_BATCH_BYTES while the function runs.
+## Lines longer than LOG_MAX_LINE_LENGTH characters are truncated, and large payloads (e.g. whole usage pages) are only
+## written for one call out of LOG_PAYLOAD_SAMPLE_EVERY, as a bounded text of their first items.
+## In the gzip mode of the outputs (BLOB_COMPRESSION) every batch is appended as a gzip member, the members of the blob
+## together are one valid gzip stream that is decompressed transparently (Content-Encoding gzip).
+import os
+import gzip
+import reprlib
+import logging
+import datetime
+import threading
+
+from collections import deque
+from . import common
+
+## Largest block accepted by append_block
+AppendBlockMaxBytes = 4 * 1024 * 1024
+
+class RunLogSink(object):
+    def __init__(self, containerName = None, blobName = None):
+        self.tailBytes = common.getApplicationConfigInt("LOG_TAIL_BYTES", 10 * 1024 * 1024)
+        self.maxLineLength = common.getApplicationConfigInt("LOG_MAX_LINE_LENGTH", 10000)
+        self.sampleEvery = max(common.getApplicationConfigInt("LOG_PAYLOAD_SAMPLE_EVERY", 1), 1)
+        self.batchBytes = min(common.getApplicationConfigInt("LOG_STREAM_BATCH_BYTES", 1024 * 1024), AppendBlockMaxBytes)
+        self.containerName = containerName
+        self.blobName = blobName
+        self.blobService = None
+        self.contentSettings = common.getBlobContentSettings("text/plain; charset=utf-8")
+        self.tail = deque()
+        self.tailSize = 0
+        self.droppedLines = 0
+        self.batch = []
+        self.batchSize = 0
+        self.pendingBatches = deque()
+        self.payloadCount = 0
+        self.payloadRepr = reprlib.Repr()
+        self.payloadRepr.maxlevel = 6
+        self.payloadRepr.maxdict = 50
+        self.payloadRepr.maxlist = 3
+        self.payloadRepr.maxstring = 300
+        self.payloadRepr.maxother = 300
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+
+    def truncateLine(self, txtLine):
+        if (self.maxLineLength > 0) and (len(txtLine) > self.maxLineLength):
+            return txtLine[:self.maxLineLength] + f"... [truncated {len(txtLine) - self.maxLineLength} characters]"
+        return txtLine
+
+    def write(self, txtLine):
+        txtLine = self.truncateLine(txtLine) + "\n"
+        # the sizes are the bytes written to the blobs, not the characters
+        lineBytes = len(txtLine.encode("utf-8"))
+        batchFull = False
+        with self.lock:
+            self.tail.append((txtLine, lineBytes))
+            self.tailSize += lineBytes
+            while (self.tailSize > self.tailBytes) and (len(self.tail) > 1):
+                self.tailSize -= self.tail.popleft()[1]
+                self.droppedLines += 1
+            if self.containerName != None:
+                self.batch.append(txtLine)
+                self.batchSize += lineBytes
+                if self.batchSize >= self.batchBytes:
+                    self.queueBatch()
+                    batchFull = True
+        if batchFull:
+            self.appendBatches()
+
+    ## Returns True when the payload of this call has to be written (one call out of LOG_PAYLOAD_SAMPLE_EVERY), so the
+    ## caller only formats large payloads that are written
+    def samplePayload(self):
+        with self.lock:
+            self.payloadCount += 1
+            return (self.payloadCount - 1) % self.sampleEvery == 0
+
+    ## Returns the text of a large payload for one log line. Only the first items of the lists and dicts and the start of
+    ## the strings are formatted (reprlib), the payload is never converted to text in full. With LOG_MAX_LINE_LENGTH 0 the
+    ## whole payload is written.
+    def formatPayload(self, payload):
+        if self.maxLineLength <= 0:
+            return str(payload)
+        return self.payloadRepr.repr(payload)
+
+    ## Moves the pending lines to the batches to append, must be called with the lock held
+    def queueBatch(self):
+        if len(self.batch) > 0:
+            self.pendingBatches.append(self.batch)
+            self.batch = []
+            self.batchSize = 0
+
+    ## Appends the queued batches to the log blob. The blob calls are made without the lock of the lines so the other
+    ## threads keep writing meanwhile, flushLock keeps the batches in the order they were queued.
+    def appendBatches(self):
+        with self.flushLock:
+            while True:
+                with self.lock:
+                    if (len(self.pendingBatches) == 0) or (self.containerName == None):
+                        return
+                    batch = self.pendingBatches.popleft()
+                batchData = "".join(batch).encode("utf-8")
+                if self.contentSettings != None:
+                    batchData = gzip.compress(batchData)
+                try:
+                    if self.blobService == None:
+                        blobService = common.getAppendBlobService()
+                        common.ensureBlobContainer(blobService, self.containerName)
+                        blobService.create_blob(self.containerName, self.blobName, content_settings=self.contentSettings)
+                        self.blobService = blobService
+                    for blockStart in range(0, len(batchData), AppendBlockMaxBytes):
+                        self.blobService.append_block(self.containerName, self.blobName, batchData[blockStart:blockStart + AppendBlockMaxBytes])
+                except Exception as e:
+                    logging.error(f"The run log could not be written to [{self.containerName}/{self.blobName}] : {e}")
+                    # the lines are still in the tail, stop streaming to avoid failing again for every batch
+                    with self.lock:
+                        self.containerName = None
+                        self.pendingBatches.clear()
+                    return
+
+    def flush(self):
+        with self.lock:
+            if self.containerName != None:
+                self.queueBatch()
+        self.appendBatches()
+
+    ## Returns the lines kept in memory for the output binding, with a note when the oldest lines were dropped
+    def getTail(self):
+        with self.lock:
+            tailText = "".join(txtLine for txtLine, lineBytes in self.tail)
+            if self.droppedLines > 0:
+                fullLog = f", the complete log is in [{self.containerName}/{self.blobName}]" if self.containerName != None else ""
+                tailText = f"[{self.droppedLines} earlier lines are not shown{fullLog}]\n" + tailText
+            return tailText
+
+## Returns the log sink of one run of a function, streamed to LOG_STREAM_CONTAINER when the setting is present
+def createRunLogSink(functionName, logType):
+    if ("LOG_STREAM_CONTAINER" in os.environ) and (os.environ["LOG_STREAM_CONTAINER"] != ""):
+        runTimestamp = datetime.datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        return RunLogSink(os.environ["LOG_STREAM_CONTAINER"], f"{functionName}-{runTimestamp}-{logType}.log")
+    return RunLogSink()
@@ -0,0 +1,51 @@
+## Parsed Azure resource ids shared by the usage loop and the billing passes, so every distinct id is split only once per
+## worker process instead of several times per usage record and again in every pass that strips the subscription prefix.
+##   /subscriptions/<sub>/resourceGroups/<rg>/providers/<namespace>/<type>/<name>[/<child type>/<child name>...]
+## The parts are positional, like the billing files always read them: resourceGroup is the 5th segment and name/type are
+## only set when the id has a name segment. The number of ids kept is set with the app setting RESOURCE_ID_CACHE_SIZE.
+import os
+import functools
+
+try:
+    ResourceIdCacheSize = int(os.environ["RESOURCE_ID_CACHE_SIZE"])
+except Exception as e:
+    ResourceIdCacheSize = 100000
+
+class ResourceId(object):
+    __slots__ = ("id", "segments", "subscriptionId", "resourceGroup", "provider", "resourceType", "name", "childSegments", "relativeId")
+
+    def __init__(self, resourceId):
+        self.id = resourceId
+        self.segments = tuple(resourceId.split("/"))
+        nbSegments = len(self.segments)
+        self.subscriptionId = self.segments[2] if nbSegments >= 3 else None
+        self.resourceGroup = self.segments[4] if nbSegments >= 5 else None
+        self.provider = self.segments[6] if nbSegments >= 7 else None
+        if nbSegments >= 9:
+            self.resourceType = self.segments[6] + "/" + self.segments[7]
+            self.name = self.segments[8]
+        else:
+            self.resourceType = None
+            self.name = None
+        self.childSegments = self.segments[9:]
+        self.relativeId = None
+        self.relativeId = self.getRelativeId(self.subscriptionId) if self.subscriptionId != None else resourceId
+
+    ## The id without its "/subscriptions/<subid>/resourceGroups/" (or ".../providers/") prefix, as written in the
+    ## InstanceID column of the billing files
+    def getRelativeId(self, subid):
+        if (self.relativeId != None) and (subid == self.subscriptionId):
+            return self.relativeId
+        relativeId = self.id.replace("/subscriptions/"+subid+"/providers/","")
+        relativeId = relativeId.replace("/subscriptions/"+subid+"/resourceGroups/","")
+        relativeId = relativeId.replace("/subscriptions/"+subid+"/resourcegroups/","")
+        relativeId = relativeId.replace("/subscriptions/"+subid+"/","")
+        return relativeId
+
+    ## The id of the top level resource, without the child segments (e.g. the storage account of a blob service)
+    def getRootId(self):
+        return "/".join(self.segments[:9])
+
+@functools.lru_cache(maxsize=ResourceIdCacheSize)
+def parseResourceId(resourceId):
+    return ResourceId(resourceId)
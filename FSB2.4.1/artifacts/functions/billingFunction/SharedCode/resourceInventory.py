@@ -0,0 +1,109 @@
+## Run-wide index of the resources (id, name, type and tags) used by the billing passes: subscription -> resource type -> resources.
+## By default the resources of a subscription and type are listed from ARM the first time they are needed, and every later lookup
+## (e.g. the VMs for INST_VM_PATCH_TAG and again for INST_VM_BACKUP_TAG) is answered from memory. With the app setting
+## RESOURCE_INVENTORY_BACKEND = "graph" all the needed resource types of all the subscriptions are loaded up front with a few
+## paged Azure Resource Graph queries.
+## Every indexed resource also gets a 'tagsLower' property: its tags with lowercase names, so the passes don't rebuild it.
+import os
+import logging
+import threading
+
+from . import common
+
+ResourceGraphUrl = "https://management.azure.com/providers/Microsoft.ResourceGraph/resources?api-version=2021-03-01"
+## Resource Graph accepts at most 1000 subscriptions per query and returns at most 1000 rows per page
+ResourceGraphSubscriptionBatch = 1000
+ResourceGraphPageSize = 1000
+
+def getInventoryBackend():
+    if ("RESOURCE_INVENTORY_BACKEND" in os.environ) and (os.environ["RESOURCE_INVENTORY_BACKEND"].lower() == "graph"):
+        return "graph"
+    return "arm"
+
+class ResourceInventory(object):
+    def __init__(self, token, debuglogging = True):
+        self.token = token
+        self.debuglogging = debuglogging
+        # subscription id -> resource type -> list of resources, all keys lowercase
+        self.resources = dict()
+        # lowercase resource id -> resource
+        self.resourcesById = dict()
+        self.loadedSubscriptions = set()
+        self.loadedResourceTypes = set()
+        # (subscription id, resource type) listed from ARM
+        self.loadedLists = set()
+        self.lock = threading.Lock()
+
+    ## Loads the resources of the given types for all the subscriptions with Resource Graph.
+    ## Returns False when the query failed, the lookups then fall back to ARM list calls.
+    def loadFromResourceGraph(self, subscriptionIds, resourceTypes):
+        typeList = ", ".join([f"'{resourceType.lower()}'" for resourceType in resourceTypes])
+        query = f"Resources | where type in~ ({typeList}) | project id, name, type, subscriptionId, tags"
+        try:
+            for batchStart in range(0, len(subscriptionIds), ResourceGraphSubscriptionBatch):
+                subscriptionBatch = subscriptionIds[batchStart:batchStart + ResourceGraphSubscriptionBatch]
+                skipToken = None
+                while True:
+                    options = {"$top": ResourceGraphPageSize, "resultFormat": "objectArray"}
+                    if skipToken:
+                        options["$skipToken"] = skipToken
+                    resp = common.callREST(
+                        ResourceGraphUrl,
+                        self.token,
+                        self.debuglogging,
+                        body = {"subscriptions": subscriptionBatch, "query": query, "options": options})
+                    for resource in resp['data']:
+                        self.addResource(resource['subscriptionId'], resource)
+                    skipToken = resp['$skipToken'] if '$skipToken' in resp else None
+                    if not skipToken:
+                        break
+        except Exception as e:
+            logging.error(f"The resource inventory could not be loaded from Resource Graph, using ARM list calls : {e}")
+            self.resources = dict()
+            self.resourcesById = dict()
+            return False
+
+        self.loadedSubscriptions.update([subid.lower() for subid in subscriptionIds])
+        self.loadedResourceTypes.update([resourceType.lower() for resourceType in resourceTypes])
+        logging.info(f"Loaded the resource inventory of {len(subscriptionIds)} subscription(s) from Resource Graph")
+        return True
+
+    def addResource(self, subid, resource):
+        # Resource Graph returns null for a resource without tags, ARM leaves the property out
+        if ('tags' in resource) and (resource['tags'] == None):
+            del resource['tags']
+        if 'tags' in resource:
+            resource['tagsLower'] = dict((k.lower(), v) for k, v in resource['tags'].items())
+        else:
+            resource['tagsLower'] = dict()
+        subscriptionResources = self.resources.setdefault(subid.lower(), dict())
+        subscriptionResources.setdefault(resource['type'].lower(), []).append(resource)
+        self.resourcesById[resource['id'].lower()] = resource
+
+    def isLoaded(self, subid, resourceType):
+        return ((subid.lower() in self.loadedSubscriptions) and (resourceType.lower() in self.loadedResourceTypes)) or ((subid.lower(), resourceType.lower()) in self.loadedLists)
+
+    ## Lists the resources of one type in the subscription from ARM (all the pages) and adds them to the index
+    def loadFromARM(self, subid, resourceType):
+        url = f"https://management.azure.com/subscriptions/{subid}/resources?$filter=resourceType eq '{resourceType}'&api-version=2019-09-01"
+        resourceList = []
+        for page in common.iterateRESTPages(url, self.token, self.debuglogging, 0):
+            if 'value' in page:
+                resourceList += page['value']
+        with self.lock:
+            if not self.isLoaded(subid, resourceType):
+                subscriptionResources = self.resources.setdefault(subid.lower(), dict())
+                subscriptionResources.setdefault(resourceType.lower(), [])
+                for resource in resourceList:
+                    self.addResource(subid, resource)
+                self.loadedLists.add((subid.lower(), resourceType.lower()))
+
+    ## Returns the resources of one type in the subscription, in the same format as the ARM resources list (plus 'tagsLower')
+    def getResources(self, subid, resourceType):
+        if not self.isLoaded(subid, resourceType):
+            self.loadFromARM(subid, resourceType)
+        return self.resources.get(subid.lower(), dict()).get(resourceType.lower(), [])
+
+    ## Returns an indexed resource by its id, or None when it is not in the index
+    def getResource(self, resourceId):
+        return self.resourcesById.get(resourceId.lower())
@@ -0,0 +1,204 @@
+## Metrics of one run of a billing function, written as a JSON blob at the end of the run when the app setting
+## RUN_METRICS_CONTAINER is set, so the stages and subscriptions that take the wall time can be compared between runs:
+##   rest          : per endpoint class (host and resource type of the url), number of calls, retries, failures, time,
+##                   bytes received and the final HTTP status codes
+##   stages        : per stage (usage details and the usage page reads, every processBillingFor* pass, the CSV upload),
+##                   number of calls and time
+##   subscriptions : per subscription, usage pages and records read, the usage calls of a single resource (the storage
+##                   accounts resolved from their usage) and the time of every stage
+## The metrics are kept in a RunMetrics object created by startRun for every run. It is the current run of the context of
+## the function (a context variable), so the runs of billingupload and billingUploadFIT that overlap in the same worker
+## process keep their own metrics. The worker threads of a run record into it through bindRun.
+import os
+import json
+import time
+import logging
+import datetime
+import functools
+import inspect
+import threading
+import contextvars
+
+from urllib.parse import urlparse, unquote
+from . import common
+
+CurrentRun = contextvars.ContextVar("CurrentRun", default=None)
+
+## Starts the metrics of a run and makes it the current run, returns its RunMetrics
+def startRun(functionName):
+    runMetrics = RunMetrics(functionName)
+    CurrentRun.set(runMetrics)
+    return runMetrics
+
+## Returns the RunMetrics of the current run, None outside of a run
+def getCurrentRun():
+    return CurrentRun.get()
+
+## Returns the function running in the current run when it is called from another thread (e.g. an executor worker),
+## the threads do not get the context of the thread that started them
+def bindRun(runFunction):
+    runMetrics = CurrentRun.get()
+
+    @functools.wraps(runFunction)
+    def boundFunction(*args, **kwargs):
+        runToken = CurrentRun.set(runMetrics)
+        try:
+            return runFunction(*args, **kwargs)
+        finally:
+            CurrentRun.reset(runToken)
+    return boundFunction
+
+## Returns the class of a REST url, its host and the resource type without the names and ids, e.g.
+## management.azure.com/microsoft.consumption/usagedetails or management.azure.com/subscriptions/resourcegroups
+def getEndpointClass(url):
+    parsedUrl = urlparse(url)
+    segments = [segment.lower() for segment in parsedUrl.path.split("/") if segment != ""]
+    if "providers" in segments:
+        providerIndex = len(segments) - 1 - segments[::-1].index("providers")
+        typeSegments = segments[providerIndex+1:]
+        # namespace followed by (type, name) pairs
+        classPath = "/".join(typeSegments[:1] + typeSegments[1::2]) if len(typeSegments) > 0 else "providers"
+    else:
+        # (collection, name) pairs, e.g. subscriptions/<id>/resourcegroups/<name>
+        classPath = "/".join(segments[0::2])
+    return f"{parsedUrl.hostname}/{classPath}"
+
+class RunMetrics(object):
+    def __init__(self, functionName):
+        self.functionName = functionName
+        self.runStart = datetime.datetime.utcnow()
+        self.runStartTime = time.monotonic()
+        self.restMetrics = dict()
+        self.stageMetrics = dict()
+        self.subscriptionMetrics = dict()
+        self.lock = threading.Lock()
+
+    ## Must be called with the lock held
+    def getSubscriptionMetrics(self, subid):
+        if subid not in self.subscriptionMetrics:
+            self.subscriptionMetrics[subid] = {"usagePages": 0, "usageRecords": 0, "resourceUsageCalls": 0, "stages": dict()}
+        return self.subscriptionMetrics[subid]
+
+    def recordRESTCall(self, url, statusCode, seconds, nbRetries, nbBytes):
+        endpointClass = getEndpointClass(url)
+        with self.lock:
+            if endpointClass not in self.restMetrics:
+                self.restMetrics[endpointClass] = {"calls": 0, "retries": 0, "failures": 0, "seconds": 0.0, "maxSeconds": 0.0, "bytes": 0, "status": dict()}
+            endpointMetrics = self.restMetrics[endpointClass]
+            endpointMetrics["calls"] += 1
+            endpointMetrics["retries"] += nbRetries
+            endpointMetrics["seconds"] += seconds
+            endpointMetrics["maxSeconds"] = max(endpointMetrics["maxSeconds"], seconds)
+            endpointMetrics["bytes"] += nbBytes
+            statusKey = str(statusCode)
+            endpointMetrics["status"][statusKey] = endpointMetrics["status"].get(statusKey, 0) + 1
+            if not (200 <= statusCode <= 299):
+                endpointMetrics["failures"] += 1
+            # every usage details call is one page of the usage of the subscription in the url, except the calls filtered
+            # on one resource (resourceId eq) that read the tags of a storage account
+            if endpointClass.endswith("/microsoft.consumption/usagedetails"):
+                parsedUrl = urlparse(url)
+                segments = parsedUrl.path.split("/")
+                if (len(segments) > 2) and (segments[1].lower() == "subscriptions"):
+                    if "resourceid eq" in unquote(parsedUrl.query).lower():
+                        self.getSubscriptionMetrics(segments[2])["resourceUsageCalls"] += 1
+                    else:
+                        self.getSubscriptionMetrics(segments[2])["usagePages"] += 1
+
+    def addUsageRecords(self, subid, nbRecords):
+        with self.lock:
+            self.getSubscriptionMetrics(subid)["usageRecords"] += nbRecords
+
+    def recordStage(self, stageName, subid, seconds):
+        with self.lock:
+            if stageName not in self.stageMetrics:
+                self.stageMetrics[stageName] = {"calls": 0, "seconds": 0.0, "maxSeconds": 0.0}
+            stageMetrics = self.stageMetrics[stageName]
+            stageMetrics["calls"] += 1
+            stageMetrics["seconds"] += seconds
+            stageMetrics["maxSeconds"] = max(stageMetrics["maxSeconds"], seconds)
+            if subid != None:
+                subscriptionStages = self.getSubscriptionMetrics(subid)["stages"]
+                subscriptionStages[stageName] = subscriptionStages.get(stageName, 0.0) + seconds
+
+    def getRunMetrics(self):
+        with self.lock:
+            return {
+                "function": self.functionName,
+                "runStart": self.runStart.isoformat() + "Z",
+                "elapsedSeconds": time.monotonic() - self.runStartTime,
+                "rest": self.restMetrics,
+                "stages": self.stageMetrics,
+                "subscriptions": self.subscriptionMetrics
+            }
+
+## Records one REST call (with all its tries) in the current run: seconds includes the retry delays, nbBytes is the size of
+## the final answer
+def recordRESTCall(url, statusCode, seconds, nbRetries, nbBytes):
+    runMetrics = CurrentRun.get()
+    if runMetrics != None:
+        runMetrics.recordRESTCall(url, statusCode, seconds, nbRetries, nbBytes)
+
+def addUsageRecords(subid, nbRecords):
+    runMetrics = CurrentRun.get()
+    if runMetrics != None:
+        runMetrics.addUsageRecords(subid, nbRecords)
+
+def recordStage(stageName, subid, seconds):
+    runMetrics = CurrentRun.get()
+    if runMetrics != None:
+        runMetrics.recordStage(stageName, subid, seconds)
+
+## Generator returning the usage items unchanged, the number of items is added to the subscription when the iteration ends.
+## The time spent waiting for the items (reading and decoding the usage pages) is recorded as the usageReads stage, the
+## usageDetails stage minus usageReads is the time of the classification of the records.
+def countUsageRecords(subid, usageItems):
+    nbRecords = 0
+    readSeconds = 0.0
+    usageItems = iter(usageItems)
+    try:
+        while True:
+            readStart = time.monotonic()
+            try:
+                item = next(usageItems)
+            finally:
+                readSeconds += time.monotonic() - readStart
+            nbRecords += 1
+            yield item
+    except StopIteration:
+        return
+    finally:
+        addUsageRecords(subid, nbRecords)
+        recordStage("usageReads", subid, readSeconds)
+
+## Decorator recording the time of every call of a function as a stage. The stage is the function name, with the billing
+## code when the function has a billingCode parameter, and the time is added to the subscription of its subid parameter.
+def measureStage(stageFunction):
+    stageParameters = inspect.signature(stageFunction)
+
+    @functools.wraps(stageFunction)
+    def measuredFunction(*args, **kwargs):
+        stageArguments = stageParameters.bind_partial(*args, **kwargs).arguments
+        stageName = stageFunction.__name__
+        if stageArguments.get("billingCode") != None:
+            # the subscription id in the AZU-COST/AZU-OS billing codes is already in the subscription metrics
+            stageName += "[" + stageArguments["billingCode"].split(":")[0] + "]"
+        stageStart = time.monotonic()
+        try:
+            return stageFunction(*args, **kwargs)
+        finally:
+            recordStage(stageName, stageArguments.get("subid"), time.monotonic() - stageStart)
+    return measuredFunction
+
+## Writes the metrics of the run (RunMetrics of startRun) to the RUN_METRICS_CONTAINER container, returns the blob name or
+## None when the setting is not set or the blob could not be written (the error is logged, it does not fail the run)
+def writeRunMetrics(runMetrics):
+    containerName = os.environ["RUN_METRICS_CONTAINER"] if "RUN_METRICS_CONTAINER" in os.environ else ""
+    if containerName == "":
+        return None
+    blobName = f"{runMetrics.functionName}-{runMetrics.runStart.strftime('%Y%m%d-%H%M%S')}-metrics.json"
+    common.writeToBlobStorage(containerName, blobName, json.dumps(runMetrics.getRunMetrics(), indent=1, sort_keys=True), "application/json")
+    if common.getLastErrorMessage() != "":
+        logging.error(f"The metrics of the run could not be written to [{containerName}/{blobName}] : {common.getLastErrorMessage()}")
+        return None
+    return f"{containerName}/{blobName}"
@@ -0,0 +1,192 @@
+## Checkpoints of the usage detail records already ingested, per subscription and day (app setting BILLING_CHECKPOINT_STORE).
+## For every (subscription, day) the records are kept in a gzip JSON file, and an index per subscription records the number
+## of records and the SHA-256 of their content. A re-run or backfill over the same days (BILLING_DAY_PERIOD_START/END)
+## reads the settled days from the checkpoints and only calls the usage API for the missing days and the recent days, whose
+## usage can still change (BILLING_CHECKPOINT_SETTLE_DAYS). A recent day that was fetched again is compared with its
+## checkpoint by hash, and the checkpoint is only rewritten when the records changed. A fetched day is written to its
+## checkpoint while its records are returned, it is not read in memory first. The index of a subscription is written once
+## after its last day (saveIndex), a day written without its index entry is fetched again by the next run.
+##   BILLING_CHECKPOINT_STORE    : "blob" (container BILLING_CHECKPOINT_LOCATION, default billing-checkpoints) or
+##                                 "local" (folder BILLING_CHECKPOINT_LOCATION), empty to disable the checkpoints
+import io
+import os
+import json
+import gzip
+import logging
+import hashlib
+import datetime
+import threading
+
+from . import common
+
+def getCheckpointStore():
+    storeType = os.environ["BILLING_CHECKPOINT_STORE"].lower() if "BILLING_CHECKPOINT_STORE" in os.environ else ""
+    location = os.environ["BILLING_CHECKPOINT_LOCATION"] if (("BILLING_CHECKPOINT_LOCATION" in os.environ) and (os.environ["BILLING_CHECKPOINT_LOCATION"] != "")) else None
+    if storeType == "blob":
+        return BlobCheckpointStore(location if location else "billing-checkpoints")
+    if storeType == "local":
+        return LocalCheckpointStore(location if location else os.path.join("/tmp", "billing-checkpoints"))
+    return None
+
+class BlobCheckpointStore(object):
+    def __init__(self, containerName):
+        self.containerName = containerName
+
+    def getBlobService(self):
+        blobService = common.getBlockBlobService()
+        common.ensureBlobContainer(blobService, self.containerName)
+        return blobService
+
+    def read(self, name):
+        blobService = self.getBlobService()
+        if not blobService.exists(self.containerName, name):
+            return None
+        return blobService.get_blob_to_bytes(self.containerName, name).content
+
+    def write(self, name, data):
+        self.getBlobService().create_blob_from_bytes(self.containerName, name, data)
+
+class LocalCheckpointStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def read(self, name):
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as checkpointFile:
+            return checkpointFile.read()
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written next to the final file and renamed, so an interrupted run never leaves a partial checkpoint
+        with open(path + ".tmp", "wb") as checkpointFile:
+            checkpointFile.write(data)
+        os.replace(path + ".tmp", path)
+
+class UsageCheckpoints(object):
+    def __init__(self, store):
+        self.store = store
+        self.settleDays = common.getApplicationConfigInt("BILLING_CHECKPOINT_SETTLE_DAYS", 3)
+        # subscription id -> index {day: {"rows", "sha256", "ingestedAt"}}
+        self.indexes = dict()
+        # subscription ids whose index changed since it was read
+        self.changedIndexes = set()
+        self.lock = threading.Lock()
+
+    def getIndexName(self, subid):
+        return f"{subid}/index.json"
+
+    def getDayName(self, subid, day):
+        return f"{subid}/{day}.json.gz"
+
+    def getIndex(self, subid):
+        with self.lock:
+            if subid not in self.indexes:
+                indexData = None
+                try:
+                    indexData = self.store.read(self.getIndexName(subid))
+                except Exception as e:
+                    logging.error(f"The checkpoint index of subscription [{subid}] could not be read : {e}")
+                self.indexes[subid] = json.loads(indexData) if indexData else dict()
+            return self.indexes[subid]
+
+    ## A day is settled when its usage is not expected to change anymore
+    def isSettled(self, day):
+        return datetime.datetime.strptime(day, "%Y-%m-%d").date() < datetime.datetime.utcnow().date() - datetime.timedelta(days=self.settleDays)
+
+    ## Returns the checkpointed records of a settled day, or None when the day has to be fetched from the usage API
+    def getSettledDay(self, subid, day):
+        index = self.getIndex(subid)
+        if (day not in index) or (not self.isSettled(day)):
+            return None
+        try:
+            dayData = self.store.read(self.getDayName(subid, day))
+        except Exception as e:
+            logging.error(f"The checkpoint of subscription [{subid}] day [{day}] could not be read : {e}")
+            return None
+        if dayData == None:
+            return None
+        dayContent = gzip.decompress(dayData)
+        if hashlib.sha256(dayContent).hexdigest() != index[day]['sha256']:
+            logging.error(f"The checkpoint of subscription [{subid}] day [{day}] does not match its hash, fetching the day again")
+            return None
+        return json.loads(dayContent)
+
+    ## Returns the DayCheckpoint to which the records of a day are added while they are fetched
+    def startDay(self, subid, day):
+        return DayCheckpoint(self, subid, day)
+
+    ## Stores the records fetched for a day (gzip JSON content dayData, with nbRecords records and the SHA-256 dayHash of the
+    ## uncompressed content), the index is only updated in memory until saveIndex. Returns "new", "changed" or "unchanged"
+    ## compared with the previous checkpoint.
+    def saveDay(self, subid, day, nbRecords, dayHash, dayData):
+        index = self.getIndex(subid)
+        if day in index:
+            if index[day]['sha256'] == dayHash:
+                return "unchanged"
+            dayStatus = "changed"
+        else:
+            dayStatus = "new"
+        try:
+            self.store.write(self.getDayName(subid, day), dayData)
+        except Exception as e:
+            logging.error(f"The checkpoint of subscription [{subid}] day [{day}] could not be written : {e}")
+            return dayStatus
+        with self.lock:
+            index[day] = {"rows": nbRecords, "sha256": dayHash, "ingestedAt": datetime.datetime.utcnow().isoformat()}
+            self.changedIndexes.add(subid)
+        return dayStatus
+
+    ## Writes the index of the subscription when days were saved since it was written, once after the last day of the run
+    def saveIndex(self, subid):
+        with self.lock:
+            if subid not in self.changedIndexes:
+                return
+            self.changedIndexes.discard(subid)
+            indexData = json.dumps(self.indexes[subid], sort_keys=True, indent=1).encode("utf-8")
+        try:
+            self.store.write(self.getIndexName(subid), indexData)
+        except Exception as e:
+            logging.error(f"The checkpoint index of subscription [{subid}] could not be written : {e}")
+
+## The checkpoint of one day written while its records are fetched: every record is serialized and gzip compressed when it
+## is added, so the day is only kept compressed in memory and not as a list of records. The content is the JSON list of
+## json.dumps(records, sort_keys=True, separators=(",", ":")), so its hash compares with the existing checkpoints.
+## The checkpoint is only stored by save(), a day that was not read to the end is never stored.
+class DayCheckpoint(object):
+    def __init__(self, checkpoints, subid, day):
+        self.checkpoints = checkpoints
+        self.subid = subid
+        self.day = day
+        self.nbRecords = 0
+        self.contentHash = hashlib.sha256()
+        self.dayData = io.BytesIO()
+        self.dayFile = gzip.GzipFile(fileobj=self.dayData, mode="wb")
+        self.write(b"[")
+
+    def write(self, content):
+        self.contentHash.update(content)
+        self.dayFile.write(content)
+
+    def addRecord(self, record):
+        recordContent = json.dumps(record, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        self.write(recordContent if self.nbRecords == 0 else b"," + recordContent)
+        self.nbRecords += 1
+
+    ## Stores the checkpoint of the day, returns "new", "changed" or "unchanged" (UsageCheckpoints.saveDay)
+    def save(self):
+        self.write(b"]")
+        self.dayFile.close()
+        return self.checkpoints.saveDay(self.subid, self.day, self.nbRecords, self.contentHash.hexdigest(), self.dayData.getvalue())
+
+## Returns the days (YYYY-MM-DD) from startDay to endDay included
+def getDays(startDay, endDay):
+    day = datetime.datetime.strptime(startDay, "%Y-%m-%d").date()
+    lastDay = datetime.datetime.strptime(endDay, "%Y-%m-%d").date()
+    days = []
+    while day <= lastDay:
+        days.append(day.strftime("%Y-%m-%d"))
+        day += datetime.timedelta(days=1)
+    return days
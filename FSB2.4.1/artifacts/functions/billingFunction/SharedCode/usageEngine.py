@@ -0,0 +1,342 @@
+## Columnar engine for the usage detail records of one subscription (app setting USAGE_ENGINE = "columnar").
+## The records are read once while the pages are read: every field used by the classification is added to a column that keeps
+## its distinct values once and an array('i') of value codes per record (interned per batch with pd.factorize). The
+## classification (resource id parts, managed/purpose/OS tags, service category) is then done once per distinct value and
+## applied to the records with the codes, and the ALL rows are stored as codes too.
+## It fills the BillingResult exactly like the record by record loop of billingupload: the same ALL rows in the same order,
+## and the same SubsTotalCost, ServiceCost, VMData and ResourceIDs, so the SUBS, SVC, AZU-COST and AZU-OS rows are the same too.
+## Costs are added in record order (np.add.at adds in index order) so the totals are the same to the last bit, and they are stored
+## as Python floats because formatNumber rounds with round(), which rounds numpy floats differently.
+import numpy as np
+import pandas as pd
+
+from array import array
+from .billingRowStore import ValueColumn, CodedValues
+from .resourceIdParser import parseResourceId
+
+ALLHeaderRow = [
+    "Subscription Id",
+    "Subscription Name",
+    "Service Category",
+    "Resource Type",
+    "Resource Name",
+    "Resource Group",
+    "Resource Location",
+    "Managed TAG (Y/N)",
+    "Managed TAG Value",
+    "Purpose TAG Value",
+    "Meter Name",
+    "Cost",
+    "Pricing Model",
+    "Resource ID"
+]
+
+StorageAccountType = "microsoft.storage/storageaccounts"
+VirtualMachineType = "microsoft.compute/virtualmachines"
+
+class ColumnarUsageEngine(object):
+    def __init__(self, serviceCategoryIndex, managedTag, purposeTagName, osVersionTagName, tagPrefix, billingCurrencyFix = "", batchSize = 5000):
+        self.managedTagName = managedTag['TagName'].lower()
+        self.managedTagValue = managedTag['TagValue'].lower()
+        self.purposeTagName = purposeTagName.lower()
+        self.osVersionTagName = osVersionTagName.lower()
+        self.tagPrefix = tagPrefix.lower()
+        self.billingCurrencyFix = billingCurrencyFix
+        self.batchSize = batchSize
+        # lowercase provider -> service category (common.getServiceCategoryIndex)
+        self.serviceCategories = serviceCategoryIndex
+        self.pendingItems = []
+        # tag names of a record -> (tag name, position in the tag columns) of the tags used
+        self.usedTags = dict()
+        self.nbRecords = 0
+        self.resourceIds = ValueColumn()
+        self.meterNames = ValueColumn()
+        self.currencyCodes = ValueColumn()
+        self.consumedServices = ValueColumn()
+        self.resourceLocations = ValueColumn()
+        self.pricingModels = ValueColumn()
+        # managed, purpose and OS version tag
+        self.tagColumns = [ValueColumn(), ValueColumn(), ValueColumn()]
+        self.valueRates = array('d')
+        self.hasCost = array('b')
+
+    ## Adds one usage detail item, the items are added to the columns every batchSize items
+    def addItem(self, item):
+        self.pendingItems.append(item)
+        if len(self.pendingItems) >= self.batchSize:
+            self.addBatch(self.pendingItems)
+            self.pendingItems = []
+
+    ## Returns the (tag name, position in the tag columns) of the tags used by the classification in a list of tag names, the
+    ## tag names are compared in lowercase and the last one wins like in the lowercase tag dict of the record loop
+    def getUsedTags(self, tagNames):
+        tagPositions = dict()
+        for tagName in tagNames:
+            lowerTagName = tagName.lower()
+            for tagPosition, usedTagName in enumerate([self.managedTagName, self.purposeTagName, self.osVersionTagName]):
+                if lowerTagName == usedTagName:
+                    tagPositions[tagPosition] = tagName
+        return tuple((tagName, tagPosition) for tagPosition, tagName in tagPositions.items())
+
+    ## Adds the fields of the items to the columns, reading every item once
+    def addBatch(self, items):
+        records = []
+        usedTagsCache = self.usedTags
+        billingCurrencyFix = (self.billingCurrencyFix == "Yes")
+        for item in items:
+            if 'properties' not in item:
+                continue
+            prop = item['properties']
+            if item['kind'] == "modern":
+                resourceId = prop['instanceName'].lower()
+                meterName = prop['meterName']
+                currencyCode = prop['billingCurrencyCode']
+                cost = prop.get('costInBillingCurrency')
+            else:
+                resourceId = prop['resourceId'].lower()
+                meterName = prop['meterDetails'].get('meterName', "n/a")
+                currencyCode = prop['billingCurrency']
+                cost = prop.get('cost')
+            hasCost = (cost != None)
+            if not hasCost:
+                cost = 0
+            elif billingCurrencyFix:
+                cost = float(prop["exchangeRate"])*float(prop["quantity"])*float(prop["unitPrice"])
+
+            # only the tags used by the classification are kept, found once per list of tag names
+            recordTags = [None, None, None]
+            tags = item.get('tags')
+            if tags:
+                tagNames = tuple(tags)
+                usedTags = usedTagsCache.get(tagNames)
+                if usedTags == None:
+                    usedTags = self.getUsedTags(tagNames)
+                    usedTagsCache[tagNames] = usedTags
+                for tagName, tagPosition in usedTags:
+                    recordTags[tagPosition] = tags[tagName]
+
+            records.append((resourceId, meterName, currencyCode, prop['consumedService'], prop['resourceLocation'], prop.get('pricingModel', "n/a"),
+                            recordTags[0], recordTags[1], recordTags[2], cost, hasCost))
+
+        if len(records) == 0:
+            return
+        columnValues = list(zip(*records))
+        for column, values in zip(self.getColumns(), columnValues):
+            column.addValues(values, self.nbRecords)
+        self.valueRates.extend(columnValues[-2])
+        self.hasCost.extend(columnValues[-1])
+        self.nbRecords += len(records)
+
+    ## The value columns in the order of the record fields of addBatch
+    def getColumns(self):
+        return [self.resourceIds, self.meterNames, self.currencyCodes, self.consumedServices, self.resourceLocations, self.pricingModels] + self.tagColumns
+
+    ## Replaces the tag codes of the storage sub-resources by the tags of their root account: the tags of the first usage record
+    ## of the root when it came before the first sub-resource record, otherwise the tags returned by resolveStorageAccountTags(root
+    ## ids, tags of the first usage record of the roots that have one later), which only uses the usage record when the account is deleted.
+    def resolveStorageTags(self, tagCodes, resourceCodes, resourceRoots, isStorageSub, isStorageRoot, resolveStorageAccountTags):
+        resourceIds = self.resourceIds.values
+        subRows = np.flatnonzero(isStorageSub)
+        firstSubRows = dict()
+        for resourceCode, subRow in zip(*self.firstRows(resourceCodes[subRows], subRows)):
+            storageRoot = resourceRoots[resourceCode]
+            if (storageRoot not in firstSubRows) or (subRow < firstSubRows[storageRoot]):
+                firstSubRows[storageRoot] = subRow
+        rootRows = np.flatnonzero(isStorageRoot)
+        firstRootRows = dict((resourceIds[resourceCode], rootRow) for resourceCode, rootRow in zip(*self.firstRows(resourceCodes[rootRows], rootRows)))
+
+        storageTags = dict()
+        pendingRoots = []
+        for storageRoot, subRow in sorted(firstSubRows.items(), key=lambda rootRow: rootRow[1]):
+            if (storageRoot in firstRootRows) and (firstRootRows[storageRoot] < subRow):
+                storageTags[storageRoot] = [codes[firstRootRows[storageRoot]] for codes in tagCodes]
+            else:
+                pendingRoots.append(storageRoot)
+        if len(pendingRoots) > 0:
+            tagNames = [self.managedTagName, self.purposeTagName, self.osVersionTagName]
+            usageRootTags = dict()
+            for storageRoot in pendingRoots:
+                if storageRoot in firstRootRows:
+                    rootTags = zip(tagNames, [tagColumn.values[codes[firstRootRows[storageRoot]]] for tagColumn, codes in zip(self.tagColumns, tagCodes)])
+                    usageRootTags[storageRoot] = dict((tagName, tagValue) for tagName, tagValue in rootTags if tagValue != None)
+            for storageRoot, resourceTags in resolveStorageAccountTags(pendingRoots, usageRootTags).items():
+                if resourceTags == None:
+                    resourceTags = dict()
+                storageTags[storageRoot] = [tagColumn.getCode(resourceTags.get(tagName)) for tagColumn, tagName in zip(self.tagColumns, tagNames)]
+
+        # storage accounts that could not be resolved keep the tags of the record itself
+        rootCodes = np.full(len(resourceIds), -1, dtype=np.int64)
+        rootTagCodes = []
+        for resourceCode, storageRoot in resourceRoots.items():
+            if storageRoot in storageTags:
+                rootCodes[resourceCode] = len(rootTagCodes)
+                rootTagCodes.append(storageTags[storageRoot])
+        if len(rootTagCodes) == 0:
+            return
+        rootTagCodes = np.array(rootTagCodes, dtype=np.int32)
+        recordRoots = rootCodes[resourceCodes]
+        hasStorageTags = recordRoots >= 0
+        for tagPosition, codes in enumerate(tagCodes):
+            codes[hasStorageTags] = rootTagCodes[recordRoots[hasStorageTags], tagPosition]
+
+    ## Classifies all the records added and stores the results in billingResult. Returns the error messages to log.
+    def classify(self, billingResult, subid, subname, resolveStorageAccountTags):
+        errorMessages = []
+        if len(self.pendingItems) > 0:
+            self.addBatch(self.pendingItems)
+            self.pendingItems = []
+        if self.nbRecords == 0:
+            return errorMessages
+        getCodes = lambda column: np.frombuffer(column.codes, dtype=np.int32)
+
+        # resource id parts, once per distinct resource id
+        resourceIds = self.resourceIds.values
+        resourceCodes = getCodes(self.resourceIds)
+        parsedIds = [parseResourceId(resourceId) for resourceId in resourceIds]
+        resourceGroups = [parsedId.resourceGroup if parsedId.resourceGroup != None else "n/a" for parsedId in parsedIds]
+        resourceNames = [parsedId.name if parsedId.name != None else "" for parsedId in parsedIds]
+        hasName = np.array([parsedId.name != None for parsedId in parsedIds], dtype=bool)
+        # storage account sub-resources (.../blobServices/default) don't have tags, they get the tags of the root account
+        resourceRoots = dict()
+        for resourceCode, parsedId in enumerate(parsedIds):
+            if (parsedId.name != None) and (parsedId.resourceType.lower() == StorageAccountType) and (len(parsedId.childSegments) == 2) and (parsedId.childSegments[1] == "default"):
+                resourceRoots[resourceCode] = parsedId.getRootId()
+        isSubResource = np.zeros(len(resourceIds), dtype=bool)
+        isSubResource[list(resourceRoots.keys())] = True
+        isStorageSub = isSubResource[resourceCodes]
+
+        # resource type: the type of the id when it has a name, otherwise the consumed service
+        consumedServices = self.consumedServices.values
+        serviceCodes = getCodes(self.consumedServices)
+        resourceTypes = [parsedId.resourceType.lower() if parsedId.name != None else None for parsedId in parsedIds] + [consumedService.lower() for consumedService in consumedServices]
+        typeCodes = np.where(hasName[resourceCodes], resourceCodes, len(resourceIds) + serviceCodes)
+        isStorageType = np.array([resourceType == StorageAccountType for resourceType in resourceTypes], dtype=bool)[typeCodes]
+        isVMType = np.array([resourceType == VirtualMachineType for resourceType in resourceTypes], dtype=bool)[typeCodes]
+
+        valueRate = np.frombuffer(self.valueRates, dtype=np.float64)
+        hasCost = np.frombuffer(self.hasCost, dtype=np.int8).astype(bool)
+        for recordIndex in np.flatnonzero(~hasCost):
+            serviceType = consumedServices[serviceCodes[recordIndex]].lower().replace("microsoft.","").capitalize()
+            resourceCode = resourceCodes[recordIndex]
+            errorMessages.append(f"ERROR: COST not found for Service [{serviceType}] Resource [{resourceGroups[resourceCode]}\\{resourceNames[resourceCode]}] !")
+
+        tagCodes = [getCodes(tagColumn).copy() for tagColumn in self.tagColumns]
+        if isStorageSub.any():
+            self.resolveStorageTags(tagCodes, resourceCodes, resourceRoots, isStorageSub, isStorageType & ~isStorageSub, resolveStorageAccountTags)
+        managedCodes, purposeCodes, osVersionCodes = tagCodes
+        managedValues, purposeValues, osVersionValues = [tagColumn.values for tagColumn in self.tagColumns]
+
+        # managed and purpose tags
+        isManagedValue = np.array([
+            (tagValue != None) and ((tagValue.lower() == self.managedTagValue) or tagValue.lower().startswith(self.tagPrefix))
+            for tagValue in managedValues], dtype=bool)
+        isManaged = isManagedValue[managedCodes]
+
+        # service category, only for managed resources
+        categoryNames = []
+        serviceCategoryCodes = np.full(len(consumedServices), -1, dtype=np.int64)
+        for serviceCode, consumedService in enumerate(consumedServices):
+            categoryName = self.serviceCategories.get(consumedService.lower())
+            if categoryName != None:
+                if categoryName not in categoryNames:
+                    categoryNames.append(categoryName)
+                serviceCategoryCodes[serviceCode] = categoryNames.index(categoryName)
+        recordCategories = serviceCategoryCodes[serviceCodes]
+        hasCategory = isManaged & (recordCategories >= 0)
+        categoryCodes = np.where(hasCategory, recordCategories, len(categoryNames))
+        svcCategories = categoryNames + ["None"]
+
+        currencyCode = self.currencyCodes.values[getCodes(self.currencyCodes)[-1]]
+        billingResult.currencyCode = currencyCode
+        billingResult.SubsTotalCost = sum(valueRate[hasCost].tolist())
+
+        if hasCategory.any():
+            categoryCost = np.zeros(len(categoryNames))
+            np.add.at(categoryCost, categoryCodes[hasCategory], valueRate[hasCategory])
+            # in order of the first record of the category, like the record loop
+            for categoryCode in pd.unique(categoryCodes[hasCategory]):
+                billingResult.ServiceCost[categoryNames[categoryCode]] = float(categoryCost[categoryCode])
+
+        # VMData: cost per managed VM, name of the first record and the last known OS version
+        isVM = isManaged & isVMType
+        if isVM.any():
+            vmCodes, vmResourceCodes = pd.factorize(resourceCodes[isVM])
+            vmCost = self.sumInOrder(vmCodes, valueRate[isVM], len(vmResourceCodes))
+            isKnownOsVersion = np.array([(tagValue != None) and (tagValue != "Unknown") for tagValue in osVersionValues], dtype=bool)[osVersionCodes[isVM]]
+            lastOsVersion = np.full(len(vmResourceCodes), -1, dtype=np.int64)
+            np.maximum.at(lastOsVersion, vmCodes[isKnownOsVersion], np.flatnonzero(isKnownOsVersion))
+            vmOsVersionCodes = osVersionCodes[isVM]
+            for vmCode, resourceCode in enumerate(vmResourceCodes):
+                billingResult.VMData[resourceIds[resourceCode]] = {
+                    'costcurr': float(vmCost[vmCode]),
+                    'osversion': osVersionValues[vmOsVersionCodes[lastOsVersion[vmCode]]] if lastOsVersion[vmCode] >= 0 else "Unknown",
+                    'name': resourceNames[resourceCode]
+                }
+
+        # ResourceIDs: cost per managed resource and meter. The first record of every resource only creates its entry,
+        # later records add their cost per meter (location and category of the first record of the meter).
+        meterCodes = getCodes(self.meterNames)
+        locationCodes = getCodes(self.resourceLocations)
+        if isManaged.any():
+            managedIds = resourceCodes[isManaged]
+            managedResourceCodes, managedResources = pd.factorize(managedIds)
+            for resourceCode in managedResources:
+                if resourceIds[resourceCode] not in billingResult.ResourceIDs:
+                    billingResult.ResourceIDs[resourceIds[resourceCode]] = dict()
+            isFirst = np.zeros(len(managedIds), dtype=bool)
+            isFirst[self.firstIndexes(managedResourceCodes, len(managedResources))] = True
+            if not isFirst.all():
+                nbMeterNames = len(self.meterNames.values)
+                meterKeyCodes, meterKeys = pd.factorize(managedIds[~isFirst].astype(np.int64) * nbMeterNames + meterCodes[isManaged][~isFirst])
+                meterCost = self.sumInOrder(meterKeyCodes, valueRate[isManaged][~isFirst], len(meterKeys))
+                meterFirst = self.firstIndexes(meterKeyCodes, len(meterKeys))
+                meterLocations = locationCodes[isManaged][~isFirst][meterFirst]
+                meterCategories = categoryCodes[isManaged][~isFirst][meterFirst]
+                # same order as the record loop: resources in order of their first record, then meters in order of appearance
+                for meterCode in np.lexsort((np.arange(len(meterKeys)), managedResourceCodes[~isFirst][meterFirst])):
+                    resourceCode, meterNameCode = divmod(int(meterKeys[meterCode]), nbMeterNames)
+                    billingResult.ResourceIDs[resourceIds[resourceCode]][self.meterNames.values[meterNameCode]] = {
+                        'costcurr': float(meterCost[meterCode]),
+                        'location': self.resourceLocations.values[meterLocations[meterCode]],
+                        'svccategory': svcCategories[meterCategories[meterCode]].replace("+","")
+                    }
+
+        # ALL rows, one per record in record order, given as codes into the distinct values
+        billingResult.setCSVFileHeaderRow("ALL", ALLHeaderRow[:11] + ["Cost ("+currencyCode+")"] + ALLHeaderRow[12:])
+        recordCodes = np.zeros(self.nbRecords, dtype=np.int32)
+        billingResult.storeCSVColumnsForSubscription("ALL", [
+            CodedValues(recordCodes, [subid]),
+            CodedValues(recordCodes, [subname]),
+            CodedValues(categoryCodes, svcCategories),
+            CodedValues(typeCodes, resourceTypes),
+            CodedValues(resourceCodes, resourceNames),
+            CodedValues(resourceCodes, resourceGroups),
+            CodedValues(locationCodes, self.resourceLocations.values),
+            CodedValues(isManaged.astype(np.int32), ["No", "YES"]),
+            CodedValues(np.where(isManaged, managedCodes, len(managedValues)), managedValues + ["n/a"]),
+            CodedValues(purposeCodes, ["n/a" if tagValue == None else tagValue for tagValue in purposeValues]),
+            CodedValues(meterCodes, self.meterNames.values),
+            valueRate,
+            CodedValues(getCodes(self.pricingModels), self.pricingModels.values),
+            CodedValues(resourceCodes, resourceIds)])
+        return errorMessages
+
+    ## Record of every group with its first position (positions given in record order)
+    def firstRows(self, codes, positions):
+        groupCodes, firstIndex = np.unique(codes, return_index=True)
+        return groupCodes.tolist(), positions[firstIndex].tolist()
+
+    ## Index of the first record of every group
+    def firstIndexes(self, codes, nbGroups):
+        firstIndex = np.full(nbGroups, len(codes), dtype=int)
+        np.minimum.at(firstIndex, codes, np.arange(len(codes)))
+        return firstIndex
+
+    ## Cost per group, added in record order starting from the cost of the first record of the group (like the record loop)
+    def sumInOrder(self, codes, values, nbGroups):
+        firstIndex = self.firstIndexes(codes, nbGroups)
+        groupSum = values[firstIndex].copy()
+        isNotFirst = np.ones(len(codes), dtype=bool)
+        isNotFirst[firstIndex] = False
+        np.add.at(groupSum, codes[isNotFirst], values[isNotFirst])
+        return groupSum
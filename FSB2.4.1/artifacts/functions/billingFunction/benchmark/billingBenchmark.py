@@ -0,0 +1,207 @@
+## End to end benchmark of billingupload.main on a synthetic tenant served by a local mock ARM server (mockArmServer.py).
+## The blobs written by the function are kept in memory, nothing is sent to Azure or Google.
+## Run from the billingFunction folder, e.g.
+##   python benchmark/billingBenchmark.py --subscriptions 5 --records 20000 --tags 10
+##   python benchmark/billingBenchmark.py --records 20000 --setting USAGE_ENGINE=columnar --setting BILLING_SUBSCRIPTION_WORKERS=4
+##   python benchmark/billingBenchmark.py --records 20000 --throttle-every 20 --retry-after 0.5   (HTTP 429 on every 20th ARM call)
+## Reported per run: time, usage records per second, peak RSS of the process, REST calls per endpoint, blob bytes written and
+## the time of the usage records classification (usageDetails stage without the usageReads stage).
+## The app settings given with --setting are applied before the function is loaded, ARM_READS_PER_SECOND defaults to 0
+## (no rate limiter) so that the mock server and not the ARM quota is measured.
+import os
+import sys
+import json
+import time
+import logging
+import datetime
+import argparse
+import resource
+import importlib
+
+BenchmarkFolder = os.path.dirname(os.path.abspath(__file__))
+FunctionAppFolder = os.path.dirname(BenchmarkFolder)
+sys.path.insert(0, BenchmarkFolder)
+import mockArmServer
+
+## Blob container contents written by the function during the benchmark, container/blob name -> bytes
+class MemoryBlobStore(object):
+    def __init__(self):
+        self.blobs = dict()
+        self.stagedBlocks = dict()
+        self.bytesWritten = 0
+
+    def write(self, containerName, blobName, data):
+        data = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+        self.blobs[f"{containerName}/{blobName}"] = data
+        self.bytesWritten += len(data)
+
+    ## Replaces the methods of the storage SDK used by the function app with writes to this store
+    def install(self):
+        from azure.storage.blob import BlockBlobService, AppendBlobService
+        blobStore = self
+
+        def putBlock(service, containerName, blobName, block, blockId, **kwargs):
+            blobStore.stagedBlocks.setdefault(f"{containerName}/{blobName}", dict())[blockId] = block
+
+        def putBlockList(service, containerName, blobName, blockList, **kwargs):
+            stagedBlocks = blobStore.stagedBlocks.pop(f"{containerName}/{blobName}")
+            blobStore.write(containerName, blobName, b"".join(stagedBlocks[block.id] for block in blockList))
+
+        def getBlobToBytes(service, containerName, blobName, **kwargs):
+            return type("Blob", (object,), {"content": blobStore.blobs[f"{containerName}/{blobName}"]})()
+
+        def appendBlock(service, containerName, blobName, block, **kwargs):
+            blobKey = f"{containerName}/{blobName}"
+            blobStore.blobs[blobKey] = blobStore.blobs.get(blobKey, b"") + block
+            blobStore.bytesWritten += len(block)
+
+        for blobServiceClass in [BlockBlobService, AppendBlobService]:
+            blobServiceClass.create_container = lambda service, containerName, **kwargs: True
+            blobServiceClass.exists = lambda service, containerName, blobName = None, **kwargs: f"{containerName}/{blobName}" in blobStore.blobs
+            blobServiceClass.get_blob_to_bytes = getBlobToBytes
+        BlockBlobService.create_blob_from_text = lambda service, containerName, blobName, text, **kwargs: blobStore.write(containerName, blobName, text)
+        BlockBlobService.create_blob_from_bytes = lambda service, containerName, blobName, data, **kwargs: blobStore.write(containerName, blobName, data)
+        BlockBlobService.put_block = putBlock
+        BlockBlobService.put_block_list = putBlockList
+        AppendBlobService.create_blob = lambda service, containerName, blobName, **kwargs: blobStore.write(containerName, blobName, b"")
+        AppendBlobService.append_block = appendBlock
+
+class TimerRequest(object):
+    past_due = False
+
+class OutputBinding(object):
+    def __init__(self):
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+def getPeakRSSMegabytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def getSettings(arguments, baseUrl):
+    settings = {
+        "IDENTITY_ENDPOINT": baseUrl + "/msi/token",
+        "IDENTITY_HEADER": "benchmark",
+        "AzureWebJobsStorage": "DefaultEndpointsProtocol=https;AccountName=benchmark;AccountKey=YmVuY2htYXJr;EndpointSuffix=core.windows.net",
+        "AZ_KEYVAULT_NAME": "benchmark",
+        "BillingCountryCode": "NL",
+        "COMPANY_TAG_PREFIX": "Eviden",
+        "PRODUCT_CODE": "ELZ",
+        "PRODUCT_PURPOSE_TAG": "EvidenPurpose",
+        "CustomerName": "Benchmark",
+        "FITTable": "FITTable",
+        "TimeFrame": "Daily",
+        "GOOGLE_BUCKET_NAME_SECRET_NAME": "billing-google-bucket-name",
+        "GOOGLE_BUCKET_KEY_SECRET_NAME": "billing-google-bucket-key",
+        "BILLING_DAY_PERIOD_START": arguments.first_day,
+        "BILLING_DAY_PERIOD_END": arguments.last_day,
+        "ARM_READS_PER_SECOND": "0",
+        "SERVICES_SPLIT_DATA": json.dumps([[
+            {"ServiceCategoryName": "IaaS", "Providers": ["Microsoft.Compute", "Microsoft.Network", "Microsoft.Storage"]},
+            {"ServiceCategoryName": "PaaS", "Providers": ["Microsoft.Web", "Microsoft.Sql"]}
+        ]]),
+        "VM_COMPL_TAG": json.dumps({"TagName": "EvidenManaged", "TagValue": "true"}),
+        "VM_OSVERSION_TAG": json.dumps({"TagName": "EvidenOsVersion"}),
+        "VM_PATCH_TAG": json.dumps({"TagName": "EvidenPatching", "TagValue": "*"}),
+        "VM_BACKUP_TAG": json.dumps({"TagName": "EvidenBackup", "TagValue": "*"}),
+        "RECOVERY_VAULT_TAG": json.dumps({"TagName": "EvidenPurpose", "TagValue": "EvidenRecoveryServicesVault"}),
+        "VNET_SPOKES_TAG": json.dumps({"TagName": "EvidenManaged", "TagValue": "EvidenNetworkingSpoke"}),
+        "IMG_GALLERY_TAG": json.dumps({"TagName": "EvidenPurpose", "TagValue": "EvidenSharedImageGallery"}),
+        "CUSTOM_POLICIES_METADATA": json.dumps({"TagName": "source", "TagValue": "EvidenELZ"}),
+        "MAINTENANCE_CONFIG_TAG": json.dumps({"TagName": "EvidenPurpose", "TagValue": "EvidenUpdateManagement"})
+    }
+    for setting in arguments.setting:
+        settingName, settingValue = setting.split("=", 1)
+        settings[settingName] = settingValue
+    return settings
+
+def getArguments():
+    parser = argparse.ArgumentParser(description="Runs billingupload.main on a synthetic tenant served by a local mock ARM server")
+    parser.add_argument("--subscriptions", type=int, default=3, help="number of subscriptions")
+    parser.add_argument("--records", type=int, default=5000, help="usage records per subscription")
+    parser.add_argument("--tags", type=int, default=5, help="extra tags per resource")
+    parser.add_argument("--page-size", type=int, default=1000, help="usage records per usageDetails page")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every answer of the mock server")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth ARM call with HTTP 429 (0: never)")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="seconds of the Retry-After header of the HTTP 429 answers")
+    parser.add_argument("--first-day", default="2024-01-01", help="first day of the billing period")
+    parser.add_argument("--days", type=int, default=1, help="number of days of the billing period, the records are spread over them")
+    parser.add_argument("--runs", type=int, default=1, help="number of runs in the same process (the runs after the first one are warm)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic tenant")
+    parser.add_argument("--setting", action="append", default=[], metavar="NAME=VALUE", help="app setting of the function, can be repeated")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the log of the function")
+    arguments = parser.parse_args()
+    arguments.last_day = (datetime.datetime.strptime(arguments.first_day, "%Y-%m-%d") + datetime.timedelta(days=arguments.days - 1)).strftime("%Y-%m-%d")
+    return arguments
+
+def main():
+    arguments = getArguments()
+    if not arguments.verbose:
+        logging.getLogger().setLevel(logging.CRITICAL)
+    tenantStart = time.time()
+    subscriptions = mockArmServer.generateTenant(arguments.subscriptions, arguments.records, arguments.tags, arguments.seed, arguments.first_day, arguments.days)
+    tenantSeconds = time.time() - tenantStart
+    server = mockArmServer.MockArmServer(subscriptions, arguments.page_size, arguments.latency, arguments.throttle_every, arguments.retry_after)
+    server.start()
+
+    # the function app is loaded as a package, like the Functions host does
+    os.environ.update(getSettings(arguments, server.getBaseUrl()))
+    sys.path.insert(0, os.path.dirname(FunctionAppFolder))
+    packageName = os.path.basename(FunctionAppFolder)
+    httpClient = importlib.import_module(packageName + ".SharedCode.httpClient")
+    runMetrics = importlib.import_module(packageName + ".SharedCode.runMetrics")
+    billingupload = importlib.import_module(packageName + ".billingupload")
+    httpClient.getSession().mount("https://", mockArmServer.RedirectAdapter(server.getBaseUrl(), pool_maxsize=64))
+    blobStore = MemoryBlobStore()
+    blobStore.install()
+
+    nbRecords = arguments.subscriptions * arguments.records
+    results = {
+        "subscriptions": arguments.subscriptions,
+        "recordsPerSubscription": arguments.records,
+        "tags": arguments.tags,
+        "settings": arguments.setting,
+        "tenantSeconds": round(tenantSeconds, 2),
+        "rssBeforeRunsMB": round(getPeakRSSMegabytes(), 1),
+        "runs": []
+    }
+    for runIndex in range(arguments.runs):
+        callCountsBefore = dict(server.callCounts)
+        bytesWrittenBefore = blobStore.bytesWritten
+        errorOutput = OutputBinding()
+        infoOutput = OutputBinding()
+        runStart = time.time()
+        billingupload.main(TimerRequest(), errorOutput, infoOutput)
+        runSeconds = time.time() - runStart
+        restCalls = dict((endpointName, callCount - callCountsBefore.get(endpointName, 0)) for endpointName, callCount in server.callCounts.items())
+        # the metrics of the run that just ended, still the current run of this thread
+        stageMetrics = runMetrics.getCurrentRun().getRunMetrics()["stages"]
+        results["runs"].append({
+            "seconds": round(runSeconds, 2),
+            "recordsPerSecond": round(nbRecords / runSeconds, 1),
+            "peakRSSMB": round(getPeakRSSMegabytes(), 1),
+            "restCalls": dict((endpointName, callCount) for endpointName, callCount in sorted(restCalls.items()) if callCount > 0),
+            "blobBytesWritten": blobStore.bytesWritten - bytesWrittenBefore,
+            "errorLines": len(errorOutput.value.splitlines()) if errorOutput.value else 0,
+            # time of the usage records classification, without the waits for the usage pages
+            "classificationSeconds": round(stageMetrics["usageDetails"]["seconds"] - stageMetrics["usageReads"]["seconds"], 3) if "usageReads" in stageMetrics else None,
+            "stageSeconds": dict((stageName, round(stage["seconds"], 3)) for stageName, stage in sorted(stageMetrics.items(), key=lambda item: -item[1]["seconds"]))
+        })
+    server.stop()
+
+    if arguments.json:
+        print(json.dumps(results, indent=1))
+        return
+    print(f"Tenant: {arguments.subscriptions} subscriptions x {arguments.records} records x {arguments.tags} tags, generated in {results['tenantSeconds']} sec, RSS {results['rssBeforeRunsMB']} MB")
+    for runIndex, runResult in enumerate(results["runs"]):
+        print(f"Run {runIndex + 1}: {runResult['seconds']} sec, {runResult['recordsPerSecond']} records/sec, peak RSS {runResult['peakRSSMB']} MB, "
+              f"{runResult['blobBytesWritten']} blob bytes written, {runResult['errorLines']} error lines")
+        print("  REST calls: " + ", ".join(f"{endpointName} {callCount}" for endpointName, callCount in runResult["restCalls"].items()))
+        print(f"  Usage classification (usage details without the page reads): {runResult['classificationSeconds']} sec")
+        print("  Stages (sec): " + ", ".join(f"{stageName} {stageSeconds}" for stageName, stageSeconds in list(runResult["stageSeconds"].items())[:6]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+## Local HTTP server answering the REST calls of the billing functions with a synthetic tenant, for the benchmarks.
+## Served endpoints: managed identity token, Key Vault secrets, subscriptions, usageDetails (paged with nextLink),
+## resources (filtered on resourceType), Resource Graph, policyDefinitions and backupProtectedItems.
+## The https calls of the functions are sent here by RedirectAdapter, the original path and query are kept.
+## The usageDetails $filter is applied (usage start and end days, resourceId eq). With throttleEvery > 0 every Nth ARM call
+## is answered with HTTP 429 and a Retry-After header of retryAfter seconds, to exercise the retries of the functions.
+import re
+import json
+import time
+import datetime
+import random
+import socket
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+from requests.adapters import HTTPAdapter
+
+ResourceKinds = {
+    "vm": "Microsoft.Compute/virtualMachines",
+    "sa": "Microsoft.Storage/storageAccounts",
+    "vnet": "Microsoft.Network/virtualNetworks",
+    "gal": "Microsoft.Compute/galleries",
+    "web": "Microsoft.Web/sites",
+    "sql": "Microsoft.Sql/servers",
+    "rv": "Microsoft.RecoveryServices/vaults",
+    "mc": "Microsoft.Maintenance/maintenanceConfigurations"
+}
+## Relative weight of every kind of resource in the generated subscriptions
+ResourceKindWeights = {"vm": 4, "sa": 2, "vnet": 1, "gal": 1, "web": 2, "sql": 1, "rv": 1, "mc": 1}
+ResourceGraphPageSize = 1000
+## Conditions of the usageDetails $filter, e.g. properties/usageStart ge '2024-01-01' and resourceId eq '/subscriptions/..'
+UsageFilterCondition = re.compile(r"(properties/usageStart|properties/usageEnd|resourceId) (ge|le|eq) '([^']*)'", re.IGNORECASE)
+
+## Generates the tenant: nbSubscriptions subscriptions of nbRecords usage records each, spread over the days starting at
+## firstDay, on nbRecords/8 resources that carry nbTags tags besides the tags read by the billing function
+def generateTenant(nbSubscriptions, nbRecords, nbTags, seed = 1, firstDay = "2024-01-01", nbDays = 1):
+    generator = random.Random(seed)
+    kinds = [kind for kind, weight in ResourceKindWeights.items() for i in range(weight)]
+    dayStart = datetime.datetime.strptime(firstDay, "%Y-%m-%d").date()
+    days = [(dayStart + datetime.timedelta(days=dayIndex)).strftime("%Y-%m-%d") for dayIndex in range(nbDays)]
+    subscriptions = []
+    for subIndex in range(nbSubscriptions):
+        subid = f"{subIndex:08d}-0000-4000-8000-{subIndex:012d}"
+        resources = []
+        for resourceIndex in range(max(8, nbRecords // 8)):
+            kind = generator.choice(kinds)
+            resourceName = f"{kind}{resourceIndex}"
+            resourceId = f"/subscriptions/{subid}/resourceGroups/rg-{resourceIndex % 5}/providers/{ResourceKinds[kind]}/{resourceName}"
+            tags = dict()
+            if generator.random() < 0.7:
+                tags["EvidenManaged"] = generator.choice(["true", "True", "false"])
+            if kind == "vm":
+                tags["EvidenOsVersion"] = generator.choice(["Windows 2019", "Ubuntu 20.04", "RHEL8"])
+                if generator.random() < 0.5:
+                    tags["EvidenPatching"] = generator.choice(["mc-weekly", "mc-monthly"])
+                if generator.random() < 0.5:
+                    tags["EvidenBackup"] = "daily"
+            elif kind == "vnet":
+                tags["EvidenManaged"] = generator.choice(["EvidenNetworkingSpoke", "true"])
+            elif kind == "gal":
+                tags["EvidenPurpose"] = "EvidenSharedImageGallery"
+            elif kind == "rv":
+                tags["EvidenPurpose"] = "EvidenRecoveryServicesVault"
+            elif kind == "mc":
+                tags["EvidenPurpose"] = "EvidenUpdateManagement"
+            for tagIndex in range(nbTags):
+                tags[f"Tag{tagIndex}"] = f"value{generator.randint(0, 9)}"
+            resources.append({"id": resourceId, "name": resourceName, "type": ResourceKinds[kind], "location": "westeurope", "tags": tags})
+
+        records = []
+        for recordIndex in range(nbRecords):
+            resource = generator.choice(resources)
+            instanceId = resource["id"]
+            tags = resource["tags"]
+            if resource["type"] == "Microsoft.Storage/storageAccounts" and generator.random() < 0.5:
+                # usage of a child resource, its tags are the ones of the storage account
+                instanceId += "/blobServices/default"
+                tags = None
+            cost = round(generator.random() * 10, 6)
+            usageDay = days[recordIndex * nbDays // nbRecords]
+            if generator.random() < 0.5:
+                records.append({"kind": "modern", "id": f"usage{recordIndex}", "tags": tags, "properties": {
+                    "meterId": f"meter{generator.randint(0, 9)}", "meterName": f"Meter {generator.randint(0, 9)}",
+                    "consumedService": resource["type"].split("/")[0], "resourceLocation": "westeurope",
+                    "date": usageDay + "T00:00:00.0000000Z", "instanceName": instanceId, "billingCurrencyCode": "EUR",
+                    "costInBillingCurrency": cost, "exchangeRate": 1.1, "quantity": 2.0, "unitPrice": cost / 2,
+                    "pricingModel": generator.choice(["OnDemand", "Reservation"])}})
+            else:
+                records.append({"kind": "legacy", "id": f"usage{recordIndex}", "tags": tags, "properties": {
+                    "meterId": f"meter{generator.randint(0, 9)}", "meterDetails": {"meterName": f"Meter {generator.randint(0, 9)}"},
+                    "consumedService": resource["type"].split("/")[0], "resourceLocation": "westeurope",
+                    "date": usageDay + "T00:00:00Z", "resourceId": instanceId, "billingCurrency": "EUR",
+                    "cost": cost, "exchangeRate": "1.1", "quantity": "2", "unitPrice": str(cost / 2), "pricingModel": "OnDemand"}})
+
+        # every second VM is protected by one of the vaults
+        vaults = [resource["id"] for resource in resources if resource["type"] == "Microsoft.RecoveryServices/vaults"]
+        backupItems = dict((vaultId.lower(), []) for vaultId in vaults)
+        if len(vaults) > 0:
+            for resource in resources:
+                if resource["type"] == "Microsoft.Compute/virtualMachines" and generator.random() < 0.5:
+                    vaultId = generator.choice(vaults)
+                    backupItems[vaultId.lower()].append({
+                        "id": f"{vaultId}/backupFabrics/Azure/protectionContainers/iaasvmcontainer/protectedItems/{resource['name']}",
+                        "properties": {"workloadType": "VM", "virtualMachineId": resource["id"], "policyName": "DefaultPolicy"}})
+
+        policies = [{"name": f"policy{policyIndex}", "properties": {"displayName": f"Policy {policyIndex}", "policyType": "Custom",
+                     "metadata": {"source": "EvidenELZ" if policyIndex % 2 == 0 else "other"}}} for policyIndex in range(4)]
+
+        subscriptions.append({"subscriptionId": subid, "displayName": f"Benchmark subscription {subIndex}", "resources": resources,
+                              "records": records, "backupItems": backupItems, "policies": policies})
+    return subscriptions
+
+## Resource id of a usage record, instanceName for the modern records and resourceId for the legacy ones
+def getRecordResourceId(record):
+    return record["properties"]["instanceName"] if record["kind"] == "modern" else record["properties"]["resourceId"]
+
+class MockArmServer(object):
+    def __init__(self, subscriptions, pageSize = 1000, latency = 0.0, throttleEvery = 0, retryAfter = 1.0):
+        self.subscriptions = dict((subscription["subscriptionId"], subscription) for subscription in subscriptions)
+        self.subscriptionList = subscriptions
+        self.pageSize = pageSize
+        self.latency = latency
+        self.throttleEvery = throttleEvery
+        self.retryAfter = retryAfter
+        self.armCalls = 0
+        self.callCounts = dict()
+        self.bytesSent = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.createHandler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def getBaseUrl(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def countCall(self, endpointName, nbBytes):
+        with self.lock:
+            self.callCounts[endpointName] = self.callCounts.get(endpointName, 0) + 1
+            self.bytesSent += nbBytes
+
+    ## Returns True when this ARM call has to be throttled (one call out of throttleEvery), the token and Key Vault calls
+    ## are never throttled
+    def isThrottled(self, path):
+        if (self.throttleEvery <= 0) or (not path.startswith("/subscriptions")):
+            return False
+        with self.lock:
+            self.armCalls += 1
+            return self.armCalls % self.throttleEvery == 0
+
+    ## Returns the endpoint name and the JSON answer (status code, body) of a request
+    def answer(self, method, path, query, body):
+        parameters = parse_qs(query)
+        segments = path.strip("/").split("/")
+        if path.endswith("/msi/token"):
+            return "token", 200, {"access_token": "benchmark-token", "expires_on": str(int(time.time()) + 3600)}
+        if segments[0] == "secrets":
+            if segments[1] == "billing-customer-name":
+                return "secrets", 200, {"value": "Benchmark customer"}
+            return "secrets", 404, {"error": {"code": "SecretNotFound"}}
+        if path == "/subscriptions":
+            return "subscriptions", 200, {"value": [{"subscriptionId": subscription["subscriptionId"], "displayName": subscription["displayName"]} for subscription in self.subscriptionList]}
+        if path.endswith("/providers/Microsoft.ResourceGraph/resources"):
+            return "resourceGraph", 200, self.answerResourceGraph(body)
+        if (len(segments) < 2) or (segments[0] != "subscriptions") or (segments[1] not in self.subscriptions):
+            return "unknown", 404, {"error": {"code": "NotFound"}}
+        subscription = self.subscriptions[segments[1]]
+        if path.endswith("/providers/Microsoft.Consumption/usageDetails"):
+            return "usageDetails", 200, self.answerUsageDetails(subscription, path, query, parameters)
+        if path.endswith("/resources"):
+            resourceFilter = parameters.get("$filter", [""])[0]
+            resourceType = resourceFilter.split("resourceType eq '")[1].rstrip("'").lower() if "resourceType eq '" in resourceFilter else None
+            return "resources", 200, {"value": [resource for resource in subscription["resources"] if (resourceType == None) or (resource["type"].lower() == resourceType)]}
+        if path.endswith("/providers/Microsoft.Authorization/policyDefinitions"):
+            return "policyDefinitions", 200, {"value": subscription["policies"]}
+        if path.endswith("/backupProtectedItems"):
+            vaultId = path[:-len("/backupProtectedItems")].lower()
+            return "backupProtectedItems", 200, {"value": subscription["backupItems"].get(vaultId, [])}
+        return "unknown", 404, {"error": {"code": "NotFound"}}
+
+    ## One page of the usage records between startDate and endDate that match the $filter, the nextLink carries the offset
+    ## of the next page
+    def answerUsageDetails(self, subscription, path, query, parameters):
+        startDay = parameters["startDate"][0][:10] if "startDate" in parameters else "0000-00-00"
+        endDay = parameters["endDate"][0][:10] if "endDate" in parameters else "9999-99-99"
+        resourceId = None
+        for filterProperty, filterOperator, filterValue in UsageFilterCondition.findall(parameters.get("$filter", [""])[0]):
+            if filterProperty.lower() == "properties/usagestart":
+                startDay = max(startDay, filterValue[:10])
+            elif filterProperty.lower() == "properties/usageend":
+                endDay = min(endDay, filterValue[:10])
+            else:
+                resourceId = filterValue.lower()
+        records = [record for record in subscription["records"] if (startDay <= record["properties"]["date"][:10] <= endDay) and
+                   ((resourceId == None) or (getRecordResourceId(record).lower() == resourceId))]
+        offset = int(parameters["$skiptoken"][0]) if "$skiptoken" in parameters else 0
+        usagePage = {"value": records[offset:offset + self.pageSize]}
+        if offset + self.pageSize < len(records):
+            nextQuery = "&".join(parameter for parameter in query.split("&") if not parameter.startswith("$skiptoken="))
+            usagePage["nextLink"] = f"https://management.azure.com{path}?{nextQuery}&$skiptoken={offset + self.pageSize}"
+        return usagePage
+
+    def answerResourceGraph(self, body):
+        rows = []
+        for subid in body.get("subscriptions", []):
+            if subid in self.subscriptions:
+                for resource in self.subscriptions[subid]["resources"]:
+                    rows.append({"id": resource["id"], "name": resource["name"], "type": resource["type"].lower(), "subscriptionId": subid, "tags": resource["tags"]})
+        offset = int(body.get("options", {}).get("$skipToken", "0") or 0)
+        graphPage = {"totalRecords": len(rows), "count": len(rows[offset:offset + ResourceGraphPageSize]), "data": rows[offset:offset + ResourceGraphPageSize]}
+        if offset + ResourceGraphPageSize < len(rows):
+            graphPage["$skipToken"] = str(offset + ResourceGraphPageSize)
+        return graphPage
+
+    def createHandler(self):
+        mockServer = self
+
+        class MockArmRequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                # small answers are sent at once instead of waiting for the ACK of the client (Nagle + delayed ACK)
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, format, *args):
+                pass
+
+            def handleRequest(self, method):
+                contentLength = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(contentLength)) if contentLength > 0 else dict()
+                if mockServer.latency > 0:
+                    time.sleep(mockServer.latency)
+                parsedPath = urlparse(self.path)
+                if mockServer.isThrottled(unquote(parsedPath.path)):
+                    answerData = json.dumps({"error": {"code": "TooManyRequests", "message": "Throttled by the mock server"}}).encode("utf-8")
+                    mockServer.countCall("throttled", len(answerData))
+                    self.send_response(429)
+                    self.send_header("Retry-After", str(mockServer.retryAfter))
+                else:
+                    endpointName, statusCode, answer = mockServer.answer(method, unquote(parsedPath.path), parsedPath.query, body)
+                    answerData = json.dumps(answer).encode("utf-8")
+                    mockServer.countCall(endpointName, len(answerData))
+                    self.send_response(statusCode)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(answerData)))
+                self.end_headers()
+                self.wfile.write(answerData)
+
+            def do_GET(self):
+                self.handleRequest("GET")
+
+            def do_POST(self):
+                self.handleRequest("POST")
+
+        return MockArmRequestHandler
+
+## Transport adapter sending all the requests to the mock server, with their original path and query
+class RedirectAdapter(HTTPAdapter):
+    def __init__(self, baseUrl, **kwargs):
+        self.baseUrl = baseUrl
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def send(self, request, **kwargs):
+        parsedUrl = urlparse(request.url)
+        request.url = self.baseUrl + parsedUrl.path + (("?" + parsedUrl.query) if parsedUrl.query else "")
+        return HTTPAdapter.send(self, request, **kwargs)
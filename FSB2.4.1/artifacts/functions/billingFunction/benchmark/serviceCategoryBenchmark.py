@@ -0,0 +1,56 @@
+## Benchmark of the service category lookup done for every usage record: the former scan over all the SERVICES_SPLIT_DATA
+## categories against the provider index built once per run by common.getServiceCategoryIndex.
+## Run from the billingFunction folder:  python benchmark/serviceCategoryBenchmark.py
+## The benchmark folder is not deployed with the function app (.funcignore).
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# common reads these app settings when it is imported, placeholders are enough as nothing is called
+for settingName in ["IDENTITY_ENDPOINT", "IDENTITY_HEADER", "AzureWebJobsStorage", "BillingCountryCode", "COMPANY_TAG_PREFIX", "PRODUCT_CODE", "CustomerName", "FITTable"]:
+    os.environ.setdefault(settingName, "benchmark")
+from SharedCode import common
+
+## The lookup as it was done before the index: every category is scanned and its provider list lowercased again
+def getServiceCategoryScan(serviceSplitData, serviceType):
+    getServiceCategory = None
+    if len(serviceSplitData) > 0:
+        for serviceEntry in serviceSplitData[0]:
+            ServiceCategoryName = serviceEntry['ServiceCategoryName']
+            Providers = serviceEntry['Providers']
+            if serviceType.lower() in (item.lower() for item in Providers):
+                getServiceCategory = ServiceCategoryName
+    return getServiceCategory
+
+def buildServiceSplitData(nbCategories, nbProviders):
+    return [[
+        {
+            "ServiceCategoryName": f"Category{category}",
+            "Providers": [f"Microsoft.Provider{category}x{provider}" for provider in range(nbProviders)]
+        }
+        for category in range(nbCategories)
+    ]]
+
+def main():
+    nbLookups = 20000
+    print(f"{'categories':>10} {'providers':>10} {'scan (us/lookup)':>17} {'index (us/lookup)':>18} {'speedup':>8}")
+    for nbCategories, nbProviders in [(2, 5), (5, 10), (10, 20), (20, 50), (50, 100)]:
+        serviceSplitData = buildServiceSplitData(nbCategories, nbProviders)
+        serviceCategoryIndex = common.getServiceCategoryIndex(serviceSplitData)
+        # one provider of every category plus one provider that is not configured, as in the usage records
+        serviceTypes = [f"microsoft.provider{category}x{nbProviders - 1}" for category in range(nbCategories)] + ["Microsoft.Unknown"]
+        for serviceType in serviceTypes:
+            if getServiceCategoryScan(serviceSplitData, serviceType) != serviceCategoryIndex.get(serviceType.lower()):
+                raise Exception(f"Different category for [{serviceType}]")
+
+        scanTime = timeit.timeit(
+            lambda: [getServiceCategoryScan(serviceSplitData, serviceTypes[i % len(serviceTypes)]) for i in range(nbLookups)],
+            number=1)
+        indexTime = timeit.timeit(
+            lambda: [serviceCategoryIndex.get(serviceTypes[i % len(serviceTypes)].lower()) for i in range(nbLookups)],
+            number=1)
+        print(f"{nbCategories:>10} {nbProviders:>10} {scanTime / nbLookups * 1e6:>17.2f} {indexTime / nbLookups * 1e6:>18.2f} {scanTime / indexTime:>7.0f}x")
+
+if __name__ == "__main__":
+    main()
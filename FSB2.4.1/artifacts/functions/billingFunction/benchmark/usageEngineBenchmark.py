@@ -0,0 +1,65 @@
+## Benchmark of the columnar usage engine alone (USAGE_ENGINE = "columnar"): the usage records of one generated subscription
+## (mockArmServer.generateTenant) are classified in memory, without the REST calls and the page decoding, so the time is
+## the CPU time of the engine per record: addItem (the columns built while the pages are read) and classify.
+## Run from the billingFunction folder, e.g.  python benchmark/usageEngineBenchmark.py --records 60000 --tags 10
+## The benchmark folder is not deployed with the function app (.funcignore).
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# common reads these app settings when it is imported, placeholders are enough as nothing is called
+for settingName in ["IDENTITY_ENDPOINT", "IDENTITY_HEADER", "AzureWebJobsStorage", "BillingCountryCode", "COMPANY_TAG_PREFIX", "PRODUCT_CODE", "CustomerName", "FITTable"]:
+    os.environ.setdefault(settingName, "benchmark")
+from mockArmServer import generateTenant
+from SharedCode import common
+from SharedCode import usageEngine
+from SharedCode.billingResult import BillingResult
+
+ServiceSplitData = [[
+    {"ServiceCategoryName": "IaaS", "Providers": ["Microsoft.Compute", "Microsoft.Network", "Microsoft.Storage"]},
+    {"ServiceCategoryName": "PaaS", "Providers": ["Microsoft.Web", "Microsoft.Sql"]}
+]]
+
+def getArguments():
+    parser = argparse.ArgumentParser(description="Columnar usage engine benchmark")
+    parser.add_argument("--records", type=int, default=60000, help="usage records of the subscription")
+    parser.add_argument("--tags", type=int, default=5, help="tags per resource besides the ones read by the billing function")
+    parser.add_argument("--runs", type=int, default=3, help="number of runs, the best one is reported")
+    return parser.parse_args()
+
+def main():
+    arguments = getArguments()
+    subscription = generateTenant(1, arguments.records, arguments.tags)[0]
+    # the storage accounts are resolved with the tags of the generated resources, like the resource inventory does
+    storageAccountTags = dict((resource["id"].lower(), dict((tagName.lower(), tagValue) for tagName, tagValue in resource["tags"].items())) for resource in subscription["resources"])
+    resolveStorageAccountTags = lambda storageAccountIds, usageAccountTags: dict((storageAccountId, storageAccountTags.get(storageAccountId)) for storageAccountId in storageAccountIds)
+
+    bestTimes = None
+    for runIndex in range(arguments.runs):
+        engine = usageEngine.ColumnarUsageEngine(
+            common.getServiceCategoryIndex(ServiceSplitData),
+            {"TagName": "EvidenManaged", "TagValue": "true"},
+            "EvidenPurpose",
+            "EvidenOsVersion",
+            "Eviden")
+        billingResult = BillingResult(subscription["subscriptionId"], subscription["displayName"])
+        addStart = time.perf_counter()
+        for item in subscription["records"]:
+            engine.addItem(item)
+        classifyStart = time.perf_counter()
+        engine.classify(billingResult, subscription["subscriptionId"], subscription["displayName"], resolveStorageAccountTags)
+        classifyEnd = time.perf_counter()
+        runTimes = (classifyStart - addStart, classifyEnd - classifyStart)
+        if (bestTimes == None) or (sum(runTimes) < sum(bestTimes)):
+            bestTimes = runTimes
+
+    addSeconds, classifySeconds = bestTimes
+    print(f"{arguments.records} records x {arguments.tags} tags, best of {arguments.runs} runs")
+    print(f"  addItem  : {addSeconds:.3f} sec ({addSeconds / arguments.records * 1e6:.2f} us/record)")
+    print(f"  classify : {classifySeconds:.3f} sec ({classifySeconds / arguments.records * 1e6:.2f} us/record)")
+    print(f"  total    : {addSeconds + classifySeconds:.3f} sec ({arguments.records / (addSeconds + classifySeconds):.0f} records/sec)")
+
+if __name__ == "__main__":
+    main()
@@ -6,39 +6,64 @@ import logging
 import pandas as pd
 import io
 import os
+import queue
+import threading
 from io import StringIO
 
 import azure.functions as func
 
 from ..SharedCode import common
+from ..SharedCode import httpClient
+from ..SharedCode import resourceInventory
+from ..SharedCode.resourceIdParser import parseResourceId
+from ..SharedCode import logSink
+from ..SharedCode import runMetrics
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from datetime import timedelta
 
-LogErrorOutput = ""
-LogInfoOutput = ""
+LogErrorOutput = logSink.RunLogSink()
+LogInfoOutput = logSink.RunLogSink()
 LogEnableDebug = False
 VMData = dict()
 CSVData = dict()
 CSVHeader = dict()
 ResourceIDs = dict()
+Inventory = None
+ServiceCategoryIndex = dict()
+## Resource types read by the billing passes, loaded up front when the inventory comes from Resource Graph
+InventoryResourceTypes = [
+    "Microsoft.Network/virtualNetworks",
+    "Microsoft.Compute/galleries",
+    "Microsoft.Compute/virtualMachines",
+    "Microsoft.RecoveryServices/vaults",
+    "Microsoft.Maintenance/maintenanceConfigurations"
+]
 
 def writeLog(txtInfo):
-    global LogInfoOutput
     logging.info(txtInfo)
-    LogInfoOutput += txtInfo+"\n"
+    LogInfoOutput.write(txtInfo)
 
 def writeLogDebug(txtInfo):
-    global LogInfoOutput
     if LogEnableDebug:
         logging.info("DEBUG: "+txtInfo)
-        LogInfoOutput += txtInfo+"\n"
+        LogInfoOutput.write(txtInfo)
 
 def writeLogError(txtError):
-    global LogErrorOutput
     logging.error(txtError)
-    LogErrorOutput += txtError+"\n"
+    LogErrorOutput.write(txtError)
+
+## Logs a large payload (e.g. a whole API response), only one call out of LOG_PAYLOAD_SAMPLE_EVERY is written, with the
+## first items of the payload only
+def writeLogPayload(txtInfo, payload):
+    if LogInfoOutput.samplePayload():
+        writeLog(f"{txtInfo} [{LogInfoOutput.formatPayload(payload)}]")
 
 def abortFunctionWithError(txtError):
     writeLogError(txtError)
+    # the streamed logs are complete up to the error even though the output bindings are not written
+    LogInfoOutput.flush()
+    LogErrorOutput.flush()
     raise Exception(txtError)
 
 def setCSVFileHeaderRow(billingItemCode, headerRow):
@@ -55,6 +80,7 @@ def storeCSVDataForSubscription(billingItemCode, dataRow):
     # add CSV data row
     CSVData[billingItemCode].append(dataRow)
 
+@runMetrics.measureStage
 def createAndUploadCSVFiles(customerCode, datestart_str, dateend_str,dateFIT):
     global CSVData,CSVHeader
     skipGoogleUpload = True
@@ -134,7 +160,7 @@ def createAndUploadCSVFiles(customerCode, datestart_str, dateend_str,dateFIT):
             writeLog(f"The filename of the csv is {filename} ")
             
             writeLog(f"Uploading files to Azure storage account")
-            common.writeToBlobStorage("newbilling",f"{filename}.csv",CSVoutputAgregated)
+            common.writeToBlobStorage("newbilling",f"{filename}.csv",CSVoutputAgregated,"text/csv; charset=utf-8")
         else:
             writeLog(f"The displayBillingCode of the csv is {displayBillingCode} ")
 
@@ -158,36 +184,33 @@ def createAndUploadCSVFiles(customerCode, datestart_str, dateend_str,dateFIT):
 
 def searchResourceInSubscription(subid, resourceTypeFilter, resourceTagFilter):
     resourceIdList = []
-    url = f"https://management.azure.com/subscriptions/{subid}/resources?$filter=resourceType eq '{resourceTypeFilter}'&api-version=2019-09-01"
-    resourceList = common.callREST(url,apiToken,LogEnableDebug)
-    if 'value' in resourceList:
-        if len(resourceList['value']) >0:
-            for resource in resourceList['value']:
-                if 'tags' in resource:
-                    resourceTags = dict((k.lower(), v) for k, v in resource['tags'].items())
-                    if resourceTagFilter['TagName'].lower() in resourceTags:
-                        valtag = resourceTags[resourceTagFilter['TagName'].lower()]
-                        if (valtag.lower() == resourceTagFilter['TagValue'].lower()) or (resourceTagFilter['TagValue'] == "*"):
-                            resourceIdList.append(resource["id"].lower())
+    resourceList = Inventory.getResources(subid, resourceTypeFilter)
+    if len(resourceList) >0:
+        for resource in resourceList:
+            if 'tags' in resource:
+                resourceTags = resource['tagsLower']
+                if resourceTagFilter['TagName'].lower() in resourceTags:
+                    valtag = resourceTags[resourceTagFilter['TagName'].lower()]
+                    if (valtag.lower() == resourceTagFilter['TagValue'].lower()) or (resourceTagFilter['TagValue'] == "*"):
+                        resourceIdList.append(resource["id"].lower())
     return resourceIdList
 
-def searchResourceInAllSubscriptions(resourceTypeFilter, resourceTagFilter):
+def searchResourceInAllSubscriptions(subscriptions, resourceTypeFilter, resourceTagFilter):
     resourceIdList = []
-    resp = common.callREST(f"https://management.azure.com/subscriptions?api-version=2020-01-01",apiToken,LogEnableDebug)
-    if 'value' in resp:
-        if len(resp['value']) >0:
-            for subs in resp['value']:
-                subResourceList = searchResourceInSubscription(
-                    subs['subscriptionId'], 
-                    resourceTypeFilter, 
-                    resourceTagFilter)
-                if (len(subResourceList) > 0):
-                    resourceIdList += subResourceList
+    if len(subscriptions) >0:
+        for subs in subscriptions:
+            subResourceList = searchResourceInSubscription(
+                subs['subscriptionId'], 
+                resourceTypeFilter, 
+                resourceTagFilter)
+            if (len(subResourceList) > 0):
+                resourceIdList += subResourceList
     return resourceIdList
 
-def retrievePatchSchedules():
+def retrievePatchSchedules(subscriptions):
     UpdateSchedules = []
     maintenanceConfigItems = searchResourceInAllSubscriptions(
+        subscriptions,
         "Microsoft.Maintenance/maintenanceConfigurations", 
         common.getApplicationConfigJSON("MAINTENANCE_CONFIG_TAG")
     )
@@ -199,6 +222,7 @@ def retrievePatchSchedules():
             UpdateSchedules.append(maintenanceConfigItem.split('/')[8])
     return UpdateSchedules
 
+@runMetrics.measureStage
 def processBillingForAZUCost(customerCode, subid, billingCode, currencyCode):
     setCSVFileHeaderRow(
         billingCode, 
@@ -216,10 +240,7 @@ def processBillingForAZUCost(customerCode, subid, billingCode, currencyCode):
     for resourceId, meterNames in ResourceIDs.items():
         for meterName, data in meterNames.items():
             writeLogDebug(f"[{billingCode}] Resource [{resourceId}] Meter [{meterName}] cost [{data['costcurr']:.2f}]")
-            SplitResourceId = resourceId.replace("/subscriptions/"+subid+"/providers/","")
-            SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/resourceGroups/","")
-            SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/resourcegroups/","")
-            SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/","")
+            SplitResourceId = parseResourceId(resourceId).getRelativeId(subid)
             storeCSVDataForSubscription(
                 billingCode,
                 [
@@ -234,6 +255,7 @@ def processBillingForAZUCost(customerCode, subid, billingCode, currencyCode):
                 ]
             )        
 
+@runMetrics.measureStage
 def processBillingForVM(customerCode, subid, billingCode, currencyCode):
     setCSVFileHeaderRow(
         billingCode, 
@@ -255,10 +277,7 @@ def processBillingForVM(customerCode, subid, billingCode, currencyCode):
         else:
             osname = "Unknown"
         writeLogDebug(f"[{billingCode}] Resource [{data['name']}] OS [{osname}] cost [{data['costcurr']:.2f}]")
-        SplitResourceId = resourceId.replace("/subscriptions/"+subid+"/providers/","")
-        SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/resourceGroups/","")
-        SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/resourcegroups/","")
-        SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/","")
+        SplitResourceId = parseResourceId(resourceId).getRelativeId(subid)
         storeCSVDataForSubscription(
             billingCode,
             [
@@ -272,64 +291,64 @@ def processBillingForVM(customerCode, subid, billingCode, currencyCode):
             ]
         )  
 
+@runMetrics.measureStage
 def processBillingForResourceType(customerCode, subid, billingCode, resourceTypeFilter, resourceTagFilter, headerRow, TagValueArray = None):
     setCSVFileHeaderRow(billingCode, headerRow)
-    writeLog(f"Calling REST API for subscription [{subid}] resource type [{resourceTypeFilter}]")
-    url = f"https://management.azure.com/subscriptions/{subid}/resources?$filter=resourceType eq '{resourceTypeFilter}'&api-version=2019-09-01"
-    resourceList = common.callREST(url,apiToken,LogEnableDebug)
-    if 'value' in resourceList:
-        if len(resourceList['value']) >0:
-            for resource in resourceList['value']:
-                resourceName = resource['name']
-                resourceId = resource["id"]
-                resourceGroupName = resource["id"].split("/")[4]
-
-                if (resourceTagFilter and resourceTagFilter['TagName'] != "" and resourceTagFilter['TagValue'] != ""):
-                    if resourceTagFilter['TagValue'] == "*":
-                        tagDisplayVal = f"{resourceTagFilter['TagName']}:<any value>"
-                    else:
-                        tagDisplayVal = f"{resourceTagFilter['TagName']}:{resourceTagFilter['TagValue']}"
-                    tagFound = False
-                    if 'tags' in resource:
-                        resourceTags = dict((k.lower(), v) for k, v in resource['tags'].items())
-                        if resourceTagFilter['TagName'].lower() in resourceTags:
-                            valtag = resourceTags[resourceTagFilter['TagName'].lower()]
-                            if not TagValueArray and type(TagValueArray).__name__ != 'list':
-                                if (valtag.lower() == resourceTagFilter['TagValue'].lower()) or (resourceTagFilter['TagValue'] == "*"):
-                                    tagFound = True
-                            else:
-                                if (valtag.lower() in TagValueArray):
-                                    tagDisplayVal = f"{resourceTagFilter['TagName']}:{valtag}"
-                                    tagFound = True                                
-
-                    if not tagFound:
-                        #writeLogDebug(f"[{billingCode}] SKIP resource [{resourceId}] because tag is invalid")
-                        continue
+    writeLog(f"Reading resources of subscription [{subid}] resource type [{resourceTypeFilter}]")
+    resourceList = Inventory.getResources(subid, resourceTypeFilter)
+    if len(resourceList) >0:
+        for resource in resourceList:
+            resourceName = resource['name']
+            resourceId = resource["id"]
+            resourceGroupName = parseResourceId(resource["id"]).resourceGroup
+
+            if (resourceTagFilter and resourceTagFilter['TagName'] != "" and resourceTagFilter['TagValue'] != ""):
+                if resourceTagFilter['TagValue'] == "*":
+                    tagDisplayVal = f"{resourceTagFilter['TagName']}:<any value>"
                 else:
-                    tagDisplayVal = "n/a"
-
-                writeLogDebug(f"[{billingCode}] Service [{resourceTypeFilter}] Resource [{resourceGroupName}\{resourceName}]")
-
-                storeCSVDataForSubscription(
-                    billingCode,
-                    [subid,resourceGroupName,resourceName,tagDisplayVal]
-                )
-
-                # if billingCode == "SPOKES":
-                #     storeCSVDataForSubscription(
-                #         "AZU-COST:"+subid,
-                #         [
-                #             customerCode,
-                #             subid,
-                #             "Spoke",
-                #             "NoRegion",
-                #             "Spoke",
-                #             1,
-                #             "",
-                #             "Spoke"
-                #         ]
-                #     )                    
+                    tagDisplayVal = f"{resourceTagFilter['TagName']}:{resourceTagFilter['TagValue']}"
+                tagFound = False
+                if 'tags' in resource:
+                    resourceTags = resource['tagsLower']
+                    if resourceTagFilter['TagName'].lower() in resourceTags:
+                        valtag = resourceTags[resourceTagFilter['TagName'].lower()]
+                        if not TagValueArray and type(TagValueArray).__name__ != 'list':
+                            if (valtag.lower() == resourceTagFilter['TagValue'].lower()) or (resourceTagFilter['TagValue'] == "*"):
+                                tagFound = True
+                        else:
+                            if (valtag.lower() in TagValueArray):
+                                tagDisplayVal = f"{resourceTagFilter['TagName']}:{valtag}"
+                                tagFound = True                                
+
+                if not tagFound:
+                    #writeLogDebug(f"[{billingCode}] SKIP resource [{resourceId}] because tag is invalid")
+                    continue
+            else:
+                tagDisplayVal = "n/a"
 
+            writeLogDebug(f"[{billingCode}] Service [{resourceTypeFilter}] Resource [{resourceGroupName}\{resourceName}]")
+
+            storeCSVDataForSubscription(
+                billingCode,
+                [subid,resourceGroupName,resourceName,tagDisplayVal]
+            )
+
+            # if billingCode == "SPOKES":
+            #     storeCSVDataForSubscription(
+            #         "AZU-COST:"+subid,
+            #         [
+            #             customerCode,
+            #             subid,
+            #             "Spoke",
+            #             "NoRegion",
+            #             "Spoke",
+            #             1,
+            #             "",
+            #             "Spoke"
+            #         ]
+            #     )                    
+
+@runMetrics.measureStage
 def processBillingForCustomPolicies(subid, billingCode, resourceTypeFilter, resourceTagFilter, headerRow):
     setCSVFileHeaderRow(billingCode, headerRow)    
     writeLog(f"Calling REST API for subscription [{subid}] resource type [{resourceTypeFilter}]")
@@ -360,6 +379,7 @@ def processBillingForCustomPolicies(subid, billingCode, resourceTypeFilter, reso
                         [subid,policyName]
                     )
 
+@runMetrics.measureStage
 def processBillingForVMBackup(subid, billingCode, VMresourceTagFilter, RVresourceTagFilter, headerRow):
     setCSVFileHeaderRow(billingCode, headerRow)
     VMWithBackupTagsList = searchResourceInSubscription(
@@ -376,14 +396,14 @@ def processBillingForVMBackup(subid, billingCode, VMresourceTagFilter, RVresourc
             if 'value' in resp:
                 if len(resp['value']) >0:
                     for backupItems in resp['value']:
-                        vaultName = backupItems['id'].split("/")[8]
+                        vaultName = parseResourceId(backupItems['id']).name
                         prop = backupItems['properties']
                         if (prop['workloadType'] == "VM"):
                             VMResourceId = prop['virtualMachineId']
                             backupPolicyName = prop['policyName']
                             if (VMResourceId.lower() in VMWithBackupTagsList):
-                                VMName = prop['virtualMachineId'].split("/")[8]
-                                VMresourceGroupName = prop['virtualMachineId'].split("/")[4]
+                                VMName = parseResourceId(prop['virtualMachineId']).name
+                                VMresourceGroupName = parseResourceId(prop['virtualMachineId']).resourceGroup
                                 tagDisplayVal = f"{tagPrefix}Backup:{backupPolicyName}"
                                 writeLogDebug(f"[{billingCode}] Resource [{VMresourceGroupName}\{VMName}] Vault [{vaultName}] Backup policy [{backupPolicyName}]")
 
@@ -398,16 +418,94 @@ def processBillingForVMBackup(subid, billingCode, VMresourceTagFilter, RVresourc
     else:
         writeLogError(f"No ELZ recovery vaults found in subscription [{subid}]")
 
+def getUsageDetailsUrl(subid, dtstart, dtend):
+    return f"https://management.azure.com/subscriptions/{subid}/providers/Microsoft.Consumption/usageDetails?api-version=2019-10-01&startDate={dtstart}&endDate={dtend}&metric=actualcost&$expand=meterDetails"
+
+## Splits the billing period in windows of one day or one week (app setting FIT_USAGE_SHARDING = "day" or "week").
+## Returns the (start, end) of every window in period order, or the whole period when sharding is not enabled.
+def getUsageWindows(dtstart, dtend):
+    shardingMode = os.environ["FIT_USAGE_SHARDING"].lower() if "FIT_USAGE_SHARDING" in os.environ else ""
+    if shardingMode == "day":
+        windowDays = 1
+    elif shardingMode == "week":
+        windowDays = 7
+    else:
+        return [(dtstart, dtend)]
+    windowStart = datetime.datetime.strptime(dtstart[:10], "%Y-%m-%d")
+    periodEnd = datetime.datetime.strptime(dtend[:10], "%Y-%m-%d")
+    usageWindows = []
+    while windowStart <= periodEnd:
+        windowEnd = min(windowStart + timedelta(days=windowDays - 1), periodEnd)
+        usageWindows.append((windowStart.strftime("%Y-%m-%d")+"T00:00:00Z", windowEnd.strftime("%Y-%m-%d")+"T23:59:00Z"))
+        windowStart = windowEnd + timedelta(days=1)
+    return usageWindows
+
+## Returns the usage detail pages of the subscription for the billing period. When the period is split in windows, the
+## windows are fetched in parallel (FIT_USAGE_SHARD_WORKERS) and their pages are returned in period order, so the totals
+## are added in the same order on every run whatever window finishes first. At most FIT_USAGE_SHARD_WORKERS windows are
+## read at once, the next window is started when the oldest one is returned. Every window streams its pages through a
+## queue and reads at most USAGE_PAGE_PREFETCH_DEPTH pages (at least 1) ahead of the page being processed, so only a few
+## pages per window are held in memory and not whole windows.
+def iterateUsagePages(subid, dtstart, dtend):
+    usageWindows = getUsageWindows(dtstart, dtend)
+    if len(usageWindows) == 1:
+        billingAPIurl = getUsageDetailsUrl(subid, dtstart, dtend)
+        writeLog(f"The billingAPIurl is [{billingAPIurl}]")
+        for usagedetails in common.iterateRESTPages(billingAPIurl,apiToken,LogEnableDebug):
+            yield usagedetails
+        return
+
+    shardWorkers = max(common.getApplicationConfigInt("FIT_USAGE_SHARD_WORKERS", 4), 1)
+    pagesAhead = max(common.getApplicationConfigInt("USAGE_PAGE_PREFETCH_DEPTH", 1), 1)
+    writeLog(f"Reading the usage details of subscription [{subid}] in {len(usageWindows)} windows with {shardWorkers} parallel workers")
+    stopReading = threading.Event()
+
+    # the windows are fetched in parallel already, so each one reads its pages without prefetch thread. A page takes a
+    # slot that is given back once the page is processed.
+    def readWindow(usageWindow, pageQueue, pageSlots):
+        try:
+            for usagedetails in common.iterateRESTPages(getUsageDetailsUrl(subid, usageWindow[0], usageWindow[1]),apiToken,LogEnableDebug,0):
+                pageQueue.put((usagedetails, None))
+                pageSlots.acquire()
+                if stopReading.is_set():
+                    return
+            pageQueue.put((None, None))
+        except Exception as e:
+            pageQueue.put((None, e))
+
+    readWindow = runMetrics.bindRun(readWindow)
+    pendingWindows = deque()
+    with ThreadPoolExecutor(max_workers=shardWorkers) as executor:
+        try:
+            nextWindow = 0
+            while (nextWindow < len(usageWindows)) or (len(pendingWindows) > 0):
+                while (nextWindow < len(usageWindows)) and (len(pendingWindows) < shardWorkers):
+                    pageQueue = queue.Queue()
+                    pageSlots = threading.Semaphore(pagesAhead)
+                    executor.submit(readWindow, usageWindows[nextWindow], pageQueue, pageSlots)
+                    pendingWindows.append((usageWindows[nextWindow], pageQueue, pageSlots))
+                    nextWindow += 1
+                usageWindow, pageQueue, pageSlots = pendingWindows[0]
+                nbPages = 0
+                while True:
+                    usagedetails, error = pageQueue.get()
+                    if error != None:
+                        raise error
+                    if usagedetails == None:
+                        break
+                    nbPages += 1
+                    yield usagedetails
+                    pageSlots.release()
+                pendingWindows.popleft()
+                writeLogDebug(f"Usage window [{usageWindow[0]}] to [{usageWindow[1]}] of subscription [{subid}] : {nbPages} page(s)")
+        finally:
+            # Also reached when the caller stops iterating early or a window failed, unblock the readers so they can end
+            stopReading.set()
+            for usageWindow, pageQueue, pageSlots in pendingWindows:
+                pageSlots.release()
+
 def getServiceCategory(serviceType):
-    getServiceCategory = None
-    if len(serviceSplitData) > 0:
-        for serviceEntry in serviceSplitData[0]:
-            #writeLogError(f"No ELZ recovery vaults found in subscription [{serviceEntry}]")
-            ServiceCategoryName = serviceEntry['ServiceCategoryName']
-            Providers = serviceEntry['Providers']
-            if serviceType.lower() in (item.lower() for item in Providers):
-                getServiceCategory = ServiceCategoryName
-    return getServiceCategory
+    return ServiceCategoryIndex.get(serviceType.lower())
 
 def formatNumber(floatNum):
     numValue = round(floatNum,6)
@@ -428,13 +526,19 @@ def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.
     ## MAIN SCRIPT
     ##
 
+    # Declaring variables
+    global LogInfoOutput, LogErrorOutput
+    # new logs for every run, the worker process keeps the module between runs
+    LogInfoOutput = logSink.createRunLogSink("billingUploadFIT", "info")
+    LogErrorOutput = logSink.createRunLogSink("billingUploadFIT", "error")
+    functionMetrics = runMetrics.startRun("billingUploadFIT")
+
     if mytimer.past_due:
         writeLog('The timer is past due!')
 
     writeLog("Billing function started")
 
-    # Declaring variables
-    global LogEnableDebug, VMData, ResourceIDs, apiToken, serviceSplitData, BillingCustomerCode, tagPrefix
+    global LogEnableDebug, VMData, ResourceIDs, apiToken, serviceSplitData, ServiceCategoryIndex, BillingCustomerCode, tagPrefix, Inventory
     if (("LOG_LEVEL" in os.environ) and (os.environ["LOG_LEVEL"] == "DEBUG")):
         LogEnableDebug = True
     utc_timestamp = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat()    
@@ -512,6 +616,7 @@ def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.
 
     
     serviceSplitData = common.getApplicationConfigJSON("SERVICES_SPLIT_DATA")
+    ServiceCategoryIndex = common.getServiceCategoryIndex(serviceSplitData)
     serviceProviderManagedTag = common.getApplicationConfigJSON("VM_COMPL_TAG")
     VirtualMachineOSVersionTag = common.getApplicationConfigJSON("VM_OSVERSION_TAG")
 
@@ -525,15 +630,22 @@ def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.
     else:
         apiToken = common.getTokenFromManage('https://management.azure.com/')
 
+    resp = common.callREST(f"https://management.azure.com/subscriptions?api-version=2020-01-01",apiToken,LogEnableDebug)
+    subscriptions = resp['value'] if 'value' in resp else []
+
+    # Resources are read from ARM per subscription and type, or loaded at once from Resource Graph
+    Inventory = resourceInventory.ResourceInventory(apiToken, LogEnableDebug)
+    if resourceInventory.getInventoryBackend() == "graph":
+        Inventory.loadFromResourceGraph([subs['subscriptionId'] for subs in subscriptions], InventoryResourceTypes)
+
     # Search for the ELZ unique Automation account in CUST MGMT and retrieve the update schedules
-    UpdateSchedules = retrievePatchSchedules()
+    UpdateSchedules = retrievePatchSchedules(subscriptions)
 
     ##
     ## Customer subscriptions MAIN LOOP
     ##
 
     if dtstart != None and dtend != None:
-        resp = common.callREST(f"https://management.azure.com/subscriptions?api-version=2020-01-01",apiToken,LogEnableDebug)
         if 'statuscode' not in resp:
             if 'value' in resp:
                 if len(resp['value']) >0:
@@ -546,6 +658,7 @@ def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.
                         ResourceIDs = dict()
                         ServiceCost = dict()
                         SubsTotalCost = 0
+                        subscriptionStart = time.monotonic()
 
                         writeLog(f"Connecting to subscription [{subname}] ({subid})")
 
@@ -554,24 +667,17 @@ def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.
                         ##
 
                         
-                        billingAPIurl = f"https://management.azure.com/subscriptions/{subid}/providers/Microsoft.Consumption/usageDetails?api-version=2019-10-01&startDate={dtstart}&endDate={dtend}&metric=actualcost&$expand=meterDetails"
+                        writeLog(f"Calling REST API for Usage detail for subscription [{subid}]")
 
-                        while (billingAPIurl != None):
-                            writeLog(f"Calling REST API for Usage detail for subscription [{subid}]")  
-                            writeLog(f"The billingAPIurl is [{billingAPIurl}]")          
+                        # the pager follows the nextLink of every page and already fetches the next page while this one is processed,
+                        # with FIT_USAGE_SHARDING the period is split in day or week windows that are fetched in parallel
+                        for usagedetails in iterateUsagePages(subid, dtstart, dtend):
 
-                            usagedetails = common.callREST(billingAPIurl,apiToken,LogEnableDebug)
-
-                            writeLog(f"The usagedetails response is [{usagedetails}]")  
-
-                            # handle paging in API answer
-                            if 'nextLink' in usagedetails:
-                                billingAPIurl = usagedetails['nextLink']
-                            else:
-                                billingAPIurl = None
+                            writeLogPayload("The usagedetails response is", usagedetails)
 
                             # process billing resource item
                             if 'value' in usagedetails:
+                                runMetrics.addUsageRecords(subid, len(usagedetails['value']))
                                 if len(usagedetails['value']) >0:
                                     for val in usagedetails['value']:
                                         if 'properties' in val:
@@ -598,13 +704,14 @@ def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.
                                                 resourceId = prop['resourceId'].lower()
                                                 currencyCode = prop['billingCurrency']
                                                 currencyCostProperty = 'cost'
-                                            if len(resourceId.split("/")) >= 4: 
-                                                resourceGroupName = resourceId.split("/")[4]
+                                            parsedResourceId = parseResourceId(resourceId)
+                                            if parsedResourceId.resourceGroup != None:
+                                                resourceGroupName = parsedResourceId.resourceGroup
                                             else:
                                                 resourceGroupName = "n/a"
-                                            if len(resourceId.split("/")) >= 8: 
-                                                resourceName = resourceId.split("/")[8]
-                                                resourceType = resourceId.split("/")[6]+"/"+resourceId.split("/")[7]
+                                            if parsedResourceId.name != None:
+                                                resourceName = parsedResourceId.name
+                                                resourceType = parsedResourceId.resourceType
                                             else:
                                                 resourceName = ""
                                                 resourceType = prop['consumedService']
@@ -755,6 +862,8 @@ def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.
                                 )
                                 writeLogDebug(f"[SVC] Total cost for Service [{ServiceCategoryName}] for subscription is [{SvcTotalCost} {currencyCode}]")
 
+                        runMetrics.recordStage("usageDetails", subid, time.monotonic() - subscriptionStart)
+
                         ##
                         ## AZU-COST (CloudDB)
                         ##
@@ -849,6 +958,7 @@ def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.
                             "AZU-OS:"+subid,
                             [customerCode,subid,"Heartbeat","Heartbeat","Heartbeat",0,"USD"]
                         )  
+                        runMetrics.recordStage("processSubscription", subid, time.monotonic() - subscriptionStart)
                 # Generate all CSV files and upload them
                 createAndUploadCSVFiles(customerCode,datestart_str,dateend_str,fitDate)
     else:
@@ -857,7 +967,14 @@ def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.
     # Finish function
     timeScriptEnd = time.time()
     timeScripTotal = (timeScriptEnd - timeScriptStart)
+    for poolStatisticsLine in httpClient.getPoolStatisticsLogLines():
+        writeLog(poolStatisticsLine)
     writeLog(f"Billing function completed. Elapsed time {round(timeScripTotal,1)} sec")
-    errorOutput.set(LogErrorOutput)
-    infoOutput.set(LogInfoOutput)
+    metricsBlobName = runMetrics.writeRunMetrics(functionMetrics)
+    if metricsBlobName != None:
+        writeLog(f"The metrics of the run are in [{metricsBlobName}]")
+    LogInfoOutput.flush()
+    LogErrorOutput.flush()
+    errorOutput.set(LogErrorOutput.getTail())
+    infoOutput.set(LogInfoOutput.getTail())
     logging.info('Python timer trigger function ran at %s ', utc_timestamp)
@@ -10,52 +10,58 @@ import os
 import azure.functions as func
 
 from ..SharedCode import common
+from ..SharedCode import httpClient
+from ..SharedCode.billingResult import BillingResult
+from ..SharedCode import billingRowStore
+from ..SharedCode import resourceInventory
+from ..SharedCode.resourceIdParser import parseResourceId
+from ..SharedCode import usageEngine
+from ..SharedCode import usageCheckpoints
+from ..SharedCode import logSink
+from ..SharedCode import runMetrics
+from ..SharedCode import googleUploader
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
-LogErrorOutput = ""
-LogInfoOutput = ""
+LogErrorOutput = logSink.RunLogSink()
+LogInfoOutput = logSink.RunLogSink()
 LogEnableDebug = False
-VMData = dict()
-CSVData = dict()
-CSVHeader = dict()
-ResourceIDs = dict()
+Inventory = None
+Checkpoints = None
+ServiceCategoryIndex = dict()
+## Resource types read by the billing passes, loaded up front when the inventory comes from Resource Graph
+InventoryResourceTypes = [
+    "Microsoft.Network/virtualNetworks",
+    "Microsoft.Compute/galleries",
+    "Microsoft.Compute/virtualMachines",
+    "Microsoft.RecoveryServices/vaults",
+    "Microsoft.Maintenance/maintenanceConfigurations",
+    "Microsoft.Storage/storageAccounts"
+]
 
 def writeLog(txtInfo):
-    global LogInfoOutput
     logging.info(txtInfo)
-    LogInfoOutput += txtInfo+"\n"
+    LogInfoOutput.write(txtInfo)
 
 def writeLogDebug(txtInfo):
-    global LogInfoOutput
     if LogEnableDebug:
         logging.info("DEBUG: "+txtInfo)
-        LogInfoOutput += txtInfo+"\n"
+        LogInfoOutput.write(txtInfo)
 
 def writeLogError(txtError):
-    global LogErrorOutput
     logging.error(txtError)
-    LogErrorOutput += txtError+"\n"
+    LogErrorOutput.write(txtError)
 
 def abortFunctionWithError(txtError):
     writeLogError(txtError)
+    # the streamed logs are complete up to the error even though the output bindings are not written
+    LogInfoOutput.flush()
+    LogErrorOutput.flush()
     raise Exception(txtError)
 
-def setCSVFileHeaderRow(billingItemCode, headerRow):
-    global CSVHeader
-    billingItemCode = billingItemCode.upper()
-    CSVHeader[billingItemCode] = headerRow
-
-def storeCSVDataForSubscription(billingItemCode, dataRow):
-    global CSVData
-    billingItemCode = billingItemCode.upper()
-    # init array the first time
-    if billingItemCode not in CSVData:
-        CSVData[billingItemCode] = []
-    # add CSV data row
-    CSVData[billingItemCode].append(dataRow)
-
-def createAndUploadCSVFiles(customerCode, utc_timestamp, datestart_str, dateend_str):
-    global CSVData,CSVHeader
+@runMetrics.measureStage
+def createAndUploadCSVFiles(billingResult, customerCode, utc_timestamp, datestart_str, dateend_str):
+    CSVHeader = billingResult.CSVHeader
 
     if not BillingCustomerCode:
         writeLogError(f"The Billing customer name is no configured ! skipping Google upload part")
@@ -67,6 +73,18 @@ def createAndUploadCSVFiles(customerCode, utc_timestamp, datestart_str, dateend_
         else:
             skipGoogleUpload = False
 
+    # the Google credentials and client are created once for all the uploads of the run
+    uploader = None
+    if not skipGoogleUpload:
+        try:
+            uploader = googleUploader.GoogleUploader(common.GoogleBucketName, common.GoogleBucketKey)
+        except Exception as e:
+            abortFunctionWithError(f"The Google bucket client could not be created : {e}")
+
+    # the ALL file is written as CSV, Parquet or both (ALL_FILE_FORMAT)
+    allFileFormats = getAllFileFormats()
+
+    uploads = []
     for billingItemCode in CSVHeader.keys():
 
         #debug
@@ -87,8 +105,6 @@ def createAndUploadCSVFiles(customerCode, utc_timestamp, datestart_str, dateend_
 
         CountryCode = common.getBillingCountryCode()
         productCode = common.getProductCode()
-        if billingItemCode not in CSVData:
-            CSVData[billingItemCode] = []
         dateonfile = utc_timestamp.strftime("%Y%m%d")
         nenamingtime = utc_timestamp.strftime("%H%M%S")
 
@@ -99,63 +115,145 @@ def createAndUploadCSVFiles(customerCode, utc_timestamp, datestart_str, dateend_
         else:
             filename = f"DATA_{productCode}_AZU_{customerStr}_{CountryCode}_GLB_{productCode}_{displayBillingCode}_MSB-AZURE-FUNCTION_{dateonfile}_{nenamingtime}"
 
-        writeLog(f"Generating CSV file [{filename}.csv]")
-        df = pd.DataFrame (CSVData[billingItemCode] , columns = CSVHeader[billingItemCode])
-        CSVoutput = df.to_csv(index=False,encoding = "utf-8")
-
-        #upload to azure
-        writeLog(f"Uploading files to Azure storage account")
-        common.writeToBlobStorage("billing-output",f"{filename}.csv",CSVoutput)
-        if common.getLastErrorMessage():
-            abortFunctionWithError(common.getLastErrorMessage())
-
-        #upload to google
-        if not skipGoogleUpload and (displayBillingCode in ["AZU-COST","AZU-OS"]) :
-            writeLog(f"Uploading files to Google account")
-            ctrstr = f"<?xml version=\"1.0\"?><collector><source version=\"1.0\" name=\"{productCode}_{displayBillingCode}\"/></collector>"
-            UploadStatus = common.uploadToGoogle(f"{filename}.csv",CSVoutput)
-            if UploadStatus['success']:
-                writeLog(UploadStatus['message'])
-            else:
-                abortFunctionWithError(UploadStatus['message'])
-            UploadStatus = common.uploadToGoogle(f"{filename.replace('DATA_','CTRL_')}.xml",ctrstr)
+        uploads.append((billingItemCode, displayBillingCode, filename, allFileFormats if billingItemCode == "ALL" else ["csv"]))
+
+    # the files are rendered and uploaded in parallel (BLOB_UPLOAD_WORKERS), the log lines and errors are reported in file order
+    failedFiles = []
+    skippedUploads = []
+    uploadWorkers = max(common.getApplicationConfigInt("BLOB_UPLOAD_WORKERS", 8), 1)
+    with ThreadPoolExecutor(max_workers=uploadWorkers) as executor:
+        uploadResults = executor.map(
+            runMetrics.bindRun(lambda upload: uploadCSVFile(billingResult, upload[0], upload[1], upload[2], uploader, upload[3])),
+            uploads)
+        for (billingItemCode, displayBillingCode, filename, fileFormats), (logLines, errorMessage, fileSkippedUploads) in zip(uploads, uploadResults):
+            for logLine in logLines:
+                writeLog(logLine)
+            skippedUploads += fileSkippedUploads
+            if errorMessage != None:
+                writeLogError(f"The file [{filename}.{fileFormats[0]}] could not be uploaded : {errorMessage}")
+                failedFiles.append(filename)
+
+    if common.getApplicationConfigInt("UPLOAD_SKIP_UNCHANGED", 0) == 1:
+        writeLog(f"{len(skippedUploads)} uploads of unchanged files were skipped, {sum(skippedUploads)} bytes not sent again")
+
+    if len(failedFiles) > 0:
+        abortFunctionWithError(f"{len(failedFiles)} of {len(uploads)} billing files could not be uploaded")
+
+## Returns the formats of the ALL file from the app setting ALL_FILE_FORMAT: csv (default), parquet or both.
+## Parquet needs the pyarrow package, without it the ALL file is written as CSV.
+def getAllFileFormats():
+    allFileFormat = os.environ["ALL_FILE_FORMAT"].lower() if "ALL_FILE_FORMAT" in os.environ else "csv"
+    allFileFormats = {"csv": ["csv"], "parquet": ["parquet"], "both": ["csv", "parquet"]}.get(allFileFormat)
+    if allFileFormats == None:
+        writeLogError(f"Unknown ALL_FILE_FORMAT [{allFileFormat}], the ALL file is written as CSV")
+        return ["csv"]
+    if ("parquet" in allFileFormats) and (billingRowStore.pa == None):
+        writeLogError(f"The pyarrow package is not installed, the ALL file is written as CSV")
+        return ["csv"]
+    return allFileFormats
+
+## Uploads the file of one billing code to the storage account in the given formats (csv and/or parquet), and to Google for
+## the AZU-COST and AZU-OS files (when uploader is not None). Runs in a worker thread: returns the lines to log, the
+## error message (None when the file was uploaded) and the sizes of the uploads skipped because the content was unchanged.
+def uploadCSVFile(billingResult, billingItemCode, displayBillingCode, filename, uploader, fileFormats):
+    logLines = []
+    skippedUploads = []
+
+    #upload to azure, the CSV text is rendered and uploaded in chunks so the whole file is never held in memory
+    if "csv" in fileFormats:
+        logLines.append(f"Generating CSV file [{filename}.csv]")
+        logLines.append(f"Uploading files to Azure storage account")
+        try:
+            uploaded, nbBytes = common.uploadChunksIfChanged("billing-output",f"{filename}.csv",lambda: billingResult.iterCSVChunks(billingItemCode))
+        except Exception as e:
+            return logLines, f"Azure storage upload error : {e}", skippedUploads
+        if not uploaded:
+            logLines.append(f"File [{filename}.csv] is unchanged in the storage account, not uploaded again")
+            skippedUploads.append(nbBytes)
+
+    #the Parquet file is built from the row store directly, with typed columns and one row group per subscription
+    if "parquet" in fileFormats:
+        logLines.append(f"Generating Parquet file [{filename}.parquet]")
+        try:
+            parquetData = billingResult.getParquetData(billingItemCode)
+            uploaded, nbBytes = common.uploadChunksIfChanged("billing-output",f"{filename}.parquet",lambda: [parquetData],"application/vnd.apache.parquet",compress=False)
+        except Exception as e:
+            return logLines, f"Parquet file upload error : {e}", skippedUploads
+        if not uploaded:
+            logLines.append(f"File [{filename}.parquet] is unchanged in the storage account, not uploaded again")
+            skippedUploads.append(nbBytes)
+
+    #upload to google, the CTRL file follows its DATA file
+    if (uploader != None) and (displayBillingCode in ["AZU-COST","AZU-OS"]) :
+        logLines.append(f"Uploading files to Google account")
+        productCode = common.getProductCode()
+        CSVoutput = "".join(billingResult.iterCSVChunks(billingItemCode))
+        ctrstr = f"<?xml version=\"1.0\"?><collector><source version=\"1.0\" name=\"{productCode}_{displayBillingCode}\"/></collector>"
+        for UploadStatus in uploader.uploadWithControlFile(f"{filename}.csv",CSVoutput,f"{filename.replace('DATA_','CTRL_')}.xml",ctrstr):
             if UploadStatus['success']:
-                writeLog(UploadStatus['message'])
+                logLines.append(UploadStatus['message'])
+                if UploadStatus['skipped']:
+                    skippedUploads.append(UploadStatus['bytes'])
             else:
-                abortFunctionWithError(UploadStatus['message'])
+                return logLines, UploadStatus['message'], skippedUploads
+
+    return logLines, None, skippedUploads
 
 def searchResourceInSubscription(subid, resourceTypeFilter, resourceTagFilter):
     resourceIdList = []
-    url = f"https://management.azure.com/subscriptions/{subid}/resources?$filter=resourceType eq '{resourceTypeFilter}'&api-version=2019-09-01"
-    resourceList = common.callREST(url,apiToken,LogEnableDebug)
-    if 'value' in resourceList:
-        if len(resourceList['value']) >0:
-            for resource in resourceList['value']:
-                if 'tags' in resource:
-                    resourceTags = dict((k.lower(), v) for k, v in resource['tags'].items())
-                    if resourceTagFilter['TagName'].lower() in resourceTags:
-                        valtag = resourceTags[resourceTagFilter['TagName'].lower()]
-                        if (valtag.lower() == resourceTagFilter['TagValue'].lower()) or (resourceTagFilter['TagValue'] == "*"):
-                            resourceIdList.append(resource["id"].lower())
+    resourceList = Inventory.getResources(subid, resourceTypeFilter)
+    if len(resourceList) >0:
+        for resource in resourceList:
+            if 'tags' in resource:
+                resourceTags = resource['tagsLower']
+                if resourceTagFilter['TagName'].lower() in resourceTags:
+                    valtag = resourceTags[resourceTagFilter['TagName'].lower()]
+                    if (valtag.lower() == resourceTagFilter['TagValue'].lower()) or (resourceTagFilter['TagValue'] == "*"):
+                        resourceIdList.append(resource["id"].lower())
     return resourceIdList
 
-def searchResourceInAllSubscriptions(resourceTypeFilter, resourceTagFilter):
+## Returns the tags (lowercase names) of the given storage accounts of the subscription, read with one resource list for
+## the subscription (or from the Resource Graph inventory). Accounts that are no longer in the inventory (deleted since the
+## usage period) get the tags of their own usage record: from usageAccountTags when it was in the usage pages, otherwise
+## from the usage details filtered on the account. The storage accounts that are not found at all are left out.
+def resolveStorageAccountTags(subid, storageAccountIds, usageAccountTags):
+    storageAccountTags = dict()
+    Inventory.getResources(subid, "Microsoft.Storage/storageAccounts")
+    for storageAccountId in storageAccountIds:
+        storageAccount = Inventory.getResource(storageAccountId)
+        if storageAccount != None:
+            storageAccountTags[storageAccountId] = storageAccount['tagsLower'] if 'tags' in storageAccount else None
+        elif storageAccountId in usageAccountTags:
+            storageAccountTags[storageAccountId] = usageAccountTags[storageAccountId]
+        else:
+            storageUsageUrl = getUsageDetailsUrl(subid, dtstart, dtend, dtstart2, dtend2) + f"%20and%20resourceId%20eq%20'{storageAccountId}'"
+            storageUsageDetails = common.callREST(storageUsageUrl,apiToken,LogEnableDebug)
+            if ('value' not in storageUsageDetails) or (len(storageUsageDetails['value']) == 0) or ('properties' not in storageUsageDetails['value'][0]):
+                continue
+            storageUsageItem = storageUsageDetails['value'][0]
+            if 'tags' in storageUsageItem and storageUsageItem['tags']!=None:
+                storageAccountTags[storageAccountId] = dict((k.lower(), v) for k, v in storageUsageItem['tags'].items())
+            else:
+                storageAccountTags[storageAccountId] = None
+        writeLogDebug(f"STORAGE ACCOUNT : Retrieved tags for [{storageAccountId}]")
+    return storageAccountTags
+
+def searchResourceInAllSubscriptions(subscriptions, resourceTypeFilter, resourceTagFilter):
     resourceIdList = []
-    resp = common.callREST(f"https://management.azure.com/subscriptions?api-version=2020-01-01",apiToken,LogEnableDebug)
-    if 'value' in resp:
-        if len(resp['value']) >0:
-            for subs in resp['value']:
-                subResourceList = searchResourceInSubscription(
-                    subs['subscriptionId'], 
-                    resourceTypeFilter, 
-                    resourceTagFilter)
-                if (len(subResourceList) > 0):
-                    resourceIdList += subResourceList
+    if len(subscriptions) >0:
+        for subs in subscriptions:
+            subResourceList = searchResourceInSubscription(
+                subs['subscriptionId'], 
+                resourceTypeFilter, 
+                resourceTagFilter)
+            if (len(subResourceList) > 0):
+                resourceIdList += subResourceList
     return resourceIdList
 
-def retrievePatchSchedules():
+def retrievePatchSchedules(subscriptions):
     UpdateSchedules = []
     maintenanceConfigItems = searchResourceInAllSubscriptions(
+        subscriptions,
         "Microsoft.Maintenance/maintenanceConfigurations", 
         common.getApplicationConfigJSON("MAINTENANCE_CONFIG_TAG")
     )
@@ -167,8 +265,9 @@ def retrievePatchSchedules():
             UpdateSchedules.append(maintenanceConfigItem.split('/')[8])
     return UpdateSchedules
 
-def processBillingForAZUCost(customerCode, subid, billingCode, currencyCode):
-    setCSVFileHeaderRow(
+@runMetrics.measureStage
+def processBillingForAZUCost(billingResult, customerCode, subid, billingCode, currencyCode):
+    billingResult.setCSVFileHeaderRow(
         billingCode, 
         [
             "Customer",
@@ -181,14 +280,11 @@ def processBillingForAZUCost(customerCode, subid, billingCode, currencyCode):
             "InstanceID"
         ]
     )
-    for resourceId, meterNames in ResourceIDs.items():
+    for resourceId, meterNames in billingResult.ResourceIDs.items():
         for meterName, data in meterNames.items():
             writeLogDebug(f"[{billingCode}] Resource [{resourceId}] Meter [{meterName}] cost [{data['costcurr']:.2f}]")
-            SplitResourceId = resourceId.replace("/subscriptions/"+subid+"/providers/","")
-            SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/resourceGroups/","")
-            SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/resourcegroups/","")
-            SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/","")
-            storeCSVDataForSubscription(
+            SplitResourceId = parseResourceId(resourceId).getRelativeId(subid)
+            billingResult.storeCSVDataForSubscription(
                 billingCode,
                 [
                     customerCode,
@@ -196,14 +292,15 @@ def processBillingForAZUCost(customerCode, subid, billingCode, currencyCode):
                     meterName,
                     data['location'],
                     data['svccategory'],
-                    formatNumber(data['costcurr']),
+                    float(data['costcurr']),
                     currencyCode,
                     SplitResourceId
                 ]
             )        
 
-def processBillingForVM(customerCode, subid, billingCode, currencyCode):
-    setCSVFileHeaderRow(
+@runMetrics.measureStage
+def processBillingForVM(billingResult, customerCode, subid, billingCode, currencyCode):
+    billingResult.setCSVFileHeaderRow(
         billingCode, 
         [
             "Customer",
@@ -215,7 +312,7 @@ def processBillingForVM(customerCode, subid, billingCode, currencyCode):
             "Currency"
         ]        
     )    
-    for resourceId, data in VMData.items():
+    for resourceId, data in billingResult.VMData.items():
         if "windows" in data['osversion'].lower():
             osname = "Windows"
         elif data['osversion'] != "Unknown":
@@ -223,11 +320,8 @@ def processBillingForVM(customerCode, subid, billingCode, currencyCode):
         else:
             osname = "Unknown"
         writeLogDebug(f"[{billingCode}] Resource [{data['name']}] OS [{osname}] cost [{data['costcurr']:.2f}]")
-        SplitResourceId = resourceId.replace("/subscriptions/"+subid+"/providers/","")
-        SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/resourceGroups/","")
-        SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/resourcegroups/","")
-        SplitResourceId = SplitResourceId.replace("/subscriptions/"+subid+"/","")
-        storeCSVDataForSubscription(
+        SplitResourceId = parseResourceId(resourceId).getRelativeId(subid)
+        billingResult.storeCSVDataForSubscription(
             billingCode,
             [
                 customerCode,
@@ -235,71 +329,71 @@ def processBillingForVM(customerCode, subid, billingCode, currencyCode):
                 SplitResourceId,
                 data['name'],
                 osname,
-                formatNumber(data['costcurr']),
+                float(data['costcurr']),
                 currencyCode
             ]
         )  
 
-def processBillingForResourceType(customerCode, subid, billingCode, resourceTypeFilter, resourceTagFilter, headerRow, TagValueArray = None):
-    setCSVFileHeaderRow(billingCode, headerRow)
-    writeLog(f"Calling REST API for subscription [{subid}] resource type [{resourceTypeFilter}]")
-    url = f"https://management.azure.com/subscriptions/{subid}/resources?$filter=resourceType eq '{resourceTypeFilter}'&api-version=2019-09-01"
-    resourceList = common.callREST(url,apiToken,LogEnableDebug)
-    if 'value' in resourceList:
-        if len(resourceList['value']) >0:
-            for resource in resourceList['value']:
-                resourceName = resource['name']
-                resourceId = resource["id"]
-                resourceGroupName = resource["id"].split("/")[4]
+@runMetrics.measureStage
+def processBillingForResourceType(billingResult, customerCode, subid, billingCode, resourceTypeFilter, resourceTagFilter, headerRow, TagValueArray = None):
+    billingResult.setCSVFileHeaderRow(billingCode, headerRow)
+    writeLog(f"Reading resources of subscription [{subid}] resource type [{resourceTypeFilter}]")
+    resourceList = Inventory.getResources(subid, resourceTypeFilter)
+    if len(resourceList) >0:
+        for resource in resourceList:
+            resourceName = resource['name']
+            resourceId = resource["id"]
+            resourceGroupName = parseResourceId(resource["id"]).resourceGroup
+
+            if (resourceTagFilter and resourceTagFilter['TagName'] != "" and resourceTagFilter['TagValue'] != ""):
+                if resourceTagFilter['TagValue'] == "*":
+                    tagDisplayVal = f"{resourceTagFilter['TagName']}:<any value>"
+                else:
+                    tagDisplayVal = f"{resourceTagFilter['TagName']}:{resourceTagFilter['TagValue']}"
+                tagFound = False
+                if 'tags' in resource:
+                    resourceTags = resource['tagsLower']
+                    if resourceTagFilter['TagName'].lower() in resourceTags:
+                        valtag = resourceTags[resourceTagFilter['TagName'].lower()]
+                        if not TagValueArray and type(TagValueArray).__name__ != 'list':
+                            if (valtag.lower() == resourceTagFilter['TagValue'].lower()) or (resourceTagFilter['TagValue'] == "*"):
+                                tagFound = True
+                        else:
+                            if (valtag.lower() in TagValueArray):
+                                tagDisplayVal = f"{resourceTagFilter['TagName']}:{valtag}"
+                                tagFound = True                                
 
-                if (resourceTagFilter and resourceTagFilter['TagName'] != "" and resourceTagFilter['TagValue'] != ""):
-                    if resourceTagFilter['TagValue'] == "*":
-                        tagDisplayVal = f"{resourceTagFilter['TagName']}:<any value>"
-                    else:
-                        tagDisplayVal = f"{resourceTagFilter['TagName']}:{resourceTagFilter['TagValue']}"
-                    tagFound = False
-                    if 'tags' in resource:
-                        resourceTags = dict((k.lower(), v) for k, v in resource['tags'].items())
-                        if resourceTagFilter['TagName'].lower() in resourceTags:
-                            valtag = resourceTags[resourceTagFilter['TagName'].lower()]
-                            if not TagValueArray and type(TagValueArray).__name__ != 'list':
-                                if (valtag.lower() == resourceTagFilter['TagValue'].lower()) or (resourceTagFilter['TagValue'] == "*"):
-                                    tagFound = True
-                            else:
-                                if (valtag.lower() in TagValueArray):
-                                    tagDisplayVal = f"{resourceTagFilter['TagName']}:{valtag}"
-                                    tagFound = True                                
+                if not tagFound:
+                    #writeLogDebug(f"[{billingCode}] SKIP resource [{resourceId}] because tag is invalid")
+                    continue
+            else:
+                tagDisplayVal = "n/a"
 
-                    if not tagFound:
-                        #writeLogDebug(f"[{billingCode}] SKIP resource [{resourceId}] because tag is invalid")
-                        continue
-                else:
-                    tagDisplayVal = "n/a"
-
-                writeLogDebug(f"[{billingCode}] Service [{resourceTypeFilter}] Resource [{resourceGroupName}\{resourceName}]")
-
-                storeCSVDataForSubscription(
-                    billingCode,
-                    [subid,resourceGroupName,resourceName,tagDisplayVal]
-                )
-
-                # if billingCode == "SPOKES":
-                #     storeCSVDataForSubscription(
-                #         "AZU-COST:"+subid,
-                #         [
-                #             customerCode,
-                #             subid,
-                #             "Spoke",
-                #             "NoRegion",
-                #             "Spoke",
-                #             1,
-                #             "",
-                #             "Spoke"
-                #         ]
-                #     )                    
-
-def processBillingForCustomPolicies(subid, billingCode, resourceTypeFilter, resourceTagFilter, headerRow):
-    setCSVFileHeaderRow(billingCode, headerRow)    
+            writeLogDebug(f"[{billingCode}] Service [{resourceTypeFilter}] Resource [{resourceGroupName}\{resourceName}]")
+
+            billingResult.storeCSVDataForSubscription(
+                billingCode,
+                [subid,resourceGroupName,resourceName,tagDisplayVal]
+            )
+
+            # if billingCode == "SPOKES":
+            #     storeCSVDataForSubscription(
+            #         "AZU-COST:"+subid,
+            #         [
+            #             customerCode,
+            #             subid,
+            #             "Spoke",
+            #             "NoRegion",
+            #             "Spoke",
+            #             1,
+            #             "",
+            #             "Spoke"
+            #         ]
+            #     )                    
+
+@runMetrics.measureStage
+def processBillingForCustomPolicies(billingResult, subid, billingCode, resourceTypeFilter, resourceTagFilter, headerRow):
+    billingResult.setCSVFileHeaderRow(billingCode, headerRow)    
     writeLog(f"Calling REST API for subscription [{subid}] resource type [{resourceTypeFilter}]")
     url = f"https://management.azure.com/subscriptions/{subid}/providers/Microsoft.Authorization/policyDefinitions?$filter=policyType eq 'Custom'&api-version=2020-09-01"
     resourceList = common.callREST(url,apiToken,LogEnableDebug)
@@ -323,13 +417,14 @@ def processBillingForCustomPolicies(subid, billingCode, resourceTypeFilter, reso
                                         
                     writeLogDebug(f"[{billingCode}] Service [{resourceTypeFilter}] Resource [{policyName}]")
 
-                    storeCSVDataForSubscription(
+                    billingResult.storeCSVDataForSubscription(
                         billingCode,
                         [subid,policyName]
                     )
 
-def processBillingForVMBackup(subid, billingCode, VMresourceTagFilter, RVresourceTagFilter, headerRow):
-    setCSVFileHeaderRow(billingCode, headerRow)
+@runMetrics.measureStage
+def processBillingForVMBackup(billingResult, subid, billingCode, VMresourceTagFilter, RVresourceTagFilter, headerRow):
+    billingResult.setCSVFileHeaderRow(billingCode, headerRow)
     VMWithBackupTagsList = searchResourceInSubscription(
         subid, 
         "Microsoft.Compute/virtualMachines", 
@@ -345,18 +440,18 @@ def processBillingForVMBackup(subid, billingCode, VMresourceTagFilter, RVresourc
             if 'value' in resp:
                 if len(resp['value']) >0:
                     for backupItems in resp['value']:
-                        vaultName = backupItems['id'].split("/")[8]
+                        vaultName = parseResourceId(backupItems['id']).name
                         prop = backupItems['properties']
                         if (prop['workloadType'] == "VM"):
                             VMResourceId = prop['virtualMachineId']
                             backupPolicyName = prop['policyName']
                             if (VMResourceId.lower() in VMWithBackupTagsList):
-                                VMName = prop['virtualMachineId'].split("/")[8]
-                                VMresourceGroupName = prop['virtualMachineId'].split("/")[4]
+                                VMName = parseResourceId(prop['virtualMachineId']).name
+                                VMresourceGroupName = parseResourceId(prop['virtualMachineId']).resourceGroup
                                 tagDisplayVal = f"{tagPrefix}Backup:{backupPolicyName}"
                                 writeLogDebug(f"[{billingCode}] Resource [{VMresourceGroupName}\{VMName}] Vault [{vaultName}] Backup policy [{backupPolicyName}]")
 
-                                storeCSVDataForSubscription(
+                                billingResult.storeCSVDataForSubscription(
                                     billingCode,
                                     [subid,VMresourceGroupName,VMName,vaultName,backupPolicyName,tagDisplayVal]
                                 )
@@ -368,39 +463,482 @@ def processBillingForVMBackup(subid, billingCode, VMresourceTagFilter, RVresourc
         writeLogError(f"No {productCode} recovery vaults found in subscription [{subid}]")
 
 def getServiceCategory(serviceType):
-    getServiceCategory = None
-    productCode = common.getProductCode()
-    if len(serviceSplitData) > 0:
-        for serviceEntry in serviceSplitData[0]:
-            #writeLogError(f"No {productCode} recovery vaults found in subscription [{serviceEntry}]")
-            ServiceCategoryName = serviceEntry['ServiceCategoryName']
-            Providers = serviceEntry['Providers']
-            if serviceType.lower() in (item.lower() for item in Providers):
-                getServiceCategory = ServiceCategoryName
-    return getServiceCategory
+    return ServiceCategoryIndex.get(serviceType.lower())
 
 def formatNumber(floatNum):
     numValue = round(floatNum,6)
     strValue = f"{numValue:.6f}"
     return strValue
 
+def getUsageDetailsUrl(subid, startDate, endDate, usageStart, usageEnd):
+    return f"https://management.azure.com/subscriptions/{subid}/providers/Microsoft.Consumption/usageDetails?api-version=2019-10-01&startDate={startDate}&endDate={endDate}&metric=actualcost&$expand=meterDetails&$filter=properties%2FusageStart%20ge%20'{usageStart}'%20and%20properties%2FusageEnd%20le%20'{usageEnd}'"
+
+## Returns the usage detail items of the billing period day by day: the settled days that were already ingested are read
+## from the checkpoints, the other days are fetched from the usage API and checkpointed. The checkpoint index of the
+## subscription is written once at the end, also when the items are not read to the end.
+def iterateCheckpointedUsageItems(subid):
+    dayStatistics = {"reused": 0, "new": 0, "changed": 0, "unchanged": 0}
+    try:
+        for day in usageCheckpoints.getDays(dtstart2, dtend2):
+            dayItems = Checkpoints.getSettledDay(subid, day)
+            if dayItems != None:
+                dayStatistics["reused"] += 1
+                for dayItem in dayItems:
+                    yield dayItem
+            else:
+                # the records are added to the checkpoint and returned while the pages are read, the day is stored at its end
+                dayCheckpoint = Checkpoints.startDay(subid, day)
+                for dayItem in common.iterateRESTValues(getUsageDetailsUrl(subid, day+"T00:00:00Z", day+"T23:59:00Z", day, day),apiToken,LogEnableDebug):
+                    dayCheckpoint.addRecord(dayItem)
+                    yield dayItem
+                dayStatus = dayCheckpoint.save()
+                dayStatistics[dayStatus] += 1
+                writeLogDebug(f"[CHECKPOINT] Subscription [{subid}] day [{day}] fetched {dayCheckpoint.nbRecords} records ({dayStatus})")
+    finally:
+        Checkpoints.saveIndex(subid)
+    writeLog(f"Usage checkpoints for subscription [{subid}] : {dayStatistics['reused']} day(s) reused, {dayStatistics['new']} new, {dayStatistics['changed']} changed, {dayStatistics['unchanged']} unchanged")
+
+def isColumnarEngineEnabled():
+    return ("USAGE_ENGINE" in os.environ) and (os.environ["USAGE_ENGINE"].lower() == "columnar")
+
+## Classifies the usage detail items of the subscription with the columnar engine (app setting USAGE_ENGINE = "columnar")
+def classifyUsageColumnar(billingResult, subid, subname, usageItems):
+    billingCurrencyFix = ""
+    if (("BillingCurrencyFix" in os.environ)):
+        billingCurrencyFix = os.environ["BillingCurrencyFix"]
+    engine = usageEngine.ColumnarUsageEngine(
+        ServiceCategoryIndex,
+        serviceProviderManagedTag,
+        serviceProviderPurposeTag,
+        VirtualMachineOSVersionTag['TagName'],
+        tagPrefix,
+        billingCurrencyFix)
+    for val in usageItems:
+        engine.addItem(val)
+    errorMessages = engine.classify(
+        billingResult,
+        subid,
+        subname,
+        lambda storageAccountIds, usageAccountTags: resolveStorageAccountTags(subid, storageAccountIds, usageAccountTags))
+    for errorMessage in errorMessages:
+        writeLogError(errorMessage)
+
+## Returns the managed tag (YES/No), the managed tag value and the purpose tag value of a resource
+def getManagedTagValues(resourceTags):
+    managedTag = "No"
+    purposeTagValue = "n/a"
+    managedTagValue = "n/a"
+    if (resourceTags != None) and (serviceProviderManagedTag['TagName'].lower() in resourceTags):
+        valtag = resourceTags[serviceProviderManagedTag['TagName'].lower()]
+        if ((valtag.lower() == serviceProviderManagedTag['TagValue'].lower()) or (valtag.lower().startswith(tagPrefix.lower()))):
+            managedTag = "YES"
+            managedTagValue = valtag
+    if (resourceTags != None) and (serviceProviderPurposeTag.lower() in resourceTags):
+        purposeTagValue = resourceTags[serviceProviderPurposeTag.lower()]
+    return managedTag, managedTagValue, purposeTagValue
+
+## Adds the cost of a usage record to its service category and to the AZU-COST resources when it is managed, returns the
+## service category of the ALL file ("None" when the cost is not counted)
+def storeManagedCost(billingResult, resourceId, meterName, resourceLocation, consumedService, valueRate, managedTag):
+    ServiceCost = billingResult.ServiceCost
+    ResourceIDs = billingResult.ResourceIDs
+
+    # Check if the resource if part of a service category and the managed TAG is present, if yes then store cost
+    writeLogDebug(f"The point of error is [{consumedService}]")
+    svcCategory = getServiceCategory(consumedService)
+    if (svcCategory) and (managedTag == "YES"):
+        if svcCategory not in ServiceCost:
+            ServiceCost[svcCategory] = 0
+        ServiceCost[svcCategory] += valueRate
+        #writeLogDebug(f"[SVC-{svcCategory}] Adding cost [{valueRate:.2f}] - TotalCost [{ServiceCost[svcCategory]:.2f}]")
+    else:
+        svcCategory = "None"
+
+    # For AZU-COST, store information and cost per resourceID/Metername for later use (None is the place kept for a
+    # storage sub-resource until its tags are known)
+    if managedTag == "YES":
+        if ResourceIDs.get(resourceId) == None:
+            ResourceIDs[resourceId] = dict()
+        else:
+            if meterName not in ResourceIDs[resourceId]:
+                ResourceIDs[resourceId][meterName] = {
+                        'costcurr': valueRate,
+                        'location': resourceLocation,
+                        'svccategory': svcCategory.replace("+","")
+                        }
+            else:
+                ResourceIDs[resourceId][meterName]['costcurr'] += valueRate
+    return svcCategory
+
+## Processes one subscription (usage details and all the processBillingFor* passes) and returns its BillingResult.
+## Nothing is written to shared state here so this can run in a worker thread.
+def processSubscription(subs, customerCode, UpdateSchedules):
+    subid = subs['subscriptionId']
+    subname = subs['displayName']
+    billingResult = BillingResult(subid, subname)
+    currencyCode = ""
+    VMData = billingResult.VMData
+    ResourceIDs = billingResult.ResourceIDs
+    StorageAccountTags = dict()
+    PendingStorageAccounts = set()
+    # (ALL row index, storage account id, tags of the usage record, consumed service) of the storage sub-resources
+    PendingStorageRows = []
+    ServiceCost = billingResult.ServiceCost
+    SubsTotalCost = 0
+    subscriptionStart = time.monotonic()
+
+    writeLog(f"Connecting to subscription [{subname}] ({subid})")
+
+    ##
+    ## SUBSCRIPTIONS COST
+    ##
+
+    writeLog(f"Calling REST API for Usage detail for subscription [{subid}]")
+    # the items are read page by page, the next page is already fetched (or decoded while downloaded) while this one is processed
+    if Checkpoints == None:
+        usageItems = common.iterateRESTValues(getUsageDetailsUrl(subid, dtstart, dtend, dtstart2, dtend2),apiToken,LogEnableDebug)
+    else:
+        usageItems = iterateCheckpointedUsageItems(subid)
+    usageItems = runMetrics.countUsageRecords(subid, usageItems)
+    if isColumnarEngineEnabled():
+        # the columnar engine fills billingResult with the same results as the loop below, which is then skipped
+        classifyUsageColumnar(billingResult, subid, subname, usageItems)
+        currencyCode = billingResult.currencyCode
+        SubsTotalCost = billingResult.SubsTotalCost
+        usageItems = []
+    for val in usageItems:
+        if 'properties' in val:
+
+            # Retrieve properties from billing entry
+            apikind = val['kind']
+            prop = val['properties']
+            meterid = prop['meterId']
+            serviceType = prop['consumedService'].lower().replace("microsoft.","").capitalize()
+            resourceLocation = prop['resourceLocation']     
+            resourceUsageDate = prop['date'].replace("T00:00:00Z","").replace("T00:00:00.0000000Z","")                               
+            if apikind == "modern":
+                meterName = prop['meterName']
+                resourceId = prop['instanceName'].lower()
+                currencyCode = prop['billingCurrencyCode']
+                #currencyCostProperty = 'paygCostInBillingCurrency'
+                currencyCostProperty = 'costInBillingCurrency'
+            else:
+                meterDetails = prop['meterDetails']
+                if 'meterName' in meterDetails:
+                    meterName = meterDetails['meterName']
+                else:
+                    meterName = "n/a"
+                resourceId = prop['resourceId'].lower()
+                currencyCode = prop['billingCurrency']
+                currencyCostProperty = 'cost'
+            parsedResourceId = parseResourceId(resourceId)
+            if parsedResourceId.resourceGroup != None:
+                resourceGroupName = parsedResourceId.resourceGroup
+            else:
+                resourceGroupName = "n/a"
+            if parsedResourceId.name != None:
+                resourceName = parsedResourceId.name
+                resourceType = parsedResourceId.resourceType
+            else:
+                resourceName = ""
+                resourceType = prop['consumedService']
+            if 'tags' in val and val['tags']!=None:
+                resourceTags = dict((k.lower(), v) for k, v in val['tags'].items())
+            else:
+                resourceTags = None
+
+            # Calculate the cost for this resource
+            valueRate = 0
+            billingCurrencyFix = ""
+            if (("BillingCurrencyFix" in os.environ)):
+                billingCurrencyFix = os.environ["BillingCurrencyFix"]
+
+            if currencyCostProperty in prop:
+                valueRate = prop[currencyCostProperty]
+                writeLogDebug(f"[SUBS] Old Value rate [{valueRate}]")
+                writeLogDebug(f"[SUBS] billingCurrencyFix [{billingCurrencyFix}]")
+                if billingCurrencyFix == "Yes":
+                    writeLogDebug(f"We are in the new Logic")
+                    exchangeRate = float(prop["exchangeRate"])
+                    quantity = float(prop["quantity"])
+                    unitPrice = float(prop["unitPrice"])
+                    writeLogDebug(f"[SUBS] exchangeRate [{exchangeRate}] quantity [{quantity}] unitPrice [{unitPrice}] ]")
+                    valueRate = exchangeRate*quantity*unitPrice
+                    writeLogDebug(f"[SUBS] valueRate [{valueRate}]")
+
+                SubsTotalCost += valueRate
+                writeLogDebug(f"[SUBS] Service [{serviceType}] Resource [{resourceGroupName}\\{resourceName}] Meter [{meterName}] Cost [{valueRate:.2f} {currencyCode}] TotalCost [{SubsTotalCost:.2f}]")
+            else:
+                writeLogError(f"ERROR: COST not found for Service [{serviceType}] Resource [{resourceGroupName}\\{resourceName}] !")
+
+            if 'pricingModel' in prop:
+                pricingModelValue = prop['pricingModel']
+            else:
+                pricingModelValue = "n/a"
+
+            # Specific processing for storage accounts sub-resources (blob, tables, queues..) as tags are not supported
+            storageRootResourceId = None
+            if resourceType.lower() == "microsoft.storage/storageaccounts":
+                if (len(parsedResourceId.childSegments) == 2) and (parsedResourceId.childSegments[1] == "default"):
+                    rootStorageResourceId = parsedResourceId.getRootId()
+                    if (rootStorageResourceId in StorageAccountTags) and (rootStorageResourceId not in PendingStorageAccounts):
+                        # Get the tags from the root storage account resource if already stored in cache
+                        resourceTags = StorageAccountTags[rootStorageResourceId]
+                    else:
+                        # The tags of the root storage accounts not seen yet are resolved all at once after the last usage page
+                        PendingStorageAccounts.add(rootStorageResourceId)
+                        storageRootResourceId = rootStorageResourceId
+                else:
+                    # Store the tags of the storage account resource in cache for later processing
+                    if resourceId not in StorageAccountTags:
+                        StorageAccountTags[resourceId] = resourceTags
+
+            if storageRootResourceId == None:
+                # Check if managed and purpose TAGs are present
+                managedTag, managedTagValue, purposeTagValue = getManagedTagValues(resourceTags)
+
+                # For managed VMs, store information and cost per resourceID for later use
+                if resourceType.lower() == "microsoft.compute/virtualmachines":
+                    if managedTag == "YES":
+                        if VirtualMachineOSVersionTag['TagName'].lower() in resourceTags:
+                            osVersion = resourceTags[VirtualMachineOSVersionTag['TagName'].lower()]
+                        else:
+                            osVersion = "Unknown"
+                        if resourceId not in VMData:
+                            VMData[resourceId] = {
+                                'costcurr': valueRate,
+                                'osversion': osVersion,
+                                'name': resourceName
+                                }
+                        else:
+                            VMData[resourceId]['costcurr'] += valueRate
+                            if osVersion != "Unknown":
+                                VMData[resourceId]['osversion'] = osVersion
+
+                svcCategory = storeManagedCost(billingResult, resourceId, meterName, resourceLocation, prop['consumedService'], valueRate, managedTag)
+            else:
+                # The tag columns of the row are back-filled once the storage account is resolved, the resource keeps its
+                # place in the AZU-COST resources meanwhile
+                managedTag, managedTagValue, purposeTagValue = "No", "n/a", "n/a"
+                svcCategory = "None"
+                if resourceId not in ResourceIDs:
+                    ResourceIDs[resourceId] = None
+
+            # Add resource to global list CSV
+            billingResult.setCSVFileHeaderRow(
+                "ALL", 
+                [
+                    "Subscription Id",
+                    "Subscription Name",
+                    "Service Category",
+                    "Resource Type",
+                    "Resource Name",
+                    "Resource Group",
+                    "Resource Location",
+                    "Managed TAG (Y/N)",
+                    "Managed TAG Value",
+                    "Purpose TAG Value",
+                    "Meter Name",
+                    "Cost ("+currencyCode+")",
+                    "Pricing Model",
+                    "Resource ID"
+                ]
+            )
+            rowIndex = billingResult.storeCSVDataForSubscription(
+                "ALL",
+                [
+                    subid,
+                    subname,
+                    svcCategory,
+                    resourceType.lower(),
+                    resourceName,
+                    resourceGroupName,
+                    resourceLocation,
+                    managedTag,
+                    managedTagValue,
+                    purposeTagValue,
+                    meterName,
+                    float(valueRate),
+                    pricingModelValue,
+                    resourceId
+                ]
+            )
+            if storageRootResourceId != None:
+                PendingStorageRows.append((rowIndex, storageRootResourceId, resourceTags, prop['consumedService']))
+
+    # Resolve the tags of the storage accounts in bulk and back-fill the rows of their sub-resources, in their original order
+    if len(PendingStorageAccounts) > 0:
+        # StorageAccountTags also has the tags of the accounts whose own usage record came after their sub-resources
+        resolvedStorageAccountTags = resolveStorageAccountTags(subid, PendingStorageAccounts, StorageAccountTags)
+        for rowIndex, storageRootResourceId, resourceTags, consumedService in PendingStorageRows:
+            if storageRootResourceId in resolvedStorageAccountTags:
+                resourceTags = resolvedStorageAccountTags[storageRootResourceId]
+            managedTag, managedTagValue, purposeTagValue = getManagedTagValues(resourceTags)
+            allRow = billingResult.getCSVDataRow("ALL", rowIndex)
+            svcCategory = storeManagedCost(billingResult, allRow[13], allRow[10], allRow[6], consumedService, allRow[11], managedTag)
+            billingResult.updateCSVDataForSubscription("ALL", rowIndex, {2: svcCategory, 7: managedTag, 8: managedTagValue, 9: purposeTagValue})
+        # the sub-resources that are not managed have no AZU-COST rows
+        for resourceId in [resourceId for resourceId, meterNames in ResourceIDs.items() if meterNames == None]:
+            del ResourceIDs[resourceId]
+
+    billingResult.currencyCode = currencyCode
+    billingResult.SubsTotalCost = SubsTotalCost
+
+    # Add subscription total cost to CSV
+    billingResult.setCSVFileHeaderRow("SUBS", ["Subscription Id","Subscription Name","Cost ("+currencyCode+")"])
+    billingResult.storeCSVDataForSubscription(
+        "SUBS",
+        [subid,subname,float(SubsTotalCost)]
+    )
+    writeLogDebug(f"[SUBS] Total cost for subscription is [{formatNumber(SubsTotalCost)} {currencyCode}]")
+
+    # Add services category total cost to CSV
+    if len(serviceSplitData) > 0 :
+        for serviceEntry in serviceSplitData[0]:
+            ServiceCategoryName = serviceEntry['ServiceCategoryName']
+            if ServiceCategoryName not in ServiceCost:
+                ServiceCost[ServiceCategoryName] = 0
+            SvcTotalCost = formatNumber(ServiceCost[ServiceCategoryName])
+            billingResult.setCSVFileHeaderRow("SVC", ["Subscription Id","Subscription Name","Service Category","Cost ("+currencyCode+")"])                            
+            billingResult.storeCSVDataForSubscription(
+                "SVC",
+                [subid,subname,ServiceCategoryName,float(ServiceCost[ServiceCategoryName])]
+            )
+            writeLogDebug(f"[SVC] Total cost for Service [{ServiceCategoryName}] for subscription is [{SvcTotalCost} {currencyCode}]")
+
+    runMetrics.recordStage("usageDetails", subid, time.monotonic() - subscriptionStart)
+
+    ##
+    ## AZU-COST (CloudDB)
+    ##
+
+    processBillingForAZUCost(
+        billingResult,
+        customerCode,
+        subid,
+        "AZU-COST:"+subid,
+        currencyCode
+    )
+
+    # ##
+    # ## ELZ SPOKES VNET
+    # ##
+
+    processBillingForResourceType(
+        billingResult,
+        customerCode,
+        subid,
+        "SPOKES",
+        "Microsoft.Network/virtualNetworks",
+        common.getApplicationConfigJSON("VNET_SPOKES_TAG"),
+        ["Subscription Id","Resource Group Name", "Spoke VNET Name", "Tag"]
+    )
+
+    ##
+    ## ELZ IMAGE GALLERY
+    ##
+
+    processBillingForResourceType(
+        billingResult,
+        customerCode,
+        subid,
+        "IMAGE_GALLERY",
+        "Microsoft.Compute/galleries",
+        common.getApplicationConfigJSON("IMG_GALLERY_TAG"),
+        ["Subscription Id","Resource Group Name", "Shared Image Gallery Name", "Tag"]
+    )
+
+    ##
+    ## ELZ POLICY DEFINITIONS
+    ##
+
+    processBillingForCustomPolicies(
+        billingResult,
+        subid,
+        "CUSTOM_POLICIES",
+        "Microsoft.Authorization/policyDefinitions",
+        common.getApplicationConfigJSON("CUSTOM_POLICIES_METADATA"),
+        ["Subscription Id","Policy Definition Name"]
+    )
+
+    ##
+    ## VM COMPLIANT TAG (CloudDB)
+    ##
+
+    processBillingForVM(
+        billingResult,
+        customerCode,
+        subid,
+        "AZU-OS:"+subid,
+        currencyCode
+    )
+
+    ##
+    ## VM PATCH TAG
+    ##
+
+    processBillingForResourceType(
+        billingResult,
+        customerCode,
+        subid,
+        "INST_VM_PATCH_TAG",
+        "Microsoft.Compute/virtualMachines",
+        common.getApplicationConfigJSON("VM_PATCH_TAG"),
+        ["Subscription Id","Resource Group Name", "VM Name", "Tag"],
+        UpdateSchedules
+    )
+
+    ##
+    ## VM BACKUP TAG
+    ##
+
+    processBillingForVMBackup(
+        billingResult,
+        subid,
+        "INST_VM_BACKUP_TAG",
+        common.getApplicationConfigJSON("VM_BACKUP_TAG"),
+        common.getApplicationConfigJSON("RECOVERY_VAULT_TAG"),
+        ["Subscription Id","Resource Group Name", "VM Name", "Recovery Vault Name", "Backup Policy", "Tag"]
+    )
+
+    billingResult.storeCSVDataForSubscription(
+        "AZU-COST:"+subid,
+        [customerCode,subid,"Heartbeat","NoRegion","Heartbeat","0","USD","Heartbeat"]
+    )
+    billingResult.storeCSVDataForSubscription(
+        "AZU-OS:"+subid,
+        [customerCode,subid,"Heartbeat","Heartbeat","Heartbeat",0,"USD"]
+    )
+
+    runMetrics.recordStage("processSubscription", subid, time.monotonic() - subscriptionStart)
+    return billingResult
+
 def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.Out[str]) -> None:
    
     ##
     ## MAIN SCRIPT
     ##
 
+    # Declaring variables
+    global LogInfoOutput, LogErrorOutput
+    # new logs for every run, the worker process keeps the module between runs
+    LogInfoOutput = logSink.createRunLogSink("billingupload", "info")
+    LogErrorOutput = logSink.createRunLogSink("billingupload", "error")
+    functionMetrics = runMetrics.startRun("billingupload")
+
     if mytimer.past_due:
         writeLog('The timer is past due!')
 
     writeLog("Billing function started")
 
-    # Declaring variables
-    global LogEnableDebug, VMData, ResourceIDs, apiToken, serviceSplitData, BillingCustomerCode, tagPrefix
+    global LogEnableDebug, apiToken, serviceSplitData, ServiceCategoryIndex, BillingCustomerCode, tagPrefix, Inventory, Checkpoints
+    global dtstart, dtstart2, dtend, dtend2, serviceProviderManagedTag, serviceProviderPurposeTag, VirtualMachineOSVersionTag
     if (("LOG_LEVEL" in os.environ) and (os.environ["LOG_LEVEL"] == "DEBUG")):
         LogEnableDebug = True
     utc_timestamp = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat()    
     
+    # all the secrets (customer name and Google bucket) are read at once, the configuration functions below use the cached values
+    common.getKeyVaultSecrets(common.getBillingSecretNames())
     BillingCustomerCode = common.getBillingCustomerNameConfiguration()
     if not BillingCustomerCode:
         writeLogError(f"The Billing customer name could not be retrieved from the Keyvault, using default value")
@@ -429,6 +967,7 @@ def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.
 
     timeScriptStart = time.time()
     serviceSplitData = common.getApplicationConfigJSON("SERVICES_SPLIT_DATA")
+    ServiceCategoryIndex = common.getServiceCategoryIndex(serviceSplitData)
     serviceProviderManagedTag = common.getApplicationConfigJSON("VM_COMPL_TAG")
     serviceProviderPurposeTag = os.environ["PRODUCT_PURPOSE_TAG"]
     VirtualMachineOSVersionTag = common.getApplicationConfigJSON("VM_OSVERSION_TAG")
@@ -443,362 +982,57 @@ def main(mytimer: func.TimerRequest,errorOutput: func.Out[str],infoOutput: func.
     else:
         apiToken = common.getTokenFromManage('https://management.azure.com/')
 
+    resp = common.callREST(f"https://management.azure.com/subscriptions?api-version=2020-01-01",apiToken,LogEnableDebug)
+    subscriptions = resp['value'] if 'value' in resp else []
+
+    # Resources are read from ARM per subscription and type, or loaded at once from Resource Graph
+    Inventory = resourceInventory.ResourceInventory(apiToken, LogEnableDebug)
+    if resourceInventory.getInventoryBackend() == "graph":
+        Inventory.loadFromResourceGraph([subs['subscriptionId'] for subs in subscriptions], InventoryResourceTypes)
+
+    # Usage records already ingested for the billing period are reused from the checkpoints when they are enabled
+    checkpointStore = usageCheckpoints.getCheckpointStore()
+    Checkpoints = usageCheckpoints.UsageCheckpoints(checkpointStore) if checkpointStore != None else None
+
     # Search for the maintenance configuration items in CUST MGMT to retrieve the update schedules
-    UpdateSchedules = retrievePatchSchedules()
+    UpdateSchedules = retrievePatchSchedules(subscriptions)
 
     ##
     ## Customer subscriptions MAIN LOOP
     ##
 
-    resp = common.callREST(f"https://management.azure.com/subscriptions?api-version=2020-01-01",apiToken,LogEnableDebug)
     if 'statuscode' not in resp:
+        runResult = BillingResult()
         if 'value' in resp:
             if len(resp['value']) >0:
-                for subs in resp['value']:
-                    subid = subs['subscriptionId']
-                    subname = subs['displayName']
-                    currencyCode = ""
-                    VMData = dict()
-                    ResourceIDs = dict()
-                    StorageAccountTags = dict()
-                    ServiceCost = dict()
-                    SubsTotalCost = 0
-
-                    writeLog(f"Connecting to subscription [{subname}] ({subid})")
-
-                    ##
-                    ## SUBSCRIPTIONS COST
-                    ##
-
-                    billingAPIurl = f"https://management.azure.com/subscriptions/{subid}/providers/Microsoft.Consumption/usageDetails?api-version=2019-10-01&startDate={dtstart}&endDate={dtend}&metric=actualcost&$expand=meterDetails&$filter=properties%2FusageStart%20ge%20'{dtstart2}'%20and%20properties%2FusageEnd%20le%20'{dtend2}'"
-
-                    while (billingAPIurl != None):
-                        writeLog(f"Calling REST API for Usage detail for subscription [{subid}]")                            
-                        usagedetails = common.callREST(billingAPIurl,apiToken,LogEnableDebug)
-
-                        # handle paging in API answer
-                        if 'nextLink' in usagedetails:
-                            billingAPIurl = usagedetails['nextLink']
-                        else:
-                            billingAPIurl = None
-
-                        # process billing resource item
-                        if 'value' in usagedetails:
-                            if len(usagedetails['value']) >0:
-                                for val in usagedetails['value']:
-                                    if 'properties' in val:
-
-                                        # Retrieve properties from billing entry
-                                        apikind = val['kind']
-                                        prop = val['properties']
-                                        meterid = prop['meterId']
-                                        serviceType = prop['consumedService'].lower().replace("microsoft.","").capitalize()
-                                        resourceLocation = prop['resourceLocation']     
-                                        resourceUsageDate = prop['date'].replace("T00:00:00Z","").replace("T00:00:00.0000000Z","")                               
-                                        if apikind == "modern":
-                                            meterName = prop['meterName']
-                                            resourceId = prop['instanceName'].lower()
-                                            currencyCode = prop['billingCurrencyCode']
-                                            #currencyCostProperty = 'paygCostInBillingCurrency'
-                                            currencyCostProperty = 'costInBillingCurrency'
-                                        else:
-                                            meterDetails = prop['meterDetails']
-                                            if 'meterName' in meterDetails:
-                                                meterName = meterDetails['meterName']
-                                            else:
-                                                meterName = "n/a"
-                                            resourceId = prop['resourceId'].lower()
-                                            currencyCode = prop['billingCurrency']
-                                            currencyCostProperty = 'cost'
-                                        if len(resourceId.split("/")) >= 4: 
-                                            resourceGroupName = resourceId.split("/")[4]
-                                        else:
-                                            resourceGroupName = "n/a"
-                                        if len(resourceId.split("/")) >= 8: 
-                                            resourceName = resourceId.split("/")[8]
-                                            resourceType = resourceId.split("/")[6]+"/"+resourceId.split("/")[7]
-                                        else:
-                                            resourceName = ""
-                                            resourceType = prop['consumedService']
-                                        if 'tags' in val and val['tags']!=None:
-                                            resourceTags = dict((k.lower(), v) for k, v in val['tags'].items())
-                                        else:
-                                            resourceTags = None
-
-                                        # Calculate the cost for this resource
-                                        valueRate = 0
-                                        billingCurrencyFix = ""
-                                        if (("BillingCurrencyFix" in os.environ)):
-                                            billingCurrencyFix = os.environ["BillingCurrencyFix"]
-                                            
-                                        if currencyCostProperty in prop:
-                                            valueRate = prop[currencyCostProperty]
-                                            writeLogDebug(f"[SUBS] Old Value rate [{valueRate}]")
-                                            writeLogDebug(f"[SUBS] billingCurrencyFix [{billingCurrencyFix}]")
-                                            if billingCurrencyFix == "Yes":
-                                                writeLogDebug(f"We are in the new Logic")
-                                                exchangeRate = float(prop["exchangeRate"])
-                                                quantity = float(prop["quantity"])
-                                                unitPrice = float(prop["unitPrice"])
-                                                writeLogDebug(f"[SUBS] exchangeRate [{exchangeRate}] quantity [{quantity}] unitPrice [{unitPrice}] ]")
-                                                valueRate = exchangeRate*quantity*unitPrice
-                                                writeLogDebug(f"[SUBS] valueRate [{valueRate}]")
-                                                
-                                            SubsTotalCost += valueRate
-                                            writeLogDebug(f"[SUBS] Service [{serviceType}] Resource [{resourceGroupName}\\{resourceName}] Meter [{meterName}] Cost [{valueRate:.2f} {currencyCode}] TotalCost [{SubsTotalCost:.2f}]")
-                                        else:
-                                            writeLogError(f"ERROR: COST not found for Service [{serviceType}] Resource [{resourceGroupName}\\{resourceName}] !")
-
-                                        if 'pricingModel' in prop:
-                                            pricingModelValue = prop['pricingModel']
-                                        else:
-                                            pricingModelValue = "n/a"
-
-                                        # Specific processing for storage accounts sub-resources (blob, tables, queues..) as tags are not supported
-                                        if resourceType.lower() == "microsoft.storage/storageaccounts":
-                                            if (len(resourceId.split("/")) == 11) and (resourceId.split("/")[10] == "default"):
-                                                rootStorageResourceId = resourceId.replace("/" + resourceId.split("/")[9] + "/" + resourceId.split("/")[10],"")
-                                                if rootStorageResourceId in StorageAccountTags:
-                                                    # Get the tags from the root storage account resource if already stored in cache
-                                                    resourceTags = StorageAccountTags[rootStorageResourceId]
-                                                else:
-                                                    # Get the tags from the root storage account resource using API if not already stored in cache
-                                                    rootStorageBillingAPIurl = f"https://management.azure.com/subscriptions/{subid}/providers/Microsoft.Consumption/usageDetails?api-version=2019-10-01&startDate={dtstart}&endDate={dtend}&metric=actualcost&$expand=meterDetails&$filter=properties%2FusageStart%20ge%20'{dtstart2}'%20and%20properties%2FusageEnd%20le%20'{dtend2}'%20and%20resourceId%20eq%20'{rootStorageResourceId}'"
-                                                    rootStorageUsageDetails = common.callREST(rootStorageBillingAPIurl,apiToken,LogEnableDebug)
-                                                    if 'value' in rootStorageUsageDetails:
-                                                        if len(rootStorageUsageDetails['value']) >0:
-                                                            if 'properties' in rootStorageUsageDetails['value'][0]:
-                                                                if 'tags' in rootStorageUsageDetails['value'][0] and rootStorageUsageDetails['value'][0]['tags']!=None:
-                                                                    resourceTags = dict((k.lower(), v) for k, v in rootStorageUsageDetails['value'][0]['tags'].items())
-                                                                else:
-                                                                    resourceTags = None
-                                                                writeLogDebug(f"STORAGE ACCOUNT : Retrieved tags for [{rootStorageResourceId}]")
-                                                                if rootStorageResourceId not in StorageAccountTags:
-                                                                    StorageAccountTags[rootStorageResourceId] = resourceTags
-                                            else:
-                                                # Store the tags of the storage account resource in cache for later processing
-                                                if resourceId not in StorageAccountTags:
-                                                    StorageAccountTags[resourceId] = resourceTags
-
-                                        # Check if managed and purpose TAGs are present
-                                        managedTag = "No"
-                                        purposeTagValue = "n/a"
-                                        managedTagValue = "n/a"
-                                        if (resourceTags != None) and (serviceProviderManagedTag['TagName'].lower() in resourceTags):
-                                            valtag = resourceTags[serviceProviderManagedTag['TagName'].lower()]
-                                            if ((valtag.lower() == serviceProviderManagedTag['TagValue'].lower()) or (valtag.lower().startswith(tagPrefix.lower()))):
-                                                managedTag = "YES"
-                                                managedTagValue = valtag
-                                        if (resourceTags != None) and (serviceProviderPurposeTag.lower() in resourceTags):
-                                            purposeTagValue = resourceTags[serviceProviderPurposeTag.lower()]
-
-                                        # For managed VMs, store information and cost per resourceID for later use
-                                        if resourceType.lower() == "microsoft.compute/virtualmachines":
-                                            if managedTag == "YES":
-                                                if VirtualMachineOSVersionTag['TagName'].lower() in resourceTags:
-                                                    osVersion = resourceTags[VirtualMachineOSVersionTag['TagName'].lower()]
-                                                else:
-                                                    osVersion = "Unknown"
-                                                if resourceId not in VMData:
-                                                    VMData[resourceId] = {
-                                                        'costcurr': valueRate,
-                                                        'osversion': osVersion,
-                                                        'name': resourceName
-                                                        }
-                                                else:
-                                                    VMData[resourceId]['costcurr'] += valueRate
-                                                    if osVersion != "Unknown":
-                                                        VMData[resourceId]['osversion'] = osVersion
-
-                                        # Check if the resource if part of a service category and the managed TAG is present, if yes then store cost
-                                        writeLogDebug(f"The point of error is [{prop['consumedService']}]")
-                                        svcCategory = getServiceCategory(prop['consumedService'])
-                                        if (svcCategory) and (managedTag == "YES"):
-                                            if svcCategory not in ServiceCost:
-                                                ServiceCost[svcCategory] = 0
-                                            ServiceCost[svcCategory] += valueRate
-                                            #writeLogDebug(f"[SVC-{svcCategory}] Adding cost [{valueRate:.2f}] - TotalCost [{ServiceCost[svcCategory]:.2f}]")
-                                        else:
-                                            svcCategory = "None"
-
-                                        # For AZU-COST, store information and cost per resourceID/Metername for later use
-                                        if managedTag == "YES":
-                                            if resourceId not in ResourceIDs:
-                                                ResourceIDs[resourceId] = dict()
-                                            else:
-                                                if meterName not in ResourceIDs[resourceId]:
-                                                    ResourceIDs[resourceId][meterName] = {
-                                                            'costcurr': valueRate,
-                                                            'location': resourceLocation,
-                                                            'svccategory': svcCategory.replace("+","")
-                                                            }
-                                                else:
-                                                    ResourceIDs[resourceId][meterName]['costcurr'] += valueRate
-
-                                        # Add resource to global list CSV
-                                        setCSVFileHeaderRow(
-                                            "ALL", 
-                                            [
-                                                "Subscription Id",
-                                                "Subscription Name",
-                                                "Service Category",
-                                                "Resource Type",
-                                                "Resource Name",
-                                                "Resource Group",
-                                                "Resource Location",
-                                                "Managed TAG (Y/N)",
-                                                "Managed TAG Value",
-                                                "Purpose TAG Value",
-                                                "Meter Name",
-                                                "Cost ("+currencyCode+")",
-                                                "Pricing Model",
-                                                "Resource ID"
-                                            ]
-                                        )
-                                        storeCSVDataForSubscription(
-                                            "ALL",
-                                            [
-                                                subid,
-                                                subname,
-                                                svcCategory,
-                                                resourceType.lower(),
-                                                resourceName,
-                                                resourceGroupName,
-                                                resourceLocation,
-                                                managedTag,
-                                                managedTagValue,
-                                                purposeTagValue,
-                                                meterName,
-                                                formatNumber(valueRate),
-                                                pricingModelValue,
-                                                resourceId
-                                            ]
-                                        )
-
-                    # Add subscription total cost to CSV
-                    setCSVFileHeaderRow("SUBS", ["Subscription Id","Subscription Name","Cost ("+currencyCode+")"])
-                    storeCSVDataForSubscription(
-                        "SUBS",
-                        [subid,subname,formatNumber(SubsTotalCost)]
-                    )
-                    writeLogDebug(f"[SUBS] Total cost for subscription is [{formatNumber(SubsTotalCost)} {currencyCode}]")
-
-                    # Add services category total cost to CSV
-                    if len(serviceSplitData) > 0 :
-                        for serviceEntry in serviceSplitData[0]:
-                            ServiceCategoryName = serviceEntry['ServiceCategoryName']
-                            if ServiceCategoryName not in ServiceCost:
-                                ServiceCost[ServiceCategoryName] = 0
-                            SvcTotalCost = formatNumber(ServiceCost[ServiceCategoryName])
-                            setCSVFileHeaderRow("SVC", ["Subscription Id","Subscription Name","Service Category","Cost ("+currencyCode+")"])                            
-                            storeCSVDataForSubscription(
-                                "SVC",
-                                [subid,subname,ServiceCategoryName,SvcTotalCost]
-                            )
-                            writeLogDebug(f"[SVC] Total cost for Service [{ServiceCategoryName}] for subscription is [{SvcTotalCost} {currencyCode}]")
-
-                    ##
-                    ## AZU-COST (CloudDB)
-                    ##
-
-                    processBillingForAZUCost(
-                        customerCode,
-                        subid,
-                        "AZU-COST:"+subid,
-                        currencyCode
-                    )
-
-                    # ##
-                    # ## ELZ SPOKES VNET
-                    # ##
-
-                    processBillingForResourceType(
-                        customerCode,
-                        subid,
-                        "SPOKES",
-                        "Microsoft.Network/virtualNetworks",
-                        common.getApplicationConfigJSON("VNET_SPOKES_TAG"),
-                        ["Subscription Id","Resource Group Name", "Spoke VNET Name", "Tag"]
-                    )
-
-                    ##
-                    ## ELZ IMAGE GALLERY
-                    ##
-
-                    processBillingForResourceType(
-                        customerCode,
-                        subid,
-                        "IMAGE_GALLERY",
-                        "Microsoft.Compute/galleries",
-                        common.getApplicationConfigJSON("IMG_GALLERY_TAG"),
-                        ["Subscription Id","Resource Group Name", "Shared Image Gallery Name", "Tag"]
-                    )
-
-                    ##
-                    ## ELZ POLICY DEFINITIONS
-                    ##
-
-                    processBillingForCustomPolicies(
-                        subid,
-                        "CUSTOM_POLICIES",
-                        "Microsoft.Authorization/policyDefinitions",
-                        common.getApplicationConfigJSON("CUSTOM_POLICIES_METADATA"),
-                        ["Subscription Id","Policy Definition Name"]
-                    )
-
-                    ##
-                    ## VM COMPLIANT TAG (CloudDB)
-                    ##
-
-                    processBillingForVM(
-                        customerCode,
-                        subid,
-                        "AZU-OS:"+subid,
-                        currencyCode
-                    )
-
-                    ##
-                    ## VM PATCH TAG
-                    ##
-
-                    processBillingForResourceType(
-                        customerCode,
-                        subid,
-                        "INST_VM_PATCH_TAG",
-                        "Microsoft.Compute/virtualMachines",
-                        common.getApplicationConfigJSON("VM_PATCH_TAG"),
-                        ["Subscription Id","Resource Group Name", "VM Name", "Tag"],
-                        UpdateSchedules
-                    )
-
-                    ##
-                    ## VM BACKUP TAG
-                    ##
-
-                    processBillingForVMBackup(
-                        subid,
-                        "INST_VM_BACKUP_TAG",
-                        common.getApplicationConfigJSON("VM_BACKUP_TAG"),
-                        common.getApplicationConfigJSON("RECOVERY_VAULT_TAG"),
-                        ["Subscription Id","Resource Group Name", "VM Name", "Recovery Vault Name", "Backup Policy", "Tag"]
-                    )
-
-                    storeCSVDataForSubscription(
-                        "AZU-COST:"+subid,
-                        [customerCode,subid,"Heartbeat","NoRegion","Heartbeat","0","USD","Heartbeat"]
-                    )
-                    storeCSVDataForSubscription(
-                        "AZU-OS:"+subid,
-                        [customerCode,subid,"Heartbeat","Heartbeat","Heartbeat",0,"USD"]
-                    )
+                subscriptionWorkers = common.getApplicationConfigInt("BILLING_SUBSCRIPTION_WORKERS", 1)
+                if subscriptionWorkers > 1:
+                    writeLog(f"Processing {len(resp['value'])} subscriptions with {subscriptionWorkers} parallel workers")
+                    with ThreadPoolExecutor(max_workers=subscriptionWorkers) as executor:
+                        # map() returns the results in subscription order, whatever order the workers finish in
+                        subscriptionResults = executor.map(
+                            runMetrics.bindRun(lambda subs: processSubscription(subs, customerCode, UpdateSchedules)),
+                            resp['value'])
+                        for subscriptionResult in subscriptionResults:
+                            runResult.merge(subscriptionResult)
+                else:
+                    for subs in resp['value']:
+                        runResult.merge(processSubscription(subs, customerCode, UpdateSchedules))
 
             # Generate all CSV files and upload them
-            createAndUploadCSVFiles(customerCode,utc_timestamp,datestart_str,dateend_str)
+            createAndUploadCSVFiles(runResult,customerCode,utc_timestamp,datestart_str,dateend_str)
 
     # Finish function
     timeScriptEnd = time.time()
     timeScripTotal = (timeScriptEnd - timeScriptStart)
+    for poolStatisticsLine in httpClient.getPoolStatisticsLogLines():
+        writeLog(poolStatisticsLine)
     writeLog(f"Billing function completed. Elapsed time {round(timeScripTotal,1)} sec")
-    errorOutput.set(LogErrorOutput)
-    infoOutput.set(LogInfoOutput)
+    metricsBlobName = runMetrics.writeRunMetrics(functionMetrics)
+    if metricsBlobName != None:
+        writeLog(f"The metrics of the run are in [{metricsBlobName}]")
+    LogInfoOutput.flush()
+    LogErrorOutput.flush()
+    errorOutput.set(LogErrorOutput.getTail())
+    infoOutput.set(LogInfoOutput.getTail())
     logging.info('Python timer trigger function ran at %s ', utc_timestamp)
@@ -9,6 +9,7 @@ from datetime import timedelta
 
 from ..SharedCode import common
 from ..SharedCode import billingCommon
+from ..SharedCode import httpClient
 
 def main(myblob: InputStream):
     logging.info(f"Python blob trigger function processed blob \n"
@@ -26,7 +27,8 @@ def main(myblob: InputStream):
                 cloudName = tempCloudSplit[1]
 
     if cloudName != "":
-        csvInput = BytesIO(myblob.read())
+        # the blob can have been written gzip compressed (BLOB_COMPRESSION)
+        csvInput = BytesIO(common.decompressBlobContent(myblob.read()))
         billingReader = billingCommon.Billing(cloudName)
         isSuccess = billingReader.getFITFile(csvInput)
         logging.info(isSuccess)
@@ -34,6 +36,8 @@ def main(myblob: InputStream):
             logging.info("FIT File Generated Successfully")
         else:
             logging.info("FIT File Generation Failed")
+        for poolStatisticsLine in httpClient.getPoolStatisticsLogLines():
+            logging.info(poolStatisticsLine)
     else:
         logging.info(f"Invalid Cloud Name")
         